@@ -0,0 +1,260 @@
+"""Bench
+
+This module contains the benchmarks for the hot paths of this simple
+subscription system. Each case replays a synthetic population of a given
+number of events in a fresh process and reports its throughput, latency
+percentiles and peak resident set size as JSON.
+
+Example:
+    $ python bench.py --sizes 1e3 1e5 --output baseline.json
+    $ python bench.py --sizes 1e3 1e5 --compare baseline.json --threshold 0.1
+    $ python bench.py --cases move_to_plan --sizes 1e7
+    $ python bench.py --cases cold_start --sizes 20
+
+Attributes:
+    CASES (dict)    : Maps a case name to a function running it for a number of events
+    DEFAULT_CASES (list) : Cases run when none are given, every case but cold_start
+    SAMPLES (int)   : Maximum number of latencies kept per case
+
+"""
+import os, sys
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import time
+from datetime import datetime
+from subscribersim import cli
+from subscribersim import epochs
+from subscribersim import helpers
+from subscribersim import report
+from subscribersim.models import Customer
+
+SAMPLES = 100000
+PLANS = ["Single", "Plus", "Infinite"]
+START = datetime(2019, 1, 1, 9, 0, 0)
+
+
+class Timer():
+    """Times operations, keeping a bounded evenly spaced sample of latencies.
+
+    Args:
+        size (int)          : Number of operations that will be timed
+
+    Attributes:
+        ops (int)           : Number of operations timed
+        seconds (float)     : Total time spent in timed operations
+        latencies (list)    : Sampled latencies in nanoseconds
+    """
+
+    def __init__(self, size):
+        self.every = max(1, size // SAMPLES)
+        self.ops = 0
+        self.seconds = 0.0
+        self.latencies = []
+
+    def time(self, function, *args, **kwargs):
+        """Calls a function and records its latency"""
+        start = time.perf_counter_ns()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter_ns() - start
+        if self.ops % self.every == 0:
+            self.latencies.append(elapsed)
+        self.ops += 1
+        self.seconds += elapsed / 1e9
+        return result
+
+
+def population(size, rng, moves=10):
+    """Returns customers on random plans covering size events"""
+    people = []
+    for i in range(max(1, size // moves)):
+        person = Customer(f"customer{i}", "secret", f"customer{i}@example.com")
+        person.select_plan(rng.choice(PLANS), START)
+        people.append(person)
+    return people
+
+
+def next_plan(person, rng):
+    """Returns a random plan other than the customer's current plan"""
+    return rng.choice([p for p in PLANS if p != person.current_plan.name])
+
+
+def bench_select_plan(size, rng, timer):
+    """Times select_plan for size new customers"""
+    for i in range(size):
+        person = Customer(f"customer{i}", "secret", f"customer{i}@example.com")
+        timer.time(person.select_plan, rng.choice(PLANS), START)
+
+
+def bench_move_to_plan(size, rng, timer):
+    """Times size prorated plan changes across a population"""
+    people = population(size, rng)
+    when = START
+    while timer.ops < size:
+        when = epochs.datetime_months_hence(when, 1)
+        for person in people[:size - timer.ops]:
+            timer.time(person.move_to_plan, next_plan(person, rng), when)
+
+
+def bench_add_remove_website(size, rng, timer):
+    """Times size website additions and removals on Infinite customers"""
+    people = population(size, rng, moves=100)
+    for person in people:
+        if person.current_plan.name != "Infinite":
+            person.move_to_plan("Infinite", START)
+    while timer.ops < size:
+        for person in people:
+            url = f"site{rng.randrange(50)}.com"
+            if "http://" + url in person.websites:
+                timer.time(person.remove_website, "http://" + url)
+            else:
+                timer.time(person.add_website, url, False)
+
+
+def bench_print_table(size, rng, timer):
+    """Times rendering report tables for size events"""
+    people = population(size, rng)
+    when = START
+    for _ in range(9):
+        when = epochs.datetime_months_hence(when, 1)
+        for person in people:
+            person.move_to_plan(next_plan(person, rng), when)
+    with open(os.devnull, "w") as devnull:
+        for page in range(0, len(people), 10):
+            timer.time(report.write_table, people[page:page + 10], devnull)
+    timer.ops = len(people) * 10
+
+
+def bench_helpers(size, rng, timer):
+    """Times the helpers date functions size times each"""
+    stamps = [helpers.time_to_datetime(rng.randrange(1546300800, 1640995200)) for _ in range(min(size, 10000))]
+    for i in range(size):
+        when = stamps[i % len(stamps)]
+        timer.time(helpers.datetime_months_hence, when, 12)
+        timer.time(helpers.get_seconds_in_current_year, when)
+
+
+def bench_epochs(size, rng, timer):
+    """Times the epochs date functions size times each"""
+    stamps = [helpers.time_to_datetime(rng.randrange(1546300800, 1640995200)) for _ in range(min(size, 10000))]
+    for i in range(size):
+        when = stamps[i % len(stamps)]
+        timer.time(epochs.datetime_months_hence, when, 12)
+        timer.time(epochs.get_seconds_in_current_year, when)
+
+
+def bench_cold_start(size, rng, timer):
+    """Times up to 20 starts of 'subscribersim --version' in fresh interpreters"""
+    command = [sys.executable, "-m", "subscribersim", "--version"]
+    root = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(min(size, 20)):
+        timer.time(subprocess.run, command, check=True, stdout=subprocess.DEVNULL, cwd=root)
+
+
+CASES = {
+    "select_plan": bench_select_plan,
+    "move_to_plan": bench_move_to_plan,
+    "add_remove_website": bench_add_remove_website,
+    "print_table": bench_print_table,
+    "helpers": bench_helpers,
+    "epochs": bench_epochs,
+    "cold_start": bench_cold_start,
+}
+DEFAULT_CASES = [name for name in CASES if name != "cold_start"]
+
+
+def percentile(values, fraction):
+    """Returns a percentile of sorted values by nearest rank"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_case(name, size, seed=0):
+    """Runs a case in this process and returns its result as a dict"""
+    timer = Timer(size)
+    CASES[name](size, random.Random(seed), timer)
+    latencies = sorted(timer.latencies)
+    return {
+        "case": name,
+        "size": size,
+        "ops": timer.ops,
+        "seconds": round(timer.seconds, 6),
+        "throughput": round(timer.ops / timer.seconds, 1) if timer.seconds else 0.0,
+        "p50_us": round(percentile(latencies, 0.50) / 1000, 3),
+        "p90_us": round(percentile(latencies, 0.90) / 1000, 3),
+        "p99_us": round(percentile(latencies, 0.99) / 1000, 3),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_isolated(name, size, seed=0):
+    """Runs a case in a fresh interpreter so that its peak RSS is its own"""
+    output = subprocess.run([sys.executable, __file__, "--run-case", name, str(size), str(seed)],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def compare(results, baseline, threshold):
+    """Returns a description of every result slower than its baseline by more than threshold"""
+    previous = {(r["case"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["case"], result["size"]))
+        if old is None:
+            continue
+        if result["throughput"] < old["throughput"] * (1 - threshold):
+            regressions.append(f'{result["case"]} {result["size"]}: throughput {old["throughput"]} -> {result["throughput"]}')
+        if result["p99_us"] > old["p99_us"] * (1 + threshold):
+            regressions.append(f'{result["case"]} {result["size"]}: p99 {old["p99_us"]}us -> {result["p99_us"]}us')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the subscribersim hot paths")
+    parser.add_argument("--cases", nargs="+", default=DEFAULT_CASES, choices=list(CASES))
+    parser.add_argument("--sizes", nargs="+", default=["1e3", "1e5"], help="Events per case, e.g. 1e3 1e5 1e7")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="Baseline JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Tolerated slowdown as a fraction")
+    parser.add_argument("--run-case", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        name, size, seed = args.run_case
+        print(json.dumps(run_case(name, int(size), int(seed))))
+        return 0
+
+    results = [run_isolated(name, int(float(size)), args.seed) for size in args.sizes for name in args.cases]
+    document = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": helpers.datetime_now().isoformat(),
+        "results": results,
+    }
+    text = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(text + "\n")
+    else:
+        print(text)
+
+    over = [r for r in results if r["case"] == "cold_start" and r["p50_us"] > cli.STARTUP_BUDGET * 1e6]
+    for result in over:
+        print("OVER BUDGET", f'cold_start: p50 {result["p50_us"]}us, budget {cli.STARTUP_BUDGET}s', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(results, json.load(fp), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression, file=sys.stderr)
+        return 1 if regressions or over else 0
+    return 1 if over else 0
+
+
+if (__name__ == '__main__'):
+    sys.exit(main())
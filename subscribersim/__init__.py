@@ -0,0 +1,11 @@
+"""Subscribersim
+
+A simple program that emulates buying a yearly subscription for hosting
+websites. Submodules are imported on use, so importing the package is cheap.
+
+Attributes:
+    __version__ (str) : Package version
+
+"""
+
+__version__ = "0.1.0"
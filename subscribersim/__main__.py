@@ -0,0 +1,6 @@
+"""Runs the subscribersim command, see cli"""
+
+import sys
+from .cli import main
+
+sys.exit(main())
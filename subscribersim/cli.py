@@ -0,0 +1,171 @@
+"""CLI
+
+This module contains the subscribersim console command. Each subcommand
+imports the modules it needs when it runs, so starting the command costs the
+interpreter, argparse and this module: NumPy, tabulate and dateutil are only
+loaded by the subcommands that use them.
+
+Example:
+
+        $ subscribersim demo
+        $ subscribersim replay events.jsonl > summary.csv
+        $ subscribersim report --format csv events.jsonl
+        $ subscribersim run --workers 32 out events.jsonl
+        $ subscribersim save customers.db events.jsonl
+        $ subscribersim scenario jake.yaml --customers 100000 > summary.csv
+        $ subscribersim whatif plans-2020.json events.jsonl
+        $ subscribersim serve --port 8765
+
+Attributes:
+    STARTUP_BUDGET (float) : Seconds allowed for a cold start of 'subscribersim --version', checked by bench.py
+
+"""
+
+import argparse
+import sys
+from . import __version__
+
+STARTUP_BUDGET = 0.1
+
+
+def _events(paths):
+    """Returns the events of logs read one after another"""
+    from itertools import chain
+    from . import replay
+    return chain.from_iterable(replay.read_events(path) for path in paths)
+
+
+def demo(args):
+    """Runs the example interactions"""
+    from . import subscribersim
+    subscribersim.main()
+    return 0
+
+
+def replay_logs(args):
+    """Writes the summary of every replayed customer as CSV"""
+    from . import replay
+    customers = replay.replay(_events(args.logs), args.retire_after)
+    replay.write_summaries((replay.summarize(c) for c in customers), sys.stdout)
+    return 0
+
+
+def report_logs(args):
+    """Writes the report rows of every replayed customer"""
+    from . import replay, report
+    customers = replay.replay(_events(args.logs), args.retire_after)
+    if args.format == "table":
+        report.write_table(customers, sys.stdout)
+    elif args.format == "csv":
+        report.write_csv(customers, sys.stdout)
+    else:
+        report.write_jsonl(customers, sys.stdout)
+    return 0
+
+
+def run_logs(args):
+    """Replays logs on many processes and writes summary.csv and ledger.csv"""
+    from . import runner
+    summaries, rows = runner.run(args.logs, workers=args.workers, shards=args.shards, retire_after=args.retire_after)
+    runner.write_results(summaries, rows, args.directory)
+    return 0
+
+
+def save_logs(args):
+    """Replays logs into a SQLite database and prints the number of customers saved"""
+    from . import database, replay
+    with database.Database(args.database) as db:
+        print(db.save(replay.replay(_events(args.logs), args.retire_after)))
+    return 0
+
+
+def run_scenario(args):
+    """Runs a scenario file over new customers and writes their summaries as CSV"""
+    from . import replay, scenario
+    program = scenario.compile_scenario(scenario.load(args.scenario))
+    customers = scenario.run(program, scenario.population(args.customers, program.name or "customer"))
+    replay.write_summaries((replay.summarize(c) for c in customers), sys.stdout)
+    return 0
+
+
+def what_if(args):
+    """Replays logs and writes the revenue diff per plan under another catalog as CSV"""
+    import csv
+    from . import models, replay, whatif
+    customers = list(replay.replay(_events(args.logs), args.retire_after))
+    writer = csv.writer(sys.stdout)
+    writer.writerow(whatif.Diff._fields)
+    writer.writerows(whatif.diff(customers, models.Catalog.load(args.catalog)))
+    return 0
+
+
+def serve(args, argv):
+    """Runs the billing service or its load generator"""
+    from . import service
+    return service.main([args.command] + argv)
+
+
+def parser():
+    """Returns the argument parser of the command"""
+    parser = argparse.ArgumentParser(prog="subscribersim", description="Simulate yearly website hosting subscriptions")
+    parser.add_argument("--version", action="version", version=f"subscribersim {__version__}")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    command = commands.add_parser("demo", help="Run the example interactions")
+    command.set_defaults(handler=demo)
+
+    for name, handler, description in (("replay", replay_logs, "Write a CSV summary of every customer"),
+                                       ("report", report_logs, "Write the report rows of every customer")):
+        command = commands.add_parser(name, help=description)
+        command.add_argument("logs", nargs="+", help="JSON lines or CSV event logs")
+        command.add_argument("--retire-after", type=int, help="Seconds of log time before an idle customer is emitted, "
+                             "longer than any gap between two events of a customer")
+        command.set_defaults(handler=handler)
+        if name == "report":
+            command.add_argument("--format", choices=["table", "csv", "jsonl"], default="table")
+
+    command = commands.add_parser("run", help="Replay logs on many processes")
+    command.add_argument("directory", help="Output directory for summary.csv and ledger.csv")
+    command.add_argument("logs", nargs="+")
+    command.add_argument("--workers", type=int, default=1)
+    command.add_argument("--shards", type=int)
+    command.add_argument("--retire-after", type=int)
+    command.set_defaults(handler=run_logs)
+
+    command = commands.add_parser("save", help="Replay logs into a SQLite database")
+    command.add_argument("database")
+    command.add_argument("logs", nargs="+")
+    command.add_argument("--retire-after", type=int)
+    command.set_defaults(handler=save_logs)
+
+    command = commands.add_parser("scenario", help="Run a JSON or YAML scenario over new customers")
+    command.add_argument("scenario")
+    command.add_argument("--customers", type=int, default=1)
+    command.set_defaults(handler=run_scenario)
+
+    command = commands.add_parser("whatif", help="Diff the revenue per plan of logs under another catalog")
+    command.add_argument("catalog", help="JSON catalog, see models.Catalog.load")
+    command.add_argument("logs", nargs="+")
+    command.add_argument("--retire-after", type=int)
+    command.set_defaults(handler=what_if)
+
+    for name in ("serve", "load"):
+        command = commands.add_parser(name, help=f"{name.capitalize()} the billing service, see service --help",
+                                      add_help=False)
+        command.set_defaults(handler=serve)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args, rest = parser().parse_known_args(argv)
+    if args.handler is serve:
+        return serve(args, rest)
+    if rest:
+        parser().error(f"unrecognized arguments: {' '.join(rest)}")
+    return args.handler(args)
+
+
+if (__name__ == '__main__'):
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""Database
+
+This module persists customers to a local SQLite database so that replayed
+state outlives the process. Customers, their events, money ledgers and
+websites are written in batches with executemany, one transaction per batch,
+and the database runs in WAL mode so readers are not blocked by a replay
+writing to it. Ledger tables are keyed by (customer, seq) and events are also
+indexed by time, so a single customer or a time range is read without
+scanning the whole file.
+
+Example:
+
+        with Database("customers.db") as db:
+            db.save(replay.replay(replay.read_events("events.jsonl")))
+            jake = db.load("Jake Peralta")
+
+        $ python -m subscribersim.database customers.db events.jsonl
+
+Attributes:
+    SCHEMA (str) : Tables and indexes created by Database
+
+"""
+
+import sqlite3
+import sys
+from array import array
+from itertools import chain
+from . import epochs
+from . import helpers
+from . import models
+from . import replay
+from . import store as stores
+
+MONEY = stores.LEDGERS[1:]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, password TEXT, email TEXT,
+    plan TEXT, renews INTEGER);
+CREATE TABLE IF NOT EXISTS events (
+    customer INTEGER NOT NULL, seq INTEGER NOT NULL, time INTEGER NOT NULL, plan TEXT, type TEXT,
+    sites INTEGER, payments INTEGER, refunds INTEGER, spend INTEGER,
+    PRIMARY KEY (customer, seq)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE TABLE IF NOT EXISTS websites (
+    customer INTEGER NOT NULL, seq INTEGER NOT NULL, url TEXT NOT NULL, has_database INTEGER,
+    PRIMARY KEY (customer, seq)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS websites_url ON websites (url);
+""" + "".join(f"""
+CREATE TABLE IF NOT EXISTS {name} (
+    customer INTEGER NOT NULL, seq INTEGER NOT NULL, cents INTEGER NOT NULL,
+    PRIMARY KEY (customer, seq)) WITHOUT ROWID;
+""" for name in MONEY)
+
+
+class Database():
+    """A database holds persisted customers in a SQLite file.
+
+    Saving a customer that is already stored replaces its rows.
+
+    Args:
+        path (str)          : SQLite file, created if missing
+        batch_size (int)    : Customers written per transaction by save
+
+    Attributes:
+        connection (obj:sqlite3.Connection) : Open connection
+        ids (dict)                          : Maps a customer name to its row id
+    """
+
+    def __init__(self, path, batch_size=1000):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.ids = dict(self.connection.execute("SELECT name, id FROM customers"))
+        self.next_id = max(self.ids.values(), default=0) + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def close(self):
+        """Closes the connection"""
+        self.connection.close()
+
+    def save(self, customers):
+        """Writes customers in transactions of batch_size customers and returns how many were written"""
+        count, batch = 0, {}
+        for customer in customers:
+            batch[customer.name] = self._rows(customer)
+            if len(batch) == self.batch_size:
+                count += self._write(list(batch.values()))
+                batch = {}
+        return count + self._write(list(batch.values()))
+
+    def load(self, name, store=None):
+        """Returns the stored customer with a name, restored into store"""
+        cid = self.ids.get(name)
+        if cid is None:
+            raise Exception("Customer")
+        db = self.connection
+        _, password, email, plan, renews = db.execute(
+            "SELECT name, password, email, plan, renews FROM customers WHERE id = ?", (cid,)).fetchone()
+        customer = models.Customer(name, password, email, store)
+        store = customer.store
+
+        columns = [array(column.typecode) for column in store.events.columns]
+        label = store.label
+        for tim, plan_name, type, *sizes in db.execute(
+                "SELECT time, plan, type, sites, payments, refunds, spend FROM events WHERE customer = ? ORDER BY seq", (cid,)):
+            values = (tim, -1 if plan_name is None else label(plan_name), -1 if type is None else label(type), *sizes)
+            for column, value in zip(columns, values):
+                column.append(value)
+        store.events.assign(customer.id, columns)
+        for ledger in MONEY:
+            values = array("q", (v for v, in db.execute(f"SELECT cents FROM {ledger} WHERE customer = ? ORDER BY seq", (cid,))))
+            getattr(store, ledger).assign(customer.id, [values])
+
+        if plan is not None:
+            customer.current_plan = models.Plan(plan)
+        if renews is not None:
+            customer.plan_renewal_date = epochs.datetime_from_time(renews)
+        for url, has_database in db.execute(
+                "SELECT url, has_database FROM websites WHERE customer = ? ORDER BY seq", (cid,)):
+            website = models.Website(customer, "", bool(has_database))
+            website.url = url
+            customer.websites.add(website)
+        return customer
+
+    def events_between(self, start, end):
+        """Returns (customer name, epoch seconds, plan, type) of every event with start <= time < end"""
+        return self.connection.execute(
+            "SELECT c.name, e.time, e.plan, e.type FROM events e JOIN customers c ON c.id = e.customer "
+            "WHERE e.time >= ? AND e.time < ? ORDER BY e.time, c.name", (start, end)).fetchall()
+
+    def _rows(self, customer):
+        """Returns the rows of a customer, assigning it a row id if it is new"""
+        cid = self.ids.get(customer.name)
+        existed = cid is not None
+        if not existed:
+            cid = self.ids[customer.name] = self.next_id
+            self.next_id += 1
+
+        store, labels = customer.store, customer.store.labels
+        events = store.events.entries(customer.id)
+        renewal = customer.plan_renewal_date
+        rows = {
+            "customers": [(cid, customer.name, customer.password, customer.email,
+                           customer.current_plan.name if customer.current_plan else None,
+                           helpers.datetime_to_time(renewal) if renewal else None)],
+            "events": [(cid, seq, tim, labels[plan] if plan >= 0 else None, labels[type] if type >= 0 else None, *sizes)
+                       for seq, (tim, plan, type, *sizes) in enumerate(zip(*events))],
+            "websites": [(cid, seq, w.url, int(bool(w.database))) for seq, w in enumerate(customer.websites)],
+        }
+        for ledger in MONEY:
+            rows[ledger] = [(cid, seq, value) for seq, value in enumerate(getattr(store, ledger).values(customer.id))]
+        return existed, cid, rows
+
+    def _write(self, batch):
+        """Writes the rows of many customers in one transaction"""
+        if not batch:
+            return 0
+        tables = ["events", "websites"] + list(MONEY)
+        with self.connection as db:
+            stale = [(cid,) for existed, cid, _ in batch if existed]
+            if stale:
+                for table in tables:
+                    db.executemany(f"DELETE FROM {table} WHERE customer = ?", stale)
+            db.executemany("INSERT OR REPLACE INTO customers VALUES (?, ?, ?, ?, ?, ?)",
+                           chain.from_iterable(rows["customers"] for _, _, rows in batch))
+            db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           chain.from_iterable(rows["events"] for _, _, rows in batch))
+            db.executemany("INSERT INTO websites VALUES (?, ?, ?, ?)",
+                           chain.from_iterable(rows["websites"] for _, _, rows in batch))
+            for ledger in MONEY:
+                db.executemany(f"INSERT INTO {ledger} VALUES (?, ?, ?)",
+                               chain.from_iterable(rows[ledger] for _, _, rows in batch))
+        return len(batch)
+
+
+if __name__ == '__main__':
+    events = chain.from_iterable(replay.read_events(path) for path in sys.argv[2:])
+    with Database(sys.argv[1]) as db:
+        print(db.save(replay.replay(events)))
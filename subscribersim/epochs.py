@@ -0,0 +1,215 @@
+"""Epochs
+
+This module is an alternative backend for the date arithmetic in helpers.
+It works on integer epoch seconds in local time and memoizes the start of
+every local day and the length of every year it is asked about, so adding
+months to a timestamp costs a localtime call and a table lookup instead of a
+relativedelta and two conversions.
+
+Results equal the helpers functions: the day of month is clamped to the end
+of the target month like relativedelta, and wall clock times that fall on a
+daylight saving transition day are resolved by time.mktime exactly as before.
+The tables belong to the process time zone, call reset() after time.tzset().
+
+Example:
+
+        renewal = months_hence(helpers.datetime_to_time(now), 12)
+        seconds = seconds_in_year(helpers.datetime_to_time(now))
+        renewals = months_hence_array(timestamps, 12)
+
+Attributes:
+    EPOCH_ORDINAL (int) : Proleptic ordinal of 1970-01-01, day numbers count from it
+
+"""
+
+import time
+from datetime import date, datetime
+from functools import lru_cache
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def is_leap(year):
+    """Returns True if the year is a leap year"""
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def days_in_month(year, month):
+    """Returns the number of days in a month"""
+    if month == 2 and is_leap(year):
+        return 29
+    return _DAYS_IN_MONTH[month - 1]
+
+
+@lru_cache(maxsize=None)
+def day_start(year, month, day):
+    """Returns the epoch seconds of local midnight on a date"""
+    return round(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)))
+
+
+@lru_cache(maxsize=None)
+def is_uniform(year, month, day):
+    """Returns True if a local date has no daylight saving transition"""
+    following = date(year, month, day).toordinal() + 1
+    nxt = date.fromordinal(following)
+    return day_start(nxt.year, nxt.month, nxt.day) - day_start(year, month, day) == 86400
+
+
+def shift(year, month, day, seconds, months):
+    """Returns the epoch seconds of a local wall clock time moved by a number of months
+
+    Args:
+        year, month, day (int) : Local date
+        seconds (int)          : Seconds since local midnight on the wall clock
+        months (int)           : Number of months to add, may be negative
+
+    Returns:
+        Epoch seconds, clamping the day to the end of the target month.
+    """
+    years, month = divmod(month - 1 + months, 12)
+    year += years
+    month += 1
+    day = min(day, days_in_month(year, month))
+    if is_uniform(year, month, day):
+        return day_start(year, month, day) + seconds
+    hours, rest = divmod(seconds, 3600)
+    return round(time.mktime((year, month, day, hours, rest // 60, rest % 60, 0, 0, -1)))
+
+
+@lru_cache(maxsize=4096)
+def _year_length(year, month, day):
+    """Returns the seconds in the year starting on a uniform date, None otherwise"""
+    if not is_uniform(year, month, day):
+        return None
+    target = min(day, days_in_month(year + 1, month))
+    if not is_uniform(year + 1, month, target):
+        return None
+    return day_start(year + 1, month, target) - day_start(year, month, day)
+
+
+def _fields(tim):
+    """Returns the local (year, month, day, seconds since midnight) of epoch seconds"""
+    t = time.localtime(tim)
+    return t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+
+
+def year_month(tim):
+    """Returns the local (year, month) of epoch seconds"""
+    t = time.localtime(tim)
+    return t.tm_year, t.tm_mon
+
+
+def months_hence(tim, months):
+    """Returns the epoch seconds months after epoch seconds tim"""
+    return shift(*_fields(tim), months)
+
+
+def seconds_in_year(tim):
+    """Returns the number of seconds in the year starting at epoch seconds tim"""
+    year, month, day, seconds = _fields(tim)
+    length = _year_length(year, month, day)
+    if length is None:
+        return shift(year, month, day, seconds, 12) - tim
+    return length
+
+
+def datetime_months_hence(prev, months):
+    """Returns a rounded datetime object months from a datetime, like helpers.datetime_months_hence"""
+    seconds = prev.hour * 3600 + prev.minute * 60 + prev.second
+    tim = shift(prev.year, prev.month, prev.day, seconds, months)
+    return datetime_from_time(tim)
+
+
+def get_seconds_in_current_year(datetimeobj):
+    """Returns the number of seconds in the year starting at a datetime, like helpers.get_seconds_in_current_year"""
+    d = datetimeobj
+    length = _year_length(d.year, d.month, d.day)
+    if length is None:
+        seconds = d.hour * 3600 + d.minute * 60 + d.second
+        start = round(time.mktime(d.timetuple()))
+        return shift(d.year, d.month, d.day, seconds, 12) - start
+    return length
+
+
+def reset():
+    """Clears the memoized day and year tables"""
+    day_start.cache_clear()
+    is_uniform.cache_clear()
+    _year_length.cache_clear()
+
+
+def datetime_from_time(tim):
+    """Returns a datetime object for epoch seconds"""
+    return datetime.fromtimestamp(tim)
+
+
+def _day_table(first, last):
+    """Returns NumPy arrays describing the local days numbered first to last
+
+    Day numbers count from 1970-01-01. The arrays hold the epoch seconds of
+    each local midnight, the year, month and day of each date and whether the
+    date is free of daylight saving transitions.
+    """
+    import numpy as np
+    count = last - first + 1
+    starts = np.empty(count, dtype=np.int64)
+    ymd = np.empty((3, count), dtype=np.int64)
+    uniform = np.empty(count, dtype=bool)
+    for i in range(count):
+        d = date.fromordinal(first + i + EPOCH_ORDINAL)
+        starts[i] = day_start(d.year, d.month, d.day)
+        ymd[:, i] = d.year, d.month, d.day
+        uniform[i] = is_uniform(d.year, d.month, d.day)
+    return starts, ymd, uniform
+
+
+def _day_number(tim):
+    """Returns the day number of the local date of epoch seconds"""
+    t = time.localtime(tim)
+    return date(t.tm_year, t.tm_mon, t.tm_mday).toordinal() - EPOCH_ORDINAL
+
+
+def months_hence_array(tims, months):
+    """Returns epoch seconds months after each entry of an array of epoch seconds
+
+    Timestamps are mapped to their local day with a table of local midnights,
+    the target day is computed with NumPy calendar arithmetic and looked up in
+    a second table. Timestamps on a transition day go through months_hence.
+    """
+    import numpy as np
+    tims = np.asarray(tims, dtype=np.int64)
+    if tims.size == 0:
+        return tims.copy()
+
+    first, last = _day_number(int(tims.min())), _day_number(int(tims.max()))
+    starts, ymd, uniform = _day_table(first, last)
+    index = np.searchsorted(starts, tims, side="right") - 1
+    seconds = tims - starts[index]
+    years, mons, days = ymd[:, index]
+
+    shifted = mons - 1 + months
+    years = years + shifted // 12
+    mons = shifted % 12 + 1
+    lengths = np.array(_DAYS_IN_MONTH, dtype=np.int64)[mons - 1]
+    leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+    lengths += (mons == 2) & leap
+    days = np.minimum(days, lengths)
+
+    target = ((years - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (mons - 1)).astype("datetime64[D]")
+    numbers = (target + (days - 1)).astype(np.int64)
+    tfirst = int(numbers.min())
+    tstarts, _, tuniform = _day_table(tfirst, int(numbers.max()))
+
+    result = tstarts[numbers - tfirst] + seconds
+    slow = np.flatnonzero(~(uniform[index] & tuniform[numbers - tfirst]))
+    for i in slow:
+        result[i] = months_hence(int(tims[i]), months)
+    return result
+
+
+def seconds_in_year_array(tims):
+    """Returns the seconds in the year starting at each entry of an array of epoch seconds"""
+    import numpy as np
+    tims = np.asarray(tims, dtype=np.int64)
+    return months_hence_array(tims, 12) - tims
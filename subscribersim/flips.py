@@ -0,0 +1,203 @@
+"""Flips
+
+This module flags customers who keep switching plans, as events are logged.
+A Detector attached to a CustomerStore is called after every logged event
+and keeps, for each customer, the upgrades, downgrades, refunds and upgrade
+payments of a sliding window. The window is a ring of time buckets: an
+event adds to the bucket of its time, and buckets that slide out of the
+window are subtracted from the running totals, so an event costs O(1) and a
+customer holds a fixed number of counters however long its history.
+
+A customer is flagged once when the window holds at least flips plan changes
+in both directions, or net refunds of at least refunds dollars, and can be
+flagged again once the window drops back under both limits. Customers
+without events for a whole window are forgotten, oldest first, so memory
+grows with the customers active in the last window.
+
+Events must arrive in time order across customers, up to lateness seconds
+behind the most recent one, since a customer is forgotten once the latest
+event of any customer leaves it a window and lateness behind. An older
+event raises an exception rather than being counted in an empty window.
+
+Detectors key customers by their name, which must be unique within the
+store, as customer ids are released and reused. A 'start' event resets the
+window of a name, so a customer created again under a closed customer's
+name starts empty.
+
+Example:
+
+        detector = Detector(window=365 * 86400, buckets=12, flips=3).attach(store)
+        ... replay into store ...
+        for alert in detector.alerts:
+            print(alert.customer, alert.reason, alert.upgrades, alert.downgrades)
+
+Attributes:
+    UPGRADES (int)      : Index of the upgrade count in a window
+    DOWNGRADES (int)    : Index of the downgrade count in a window
+    REFUNDED (int)      : Index of the cents refunded in a window
+    PAID (int)          : Index of the cents paid on upgrades in a window
+    Alert (type)        : A flagged customer name and its window totals, amounts in dollars
+
+"""
+
+from array import array
+from collections import namedtuple, OrderedDict, deque
+from . import epochs
+from . import money
+
+UPGRADES, DOWNGRADES, REFUNDED, PAID = 0, 1, 2, 3
+_FIELDS = 4
+
+Alert = namedtuple("Alert", ["customer", "time", "reason", "upgrades", "downgrades", "refunded", "paid"])
+
+
+class Window():
+    """A window holds the ring of buckets of one customer.
+
+    Attributes:
+        head (int)      : Number of the most recent bucket
+        totals (array)  : Sums of the buckets in the window, indexed by UPGRADES to PAID
+        ring (array)    : Bucket counters, bucket n at slot n % buckets
+        flagged (bool)  : True while the customer is over a limit and was alerted
+    """
+
+    __slots__ = ("head", "totals", "ring", "flagged")
+
+    def __init__(self, head, buckets):
+        self.head = head
+        self.totals = array("q", bytes(8 * _FIELDS))
+        self.ring = array("q", bytes(8 * _FIELDS * buckets))
+        self.flagged = False
+
+
+class Detector():
+    """A detector counts plan changes of each customer over a sliding window.
+
+    Args:
+        window (int)        : Window length in seconds
+        buckets (int)       : Buckets in the window, the window slides one bucket at a time
+        flips (int)         : Plan changes in the window that flag a customer, with one in each direction
+        refunds (float)     : Net refunds in dollars in the window that flag a customer, None to ignore
+        on_alert (callable) : Called with each Alert, alerts are only kept in alerts if None
+        keep (int)          : Most recent alerts kept in alerts
+        lateness (int)      : Seconds an event may be older than the most recent event counted
+
+    Attributes:
+        windows (dict)      : Maps a customer name to its Window, least recently active first
+        alerts (deque)      : Most recent Alerts
+        clock (int)         : Most recent bucket counted
+    """
+
+    def __init__(self, window=365 * 86400, buckets=12, flips=3, refunds=None, on_alert=None, keep=1000, lateness=0):
+        self.width = -(-window // buckets)
+        self.buckets = buckets
+        self.late = -(-lateness // self.width)
+        self.clock = None
+        self.flips = flips
+        self.refunds = None if refunds is None else money.to_cents(refunds)
+        self.on_alert = on_alert
+        self.windows = OrderedDict()
+        self.alerts = deque(maxlen=keep)
+
+    def __len__(self):
+        return len(self.windows)
+
+    def attach(self, store):
+        """Counts every event logged in a CustomerStore and returns this detector"""
+        store.observers.append(self.observe)
+        return self
+
+    def detach(self, store):
+        """Stops counting the events of a CustomerStore"""
+        store.observers.remove(self.observe)
+
+    def observe(self, store, cid, entry):
+        """Counts an events ledger entry just appended for customer id cid, ignores releases"""
+        if entry is None:
+            return
+        tim, _, type, _, _, _, _ = entry
+        kind, name = store.labels[type], store.names[cid]
+        if kind == "upgrade":
+            self.count(name, tim, upgrades=1, paid=store.last("payments", cid))
+        elif kind == "downgrade":
+            self.count(name, tim, downgrades=1, refunded=store.last("refunds", cid))
+        else:
+            self.count(name, tim, reset=kind == "start")
+
+    def count(self, name, tim, upgrades=0, downgrades=0, refunded=0, paid=0, reset=False):
+        """Adds one event at epoch seconds tim to the window of a customer name
+
+        Returns:
+            The Alert raised by the event, None otherwise. Raises an exception
+            if the event is older than lateness allows.
+        """
+        bucket = tim // self.width
+        if self.clock is None or bucket > self.clock:
+            self.clock = bucket
+        elif bucket < self.clock - self.late:
+            raise Exception(f"Event of {name} out of time order, more than lateness behind the latest event")
+        window = self.windows.get(name)
+        if window is None or reset:
+            window = self.windows[name] = Window(bucket, self.buckets)
+        self.windows.move_to_end(name)
+        self._slide(window, bucket)
+        self._evict()
+
+        if bucket > window.head - self.buckets:
+            slot = (bucket % self.buckets) * _FIELDS
+            for field, value in ((UPGRADES, upgrades), (DOWNGRADES, downgrades), (REFUNDED, refunded), (PAID, paid)):
+                if value:
+                    window.ring[slot + field] += value
+                    window.totals[field] += value
+        return self._check(name, tim, window)
+
+    def window(self, name):
+        """Returns the totals of the window of a customer name as an Alert without reason, None if unknown"""
+        window = self.windows.get(name)
+        if window is None:
+            return None
+        return self._alert(name, window.head * self.width, None, window.totals)
+
+    def _slide(self, window, bucket):
+        """Moves the head of a window to bucket, dropping the buckets that leave the window"""
+        if bucket <= window.head:
+            return
+        ring, totals = window.ring, window.totals
+        for number in range(window.head + 1, min(bucket, window.head + self.buckets) + 1):
+            slot = (number % self.buckets) * _FIELDS
+            for field in range(_FIELDS):
+                totals[field] -= ring[slot + field]
+                ring[slot + field] = 0
+        window.head = bucket
+
+    def _evict(self):
+        """Forgets the least recently active customers whose window no event within lateness can reach"""
+        windows, oldest = self.windows, self.clock - self.late - self.buckets
+        while windows:
+            name, window = next(iter(windows.items()))
+            if window.head > oldest:
+                break
+            del windows[name]
+
+    def _check(self, name, tim, window):
+        """Emits an Alert when a window crosses a limit, returns it or None"""
+        totals = window.totals
+        changes = totals[UPGRADES] + totals[DOWNGRADES]
+        flipping = changes >= self.flips and totals[UPGRADES] and totals[DOWNGRADES]
+        refunding = self.refunds is not None and totals[REFUNDED] - totals[PAID] >= self.refunds
+        if not (flipping or refunding):
+            window.flagged = False
+            return None
+        if window.flagged:
+            return None
+        window.flagged = True
+        alert = self._alert(name, tim, "flips" if flipping else "refunds", totals)
+        self.alerts.append(alert)
+        if self.on_alert is not None:
+            self.on_alert(alert)
+        return alert
+
+    def _alert(self, name, tim, reason, totals):
+        """Returns an Alert of window totals"""
+        return Alert(name, epochs.datetime_from_time(tim), reason, totals[UPGRADES], totals[DOWNGRADES],
+                     money.to_dollars(totals[REFUNDED]), money.to_dollars(totals[PAID]))
@@ -19,10 +19,10 @@ Todo:
 
 import time
 from datetime import datetime, date
-from dateutil.relativedelta import relativedelta
 
 def get_seconds_a_year_from_now():
     """Returns the number of seconds a year from now"""
+    from dateutil.relativedelta import relativedelta  # Imported on use to keep startup fast
     NOW = datetime.now()
     THEN = NOW + relativedelta(months=+12)
     return datetime_to_time(THEN) - datetime_to_time(NOW)
@@ -30,6 +30,7 @@ def get_seconds_a_year_from_now():
 
 def get_seconds_in_current_year(datetimeobj):
     """Returns the number of seconds in a given year"""
+    from dateutil.relativedelta import relativedelta
     NOW = datetimeobj
     THEN = NOW + relativedelta(months=+12)
     return datetime_to_time(THEN) - datetime_to_time(NOW)
@@ -63,6 +64,7 @@ def datetime_get_last_event(customer):
 
 def datetime_months_hence(prev, months):
     """Returns a rounded datetime object months from the current timestamp"""
+    from dateutil.relativedelta import relativedelta
     dt = prev + relativedelta(months=+months)
     tim = datetime_to_time(dt)
     return time_to_datetime(tim)
@@ -0,0 +1,117 @@
+"""History
+
+This module answers point-in-time questions about customers. The events
+ledger of a customer is already a sorted timestamp index: entry i holds the
+time of event i, the balance after it is entry i of the balances ledger, and
+the sizes of the payments, refunds and spend ledgers right after it are
+recorded with it. A bisection over the time column finds the event in force
+at any time in O(log n), and those sizes locate the money logged between two
+times without walking the parallel ledgers.
+
+Events of a customer must be logged in time order, as replays and the
+Customer methods do.
+
+Example:
+
+        state_at(jake, datetime(2019, 6, 30))
+        payments_between(jake, datetime(2019, 1, 1), datetime(2020, 1, 1))
+        as_of(customers, datetime(2019, 6, 30, 23, 59, 59))
+
+Attributes:
+    State (type) : State of a customer after its last event at or before a time
+
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from . import epochs
+from . import helpers
+from . import models
+from . import money
+
+State = namedtuple("State", ["time", "plan", "type", "sites", "payments", "balance", "remaining", "renews_on"])
+
+# Fields of the events ledger holding the payments and refunds ledger sizes
+_SIZES = {"payments": 4, "refunds": 5, "spend": 6}
+
+
+def _bounds(customer):
+    """Returns the events ledger of a customer and the column range of its non sentinel events"""
+    events = customer.store.events
+    offset = events.offsets[customer.id]
+    return events, offset + 1, offset + events.sizes[customer.id]
+
+
+def state_at(customer, when):
+    """Returns the State of a customer at a datetime, None before its first event
+
+    balance is the balance right after the event in force and remaining is
+    that balance less the spend of the plan prorated up to when.
+    """
+    tim = helpers.datetime_to_time(when)
+    events, lo, hi = _bounds(customer)
+    index = bisect_right(events.columns[0], tim, lo, hi) - 1
+    if index < lo:
+        return None
+
+    store = customer.store
+    event, plan, type, sites, payments = (column[index] for column in events.columns[:5])
+    plan = store.labels[plan]
+    balance = store.balances.get(customer.id, index - lo + 1)[0]
+    spent = money.spend(models.Plan.catalog.price_cents(plan), tim - event, epochs.seconds_in_year(tim))
+    return State(epochs.datetime_from_time(event), plan, store.labels[type], sites, payments - 1,
+                 money.to_dollars(balance), money.to_dollars(balance - spent),
+                 epochs.datetime_from_time(epochs.months_hence(event, 12)))
+
+
+def events_between(customer, start, end):
+    """Returns the events of a customer with start <= time < end as (datetime, plan, type) tuples"""
+    events, lo, hi = _bounds(customer)
+    first = bisect_left(events.columns[0], helpers.datetime_to_time(start), lo, hi)
+    last = bisect_left(events.columns[0], helpers.datetime_to_time(end), first, hi)
+    offset = lo - 1
+    return customer.events[first - offset:last - offset]
+
+
+def _logged_between(customer, name, start, end):
+    """Returns (datetime, dollars) of every entry of a money ledger logged with start <= time < end"""
+    events, lo, hi = _bounds(customer)
+    times, sizes = events.columns[0], events.columns[_SIZES[name]]
+    first = bisect_left(times, helpers.datetime_to_time(start), lo, hi)
+    last = bisect_left(times, helpers.datetime_to_time(end), first, hi)
+    ledger = getattr(customer.store, name)
+    values, offset = ledger.columns[0], ledger.offsets[customer.id]
+
+    logged = []
+    for i in range(first, last):
+        if sizes[i] > sizes[i - 1]:
+            logged.append((epochs.datetime_from_time(times[i]), money.to_dollars(values[offset + sizes[i] - 1])))
+    return logged
+
+
+def payments_between(customer, start, end):
+    """Returns (datetime, dollars) of every payment of a customer with start <= time < end"""
+    return _logged_between(customer, "payments", start, end)
+
+
+def refunds_between(customer, start, end):
+    """Returns (datetime, dollars) of every refund of a customer with start <= time < end"""
+    return _logged_between(customer, "refunds", start, end)
+
+
+def as_of(customers, when):
+    """Returns (customer name, State) of every customer with an event at or before a datetime"""
+    snapshot = []
+    for customer in customers:
+        state = state_at(customer, when)
+        if state is not None:
+            snapshot.append((customer.name, state))
+    return snapshot
+
+
+def month_ends(customers, start, months):
+    """Yields (month end datetime, as_of snapshot) for months month ends from the month of start"""
+    first = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for month in range(1, months + 1):
+        end = helpers.time_to_datetime(epochs.months_hence(helpers.datetime_to_time(first), month) - 1)
+        yield end, as_of(customers, end)
@@ -0,0 +1,222 @@
+"""Ledger file
+
+This module contains a fixed-width binary format for exchanging event
+histories. Every event of a customer is one 48 byte record holding its
+timestamp, plan, type and site count with the balance after the event and
+the payment, refund and spend it logged, in integer cents. A customer's records are
+contiguous, so readers map the file with numpy.memmap and scan or slice
+hundreds of millions of events without parsing or copying them.
+
+Layout:
+
+        header    64 bytes: magic, version, record size, record count,
+                  offset and length of the index
+        records   record count fixed-width records
+        index     JSON: label table and [name, first record, count] per customer,
+                  at the offset in the header, after the records
+
+Writers only append and an existing file stays readable until the writer
+is closed: new records are written after the old index, which the header
+keeps pointing at. Closing moves them next to the old records, writes the
+new index after them and rewrites the header last, and every header written
+on the way points at a complete index. A session that only adds customers
+without events writes its index after the old one, which stays unused until
+records are appended again, and a session that adds nothing writes nothing.
+
+Example:
+
+        with Writer("2019.ledger") as writer:
+            for customer in replay.replay(replay.read_events("2019.jsonl")):
+                writer.append(customer)
+
+        ledger = LedgerFile("2019.ledger")
+        money.to_dollars(ledger.records["payment"].sum())
+        ledger.events("Jake Peralta")
+
+Attributes:
+    MAGIC (bytes)        : First bytes of every ledger file
+    VERSION (int)        : Format version
+    HEADER (obj:Struct)  : Header fields, padded to HEADER_SIZE bytes
+    HEADER_SIZE (int)    : Offset of the first record
+    RECORD (obj:dtype)   : Record layout, little endian
+    PAYMENT, REFUND, SPEND (int) : Flags set when an event logged that value
+
+"""
+
+import json
+import os
+import struct
+import numpy as np
+from . import helpers
+
+MAGIC = b"SSLEDGER"
+VERSION = 1
+HEADER = struct.Struct("<8sIIqqq")
+HEADER_SIZE = 64
+RECORD = np.dtype([("time", "<i8"), ("sites", "<i4"), ("plan", "<i2"), ("type", "<i1"), ("flags", "<u1"),
+                   ("balance", "<i8"), ("payment", "<i8"), ("refund", "<i8"), ("spend", "<i8")])
+PAYMENT, REFUND, SPEND = 1, 2, 4
+
+
+def encode(customer, labels):
+    """Returns the records of a customer's events, adding new names to the label table labels"""
+    store, cid = customer.store, customer.id
+    time, plan, type, sites, *sizes = (np.frombuffer(column, dtype=column.typecode)
+                                       for column in store.events.entries(cid))
+    records = np.zeros(len(time) - 1, dtype=RECORD)
+    records["time"] = time[1:]
+    records["sites"] = sites[1:]
+    codes = np.zeros(len(store.labels), dtype=np.int16)
+    for field, values in (("plan", plan[1:]), ("type", type[1:])):
+        for code in np.unique(values):
+            text = store.labels[code]
+            if text not in labels:
+                labels.append(text)
+            codes[code] = labels.index(text)
+        records[field] = codes[values]
+    records["balance"] = np.frombuffer(store.balances.values(cid), dtype=np.int64)[1:]
+
+    for flag, field, ledger, size in zip((PAYMENT, REFUND, SPEND), ("payment", "refund", "spend"),
+                                         ("payments", "refunds", "spend"), sizes):
+        logged = np.diff(size) > 0
+        values = np.frombuffer(getattr(store, ledger).values(cid), dtype=np.int64)
+        records["flags"][logged] |= flag
+        records[field][logged] = values[size[1:][logged] - 1]
+    return records
+
+
+class Writer():
+    """A writer appends customers to a ledger file.
+
+    Args:
+        path (str)  : Ledger file, created if missing
+
+    Attributes:
+        labels (list:str)  : Plan names and event types indexed by record code
+        index (list)       : [name, first record, count] of every customer
+        count (int)        : Number of records
+        old (tuple)        : Record count, index offset, index length and customer count of the file as opened,
+                             None if new
+        start (int)        : File offset of the first record appended by this writer
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            reader = LedgerFile(path)
+            self.labels, self.index, self.count = reader.labels, reader.index_list, len(reader)
+            del reader
+            self.fp = open(path, "r+b")
+            _, _, _, _, offset, length = HEADER.unpack(self.fp.read(HEADER.size))
+            self.old = (self.count, offset, length, len(self.index))
+            self.start = self.fp.seek(0, os.SEEK_END)
+        else:
+            self.labels, self.index, self.count = [], [], 0
+            self.fp = open(path, "w+b")
+            self.fp.write(bytes(HEADER_SIZE))
+            self.old = None
+            self.start = HEADER_SIZE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, customer):
+        """Appends the events of a customer"""
+        records = encode(customer, self.labels)
+        self.fp.write(records.tobytes())
+        self.index.append([customer.name, self.count, len(records)])
+        self.count += len(records)
+
+    def close(self):
+        """Moves the new records after the old ones, writes the index and the header and closes the file"""
+        if self.old is not None and len(self.index) == self.old[3]:
+            self.fp.close()
+            return
+        index = json.dumps({"labels": self.labels, "customers": self.index}).encode()
+        offset = HEADER_SIZE + self.count * RECORD.itemsize
+        if self.old is not None and self.count == self.old[0]:
+            # Only customers without events were added, the old index stays valid until the header moves
+            offset = self.start
+        elif self.old is not None:
+            count, old_offset, length, _ = self.old
+            end = HEADER_SIZE + count * RECORD.itemsize
+            appended = (self.count - count) * RECORD.itemsize
+            # Point the header at a copy of the old index past everything written below
+            spare = max(self.start + appended, offset + len(index))
+            self.fp.seek(old_offset)
+            old_index = self.fp.read(length)
+            self.fp.seek(spare)
+            self.fp.write(old_index)
+            self._write_header(count, spare, length)
+            self._move(self.start, end, appended)
+        self.fp.seek(offset)
+        self.fp.write(index)
+        self.fp.truncate()
+        self._write_header(self.count, offset, len(index))
+        self.fp.close()
+
+    def _move(self, source, target, size, chunk=1 << 24):
+        """Copies size bytes from source down to target, which is lower"""
+        for done in range(0, size, chunk):
+            self.fp.seek(source + done)
+            data = self.fp.read(min(chunk, size - done))
+            self.fp.seek(target + done)
+            self.fp.write(data)
+
+    def _write_header(self, count, offset, length):
+        """Rewrites the header once everything written before it is on disk"""
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.seek(0)
+        self.fp.write(HEADER.pack(MAGIC, VERSION, RECORD.itemsize, count, offset, length))
+        self.fp.flush()
+
+
+class LedgerFile():
+    """A ledger file opened for zero-copy reads.
+
+    Args:
+        path (str)  : Ledger file written by Writer
+
+    Attributes:
+        records (obj:memmap)  : Every record of the file, read only
+        labels (list:str)     : Plan names and event types indexed by record code
+        customers (dict)      : Maps a customer name to (first record, count)
+        index_list (list)     : [name, first record, count] of every customer in file order
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            magic, version, size, count, offset, length = HEADER.unpack(fp.read(HEADER.size))
+            if magic != MAGIC or version != VERSION or size != RECORD.itemsize:
+                raise Exception("Not a ledger file")
+            fp.seek(offset)
+            index = json.loads(fp.read(length))
+        self.labels = index["labels"]
+        self.index_list = index["customers"]
+        self.customers = {name: (first, n) for name, first, n in self.index_list}
+        if count:
+            self.records = np.memmap(path, dtype=RECORD, mode="r", offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD)
+
+    def __len__(self):
+        return len(self.records)
+
+    def of(self, name):
+        """Returns the records of a customer as a view into the file"""
+        first, count = self.customers[name]
+        return self.records[first:first + count]
+
+    def events(self, name):
+        """Returns the events of a customer as (datetime, plan, type) tuples, like Customer.events[1:]"""
+        labels = self.labels
+        return [(helpers.time_to_datetime(int(r["time"])), labels[r["plan"]], labels[r["type"]]) for r in self.of(name)]
+
+    def totals_by_plan(self, field):
+        """Returns a dict of the sum in cents of a money field over every record, by plan name"""
+        plans, values = self.records["plan"], self.records[field]
+        return {self.labels[code]: int(values[plans == code].sum()) for code in np.unique(plans)}
@@ -0,0 +1,217 @@
+"""Metrics
+
+This module contains an optional instrumentation layer for replays. When
+enabled, the Customer methods and the date functions they call are wrapped
+to count plan changes by type, trimmed websites and errors, and to record
+call latencies in fixed-bucket histograms. When disabled the original
+functions are restored, so instrumentation costs nothing unless it is on.
+
+Example:
+
+        metrics.enable()
+        ... replay ...
+        metrics.registry.write_prometheus("subscribersim.prom")
+        print(metrics.registry.format_summary())
+        metrics.disable()
+
+Attributes:
+    BUCKETS (tuple)          : Upper bounds in seconds of the latency histogram buckets
+    registry (obj:Registry)  : Registry updated by the instrumented functions
+
+"""
+
+import os
+import time
+from bisect import bisect_left
+from . import epochs
+from . import helpers
+from . import models
+
+BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+
+class Histogram():
+    """A latency histogram with fixed buckets.
+
+    Attributes:
+        counts (list:int) : Observations per bucket, the last one above every bound
+        total (float)     : Sum of the observations in seconds
+        count (int)       : Number of observations
+    """
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        """Records one observation"""
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Returns the upper bound of the bucket holding a quantile"""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Registry():
+    """A registry holds the counters and histograms of a run.
+
+    Attributes:
+        counters (dict)   : Maps (name, label value) to a count
+        histograms (dict) : Maps a function name to its Histogram
+        started (float)   : time.time() when the registry was last reset
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clears every counter and histogram"""
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, label="", amount=1):
+        """Increments a counter"""
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, function, seconds):
+        """Records the latency of a call"""
+        histogram = self.histograms.get(function)
+        if histogram is None:
+            histogram = self.histograms[function] = Histogram()
+        histogram.observe(seconds)
+
+    def prometheus(self):
+        """Returns the registry in the Prometheus text exposition format"""
+        lines = []
+        families = {
+            "plan_changes": ("type", "Plan changes by event type"),
+            "websites_trimmed": ("", "Websites removed by downgrades"),
+            "errors": ("function", "Calls that raised an exception"),
+        }
+        for name, (label, description) in families.items():
+            metric = f"subscribersim_{name}_total"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for (counter, value), count in sorted(self.counters.items()):
+                if counter == name:
+                    labels = f'{{{label}="{value}"}}' if label else ""
+                    lines.append(f"{metric}{labels} {count}")
+
+        metric = "subscribersim_call_seconds"
+        lines.append(f"# HELP {metric} Latency of instrumented calls")
+        lines.append(f"# TYPE {metric} histogram")
+        for function, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{function="{function}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{function="{function}"}} {histogram.total!r}')
+            lines.append(f'{metric}_count{{function="{function}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Writes a Prometheus text snapshot, replacing the file atomically"""
+        with open(path + ".tmp", "w") as fp:
+            fp.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+    def summary(self):
+        """Returns a dict summarizing the run"""
+        return {
+            "seconds": round(time.time() - self.started, 3),
+            "counters": {f"{name}{'/' + label if label else ''}": count
+                         for (name, label), count in sorted(self.counters.items())},
+            "calls": {function: {"count": h.count, "total_seconds": round(h.total, 6),
+                                 "p50_le": h.quantile(0.5), "p99_le": h.quantile(0.99)}
+                      for function, h in sorted(self.histograms.items())},
+        }
+
+    def format_summary(self):
+        """Returns the summary as text, one line per counter or function"""
+        summary = self.summary()
+        lines = [f"run: {summary['seconds']}s"]
+        lines.extend(f"{name}: {count}" for name, count in summary["counters"].items())
+        lines.extend(f"{function}: {c['count']} calls, {c['total_seconds']}s, p50 <= {c['p50_le']}s, p99 <= {c['p99_le']}s"
+                     for function, c in summary["calls"].items())
+        return "\n".join(lines)
+
+
+registry = Registry()
+_originals = {}
+
+
+def _timed(name, function):
+    """Returns a wrapper recording the latency and errors of function"""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            registry.inc("errors", name)
+            raise
+        finally:
+            registry.observe(name, time.perf_counter() - start)
+    wrapper.__wrapped__ = function
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+def _move_to_plan(function):
+    """Returns a wrapper of Customer.move_to_plan counting plan changes and trimmed sites"""
+    timed = _timed("move_to_plan", function)
+
+    def move_to_plan(self, name, *args, **kwargs):
+        before = self.website_count
+        result = timed(self, name, *args, **kwargs)
+        registry.inc("plan_changes", self.events[-1][2])
+        if self.website_count < before:
+            registry.inc("websites_trimmed", amount=before - self.website_count)
+        return result
+    move_to_plan.__wrapped__ = function
+    move_to_plan.__doc__ = function.__doc__
+    return move_to_plan
+
+
+def _patch(owner, name, wrapper):
+    """Replaces an attribute with a wrapper of it, remembering the original"""
+    original = getattr(owner, name)
+    _originals[(owner, name)] = original
+    setattr(owner, name, wrapper(original))
+
+
+def enabled():
+    """Returns True if instrumentation is on"""
+    return bool(_originals)
+
+
+def enable(customer=None):
+    """Wraps the Customer methods and date functions, models.Customer if customer is omitted"""
+    if enabled():
+        return
+    customer = customer or models.Customer
+    for name in ("select_plan", "add_website", "remove_website"):
+        _patch(customer, name, lambda f, name=name: _timed(name, f))
+    _patch(customer, "move_to_plan", _move_to_plan)
+    for module in (helpers, epochs):
+        for name in ("datetime_months_hence", "get_seconds_in_current_year"):
+            _patch(module, name, lambda f, key=f"{module.__name__}.{name}": _timed(key, f))
+
+
+def disable():
+    """Restores the original functions"""
+    for (owner, name), original in _originals.items():
+        setattr(owner, name, original)
+    _originals.clear()
@@ -20,8 +20,15 @@ Todo:
 
 """
 
-from tabulate import tabulate
-import helpers
+import json
+from array import array
+from . import helpers
+from . import epochs
+from . import money
+from . import report
+from . import sites
+from . import store as stores
+from .store import LedgerView
 
 class Customer():
     """
@@ -31,37 +38,43 @@ class Customer():
     A customer should be able to subscribe to plan, move from a plan to another
     and manage websites (add/update/remove) according to their plan.
 
+    The ledgers (events, balances, payments, refunds, spend) live in a
+    CustomerStore and are exposed as list-like views. Money is stored in
+    integer cents and the views read and write dollars.
+
     Args:
         name (string)                       : Customer's full name
         password (string)                   : Customer's password
         email (string)                      : Customer's email
+        store (obj:CustomerStore)           : Ledger backend, store.default if omitted
+        url_index (obj:UrlIndex)            : Index of the customer's URLs, sites.index if omitted
 
     Attributes:
         current_plan (obj:Plan)             : Current active plan
         plan_renewal_date (obj:datetime)    : Date one year from the date of last purchase
 
         events (list:tup(datetime,str,str)) : List of events of form (datetime, str, str)
-        websites (list:Website)             : List of website objects
+        websites (obj:SiteRegistry)         : Website objects indexed by full URL
         website_count (int)                 : Number of active websites
         events (list:tup(datetime,str,str)) : List of events including their timestamp and type
         balances (list:float)               : Customer's account value after each event
         payments (list:float)               : Each payment is added to this list
         refunds (list:float)                : Each refund is added to this list
         spend (list:float)                  : The current spend at the time of each plan change
-        ROWS (list:list)                    : Input for the tabulate method
+        ROWS (list:list)                    : Header and report rows, derived from the ledgers on access
+        store (obj:CustomerStore)           : Store holding the ledgers
+        id (int)                            : Customer id within the store
 
     """
 
-    def __init__(self, name, password, email):
+    __slots__ = ("store", "id", "websites", "name", "password", "email", "current_plan",
+                 "plan_renewal_date", "__weakref__")
+
+    def __init__(self, name, password, email, store=None, url_index=None):
         # Buffers and counters
-        self.events = [0]
-        self.balances = [0]
-        self.payments = [0]
-        self.refunds = [0]
-        self.spend = [0]
-        self.websites = []
-        self.ROWS = []
-        self.website_count = 0
+        self.store = stores.default if store is None else store
+        self.id = self.store.add(name)
+        self.websites = sites.SiteRegistry(self, url_index)
         # Attributes
         self.name = name
         self.password = password
@@ -70,7 +83,53 @@ class Customer():
         self.plan_renewal_date = None
 
 
-    def select_plan(self, name, now=helpers.datetime_now()):
+    def __del__(self):
+        try:
+            self.websites.clear()
+            self.store.release(self.id)
+        except AttributeError:
+            pass
+
+
+    @property
+    def website_count(self):
+        """Number of active websites"""
+        return len(self.websites)
+
+
+    @property
+    def ROWS(self):
+        """Header and report rows, empty before a plan is selected"""
+        rows = list(report.rows(self))
+        return [report.HEADER] + rows if rows else []
+
+    @property
+    def events(self):
+        """Events of the customer as a list-like view over the store"""
+        return LedgerView(self.store, "events", self.id)
+
+    @property
+    def balances(self):
+        """Balance after each event as a list-like view over the store"""
+        return LedgerView(self.store, "balances", self.id)
+
+    @property
+    def payments(self):
+        """Payments of the customer as a list-like view over the store"""
+        return LedgerView(self.store, "payments", self.id)
+
+    @property
+    def refunds(self):
+        """Refunds of the customer as a list-like view over the store"""
+        return LedgerView(self.store, "refunds", self.id)
+
+    @property
+    def spend(self):
+        """Spend at each plan change as a list-like view over the store"""
+        return LedgerView(self.store, "spend", self.id)
+
+
+    def select_plan(self, name, now=None):
         """ Select a plan for a new customer.
 
         select_plan updates the payments, balances and events buffers then sets the
@@ -78,31 +137,31 @@ class Customer():
 
         Args:
             name (string)  : Name of the desired plan.
-            now (datetime) : A round datetime object returned by helpers.datetime_now()
+            now (datetime) : A round datetime, helpers.datetime_now() at the call if omitted
 
         Returns:
             True if successful. Raises an exception otherwise.
         """
+        if now is None:
+            now = helpers.datetime_now()
 
         if self.current_plan == None:
             # Log payment, update balances, update events
             type = "start"
-            payment = self._get_price(name)
-            self.payments.append(payment)
-            self.balances.append(payment)
-            self.events.append((now, name, type))
+            payment = Plan.catalog.price_cents(name)
+            self.store.append("payments", self.id, payment)
+            self.store.append("balances", self.id, payment)
 
             # Set the current plan
             self.current_plan = Plan(name)
-            self.plan_renewal_date = helpers.datetime_months_hence(now, 12)
-            self._init_table()
-            self._add_table_row()
+            self.plan_renewal_date = epochs.datetime_months_hence(now, 12)
+            self._log_event(now, name, type)
             return True
         else:
             raise Exception("select plan")
 
 
-    def move_to_plan(self, name, now=helpers.datetime_now()):
+    def move_to_plan(self, name, now=None):
         """ Move customer to a different plan if they are subscribed.
 
         move_to_plan takes a desired plan name, and a timestamp and evaluates
@@ -113,12 +172,14 @@ class Customer():
 
         Args:
             name (string)  : Name of the desired plan.
-            now (datetime) : A round datetime object returned by helpers.datetime_now()
+            now (datetime) : A round datetime, helpers.datetime_now() at the call if omitted
 
         Returns:
             True if successful. Raises an exception otherwise.
         """
-        seconds_in_year = helpers.get_seconds_in_current_year(now)
+        if now is None:
+            now = helpers.datetime_now()
+        seconds_in_year = epochs.get_seconds_in_current_year(now)
 
         # Verify that we already have a plan
         # Verify that we are not trying to move to the same plan
@@ -127,59 +188,44 @@ class Customer():
 
         if current != None and plan_name != name:
 
-            # Calculate the amount spent to date while in previous plan
+            # Seconds spent in the previous plan
             prev = self.events[-1][0]
-            old_price = self._get_price(plan_name)
             elapsed = helpers.datetime_to_time(now) - helpers.datetime_to_time(prev)
-            amount_spent = self._get_current_spend(old_price,seconds_in_year,elapsed)
-            self.spend.append(amount_spent)
-
-            # PRORATION LOGIC
-            current_bal = round ((self.balances[-1] - amount_spent), 2 )
-            new_plan_price = self._get_price(name)
-
-            # Transfer
-            if (new_plan_price == current_bal):
-                self.balances.append(new_plan_price)
-
-            # Upgrade
-            elif (new_plan_price > current_bal):
-                type = "upgrade"
-                payment_due = round( (new_plan_price - current_bal), 2 )
-                self.payments.append(payment_due)
-                self.balances.append(new_plan_price)
-
-            # Downgrade
-            else:
-                type = "downgrade"
-                # Reduce the number of websites if greater than desired plan max
-                site_count = self.website_count
-                max_sites_allowed = Plan.plans[name][0]
-                if site_count > max_sites_allowed:
-                    for _ in range(site_count - max_sites_allowed):
-                        self.websites.pop()
-                        self.website_count -= 1
-
-                # Refund customer and reset balance
-                self._refund(current_bal - new_plan_price)
-                self.balances.append(new_plan_price)
-
-            # Set the plan
-            self.current_plan = Plan(name)
-
-            # Set the new renewal date
-            self._set_renewal_date(now)
 
-            # Queue the event and update the table
-            self.events.append((now, name, type))
-            self._add_table_row()
+            # PRORATION LOGIC, in cents: transfer, upgrade or downgrade
+            catalog = Plan.catalog
+            amount_spent, current_bal, kind, payment_due, refund = money.prorate(
+                catalog.price_cents(plan_name), self.store.last("balances", self.id), elapsed,
+                seconds_in_year, catalog.price_cents(name))
 
+            self._apply_move(name, now, money.KINDS[kind], amount_spent, payment_due, refund)
             return True
 
         else:
             raise Exception("move to plan")
 
 
+    def renew(self):
+        """ Charges the current plan for another year on the renewal date.
+
+        renew logs a payment of the plan price, resets the balance to it, logs a
+        'renewal' event at the renewal date and moves the renewal date a year on.
+
+        Returns:
+            True if successful. Raises an exception otherwise.
+        """
+        if self.current_plan == None:
+            raise Exception("renew")
+
+        now = self.plan_renewal_date
+        price = Plan.catalog.price_cents(self.current_plan.name)
+        self.store.append("payments", self.id, price)
+        self.store.append("balances", self.id, price)
+        self._set_renewal_date(now)
+        self._log_event(now, self.current_plan.name, "renewal")
+        return True
+
+
     def add_website(self, url, has_database):
         """Adds a website given a domain name and a database option
 
@@ -188,7 +234,9 @@ class Customer():
             has_database (bool) : If True, 'https://' will prefix the URL else 'http://'
 
         Returns:
-            True if successful. Raises an exception otherwise.
+            True if successful. Raises an exception otherwise, including when
+            the customer already has the full URL: websites are keyed by URL,
+            so a duplicate is no longer appended beside the first one.
         """
         site_count = self.website_count
         max_sites = self.current_plan.max_sites
@@ -196,8 +244,7 @@ class Customer():
         if site_count == max_sites:
             raise Exception("Reached site limit")
 
-        self.websites.append(Website(self, url, has_database))
-        self.website_count += 1
+        self.websites.add(Website(self, url, has_database))
         return True
 
 
@@ -216,36 +263,26 @@ class Customer():
         if site_count == 0:
             raise Exception("No sites to remove")
 
-        for website in self.websites:
-            if website.url == name:
-                self.websites.remove(website)
-                self.website_count -= 1
-
+        self.websites.remove(name)
         return True
 
 
     def print_table(self):
-        """Prints the table created by _init_table and _add_table_row"""
-        print ("\n\n", tabulate(self.ROWS, headers="firstrow",),"\n\n")
+        """Prints the report rows of the customer, see report.print_table"""
+        report.print_table(self)
 
 
     def __str__(self):
         return f"\ncustomer: {self.name}\ncurrent plan: {self.current_plan}\nactive sites: {self.website_count}\nevents: {len(self.events[1:])}\nlast spend:{self.spend[-1]}"
 
 
-    def _init_table(self):
-        """Initializes the header row of a table when select_plan is called"""
-        self.ROWS.append(["customer", "event", "plan", "renews on", "websites", "payments", "last payment", "last spend", "last refund", "balance"])
-
-
-    def _add_table_row(self):
-        """Creates a table row when select_plan and move_to_plan are called"""
-        self.ROWS.append([self.name, self.events[-1][2], self.current_plan, self.plan_renewal_date, self.website_count,
-                          len(self.payments[1:]), self.payments[-1], self.spend[-1], self.refunds[-1], self.balances[-1]])
+    def _log_event(self, now, name, type):
+        """Appends an event with the current site count to the events ledger"""
+        self.store.log_event(self.id, helpers.datetime_to_time(now), name, type, self.website_count)
 
 
     def _set_renewal_date(self,now):
-        self.plan_renewal_date = helpers.datetime_months_hence(now, 12)
+        self.plan_renewal_date = epochs.datetime_months_hence(now, 12)
 
 
     def _add_event(self,name,price,tim):
@@ -254,48 +291,188 @@ class Customer():
 
 
     def _get_price(self, name):
-        """Returns the plan price from Plan.plan(dict)"""
-        return Plan.plans[name][1]
+        """Returns the plan price from the active catalog"""
+        return Plan.catalog.price(name)
 
 
     def _get_current_spend(self, price, intervals, elapsed):
-        """Returns the amount spent since the last plan purchase"""
-        return round( ((price / intervals) * elapsed), 2 )
+        """Returns the amount in dollars spent since the last plan purchase"""
+        return money.to_dollars(money.spend(money.to_cents(price), elapsed, intervals))
 
 
     def _refund(self, bal):
-        """Logs the refund amount when applicable"""
-        self.refunds.append(bal)
+        """Logs the refund amount in cents when applicable"""
+        self.store.append("refunds", self.id, bal)
+
+
+    def _apply_move(self, name, now, type, amount_spent, payment_due, refund):
+        """Records a prorated plan change computed by move_to_plan or proration.apply_batch
+
+        Args:
+            name (string)        : Name of the desired plan.
+            now (datetime)       : Timestamp of the plan change
+            type (string)        : 'transfer', 'upgrade' or 'downgrade'
+            amount_spent (int)   : Spend since the last plan change in cents
+            payment_due (int)    : Payment logged on upgrade in cents
+            refund (int)         : Refund logged on downgrade in cents
+        """
+        self.store.append("spend", self.id, amount_spent)
+        new_plan_price = Plan.catalog.price_cents(name)
+
+        if type == "upgrade":
+            self.store.append("payments", self.id, payment_due)
+
+        elif type == "downgrade":
+            # Reduce the number of websites if greater than desired plan max
+            max_sites_allowed = Plan(name).max_sites
+            if max_sites_allowed is not None and self.website_count > max_sites_allowed:
+                self.websites.trim(max_sites_allowed)
+
+            # Refund customer
+            self._refund(refund)
+
+        # Reset balance and set the plan
+        self.store.append("balances", self.id, new_plan_price)
+        self.current_plan = Plan(name)
+
+        # Set the new renewal date
+        self._set_renewal_date(now)
+
+        # Queue the event
+        self._log_event(now, name, type)
 
 
 
 class Plan():
     """Plans have a name, a price, and a limited number of websites.
 
+    Plans are flyweights interned by the active Catalog: Plan(name) returns
+    the same instance for the same name until another catalog is installed.
+
     Args:
         name (str)      : 'Single', 'Plus', or 'Infinite'
 
     Attributes:
-        plans (dict)    : Contains price options and max allowed sites
+        plans (dict)    : Contains price options and max allowed sites of the active catalog
+        catalog (obj:Catalog) : Active catalog
         name (string)   : Name of the plan
         price (float)   : Price in dollars
-        max_sites (int) : Number of websites allowed
+        max_sites (int) : Number of websites allowed, None if unlimited
+        id (int)        : Dense plan id within the catalog
     """
 
+    __slots__ = ("name", "price", "max_sites", "id")
+
     plans = {"Single": (1,49), "Plus":(3,99), "Infinite":(None,249)}
+    catalog = None
 
-    def __init__(self, name):
-        """Takes a plan name and sets the price and maximum number of sites"""
-        if name not in Plan.plans.keys():
-            raise Exception(f'Plan')
-        self.name = name
-        self.price = Plan.plans.get(name)[1]
-        self.max_sites = Plan.plans.get(name)[0]
+    def __new__(cls, name):
+        """Returns the interned plan with a name from the active catalog"""
+        return cls.catalog.plan(name)
+
+    def __reduce__(self):
+        return (Plan, (self.name,))
 
     def __str__(self):
         return f'{self.name}'
 
 
+class Catalog():
+    """A catalog compiles plan definitions into interned plans and dense arrays.
+
+    Plan ids index the prices, cents and limits arrays, which the scalar path
+    reads directly and the batch path views as NumPy arrays. Proration uses
+    the prices in cents, the dollar prices are kept for display.
+
+    Args:
+        plans (dict)        : Maps a plan name to (max_sites, price), max_sites None if unlimited
+
+    Attributes:
+        plans (dict)        : The plan definitions
+        names (list:str)    : Plan names indexed by plan id
+        ids (dict)          : Maps a plan name to its id
+        instances (list:Plan) : Interned plans indexed by plan id
+        prices (array)      : Price of each plan id in dollars
+        cents (array)       : Price of each plan id in cents
+        limits (array)      : Site limit of each plan id, -1 if unlimited
+    """
+
+    def __init__(self, plans):
+        self.plans = dict(plans)
+        self.names = list(self.plans)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.instances = []
+        self.prices = array("d")
+        self.cents = array("q")
+        self.limits = array("q")
+
+        for i, name in enumerate(self.names):
+            max_sites, price = self.plans[name]
+            plan = object.__new__(Plan)
+            plan.name, plan.price, plan.max_sites, plan.id = name, price, max_sites, i
+            self.instances.append(plan)
+            self.prices.append(price)
+            self.cents.append(money.to_cents(price))
+            self.limits.append(-1 if max_sites is None else max_sites)
+
+
+    @classmethod
+    def load(cls, path):
+        """Returns a catalog read from a JSON file
+
+        The file holds {"plans": [{"name": str, "price": float, "max_sites": int or null}]}.
+        """
+        with open(path) as fp:
+            config = json.load(fp)
+        return cls({p["name"]: (p.get("max_sites"), p["price"]) for p in config["plans"]})
+
+
+    def install(self):
+        """Makes this catalog the one used by Plan and Customer"""
+        Plan.catalog = self
+        Plan.plans = self.plans
+        return self
+
+
+    def plan(self, name):
+        """Returns the interned plan with a name, raises an exception if unknown"""
+        i = self.ids.get(name)
+        if i is None:
+            raise Exception(f'Plan')
+        return self.instances[i]
+
+
+    def price(self, name):
+        """Returns the price of a plan"""
+        return self.prices[self.ids[name]]
+
+
+    def price_cents(self, name):
+        """Returns the price of a plan in cents"""
+        return self.cents[self.ids[name]]
+
+
+    def price_array(self):
+        """Returns the prices indexed by plan id as a NumPy array"""
+        import numpy as np  # Kept local so that importing models stays cheap
+        return np.frombuffer(self.prices, dtype=np.float64)
+
+
+    def cents_array(self):
+        """Returns the prices in cents indexed by plan id as a NumPy array"""
+        import numpy as np
+        return np.frombuffer(self.cents, dtype=np.int64)
+
+
+    def limit_array(self):
+        """Returns the site limits indexed by plan id as a NumPy array, -1 if unlimited"""
+        import numpy as np
+        return np.frombuffer(self.limits, dtype=np.int64)
+
+
+Catalog(Plan.plans).install()
+
+
 class Website():
     """ Websites have an URL, a database option and a customer.
 
@@ -308,18 +485,28 @@ class Website():
 
     Attributes:
         url (str)               : Full URL in the form http://domain.com
-        customer (str)          : Taken from Customer object
+        customer (str)          : Name of the owning customer, read through owner
+        owner (weakref)         : Weak reference to the owning customer
         has_database (bool)     : True if database is required, False otherwises
     """
+
+    __slots__ = ("url", "database", "owner")
+
     def __init__(self, customerobj, domain_name, has_database=False):
         self.database = has_database
-        self.customer = customerobj.name
+        self.owner = customerobj.websites.owner
 
         if has_database:
             self.url = "https://" + domain_name
         self.url = "http://" + domain_name
 
 
+    @property
+    def customer(self):
+        owner = self.owner()
+        return owner.name if owner is not None else None
+
+
     def __str__(self):
         return f'{self.url} owned by: {self.customer}'
 
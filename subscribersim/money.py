@@ -0,0 +1,73 @@
+"""Money
+
+This module contains the fixed-point money kernel of this simple subscription
+system. Amounts are held as integer cents from the catalog to the ledgers, and
+every plan change is prorated by prorate, the one place where rounding
+happens: the spend since the last plan change is rounded half up to the cent,
+and every other amount is an exact difference of cents.
+
+The kernel only uses integer arithmetic and comparisons, so the same function
+prorates one plan change given ints or a whole population given int64 NumPy
+arrays, and sums of cents never drift.
+
+Dollar floats remain the public view: Plan.price, the Customer ledgers and the
+report rows convert with to_dollars, which returns the same float as rounding
+to two decimals.
+
+Example:
+
+        spend, current, kind, payment, refund = prorate(9900, 9900, 5184000, 31536000, 4900)
+        to_dollars(refund)
+
+Attributes:
+    CENTS (int)         : Cents in a dollar
+    TRANSFER (int)      : Kind code of a move where the balance equals the new price
+    UPGRADE (int)       : Kind code of a move that requires a payment
+    DOWNGRADE (int)     : Kind code of a move that results in a refund
+    KINDS (tuple)       : Event type names indexed by kind code
+
+"""
+
+CENTS = 100
+TRANSFER, UPGRADE, DOWNGRADE = 0, 1, 2
+KINDS = ("transfer", "upgrade", "downgrade")
+
+
+def to_cents(dollars):
+    """Returns a dollar amount as integer cents, rounded to the nearest cent"""
+    return int(round(dollars * CENTS))
+
+
+def to_dollars(cents):
+    """Returns cents as a dollar float, or a float array given an integer array"""
+    return cents / CENTS
+
+
+def spend(price, elapsed, seconds_in_year):
+    """Returns the cents spent on a yearly price after elapsed seconds, rounded half up"""
+    return (2 * price * elapsed + seconds_in_year) // (2 * seconds_in_year)
+
+
+def prorate(old_price, balance, elapsed, seconds_in_year, new_price):
+    """Prorates plan changes given in cents, one change or arrays of many
+
+    Args:
+        old_price (int)       : Price of the plan being left
+        balance (int)         : Balance after the last event
+        elapsed (int)         : Seconds since the last event
+        seconds_in_year (int) : Seconds in the year starting at the plan change
+        new_price (int)       : Price of the plan being moved to
+
+    Returns:
+        A tuple of the spend, the balance left after the spend, the kind code,
+        the payment due and the refund.
+    """
+    spent = spend(old_price, elapsed, seconds_in_year)
+    current = balance - spent
+    # upgrade - downgrade is 1, 0 or -1, which is DOWNGRADE modulo 3
+    upgrade = new_price > current
+    downgrade = new_price < current
+    kind = (upgrade * 1 - downgrade * 1) % 3
+    payment = (new_price - current) * upgrade
+    refund = (current - new_price) * downgrade
+    return spent, current, kind, payment, refund
@@ -0,0 +1,167 @@
+"""Monte Carlo
+
+This module simulates populations of synthetic customers for revenue
+forecasting. Customers start on a plan drawn from an initial distribution
+and, after exponentially distributed waits, move between plans according to
+a Markov transition matrix. Every plan change goes through the batch
+proration of the proration module, so payments, refunds and balances follow
+the same rules as Customer.move_to_plan.
+
+Sampling and proration are vectorized over the whole population, and every
+trial is seeded from a numpy SeedSequence so forecasts are reproducible.
+SeedSequence and default_rng need NumPy 1.17, the version requirements.txt
+pins. Money is simulated and totalled in integer cents.
+
+Example:
+
+        model = Model({"Single": 0.5, "Plus": 0.3, "Infinite": 0.2},
+                      {"Single": {"Single": 0.8, "Plus": 0.2}, ...}, mean_days=90)
+        population = simulate(model, customers=100000, steps=12, seed=7)
+        forecast = run_trials(model, customers=10000, steps=12, trials=1000, seed=7)
+        summarize(money.to_dollars(forecast["paid"]))
+
+Attributes:
+    Population (type) : Final state arrays of a simulated population, money in cents
+
+"""
+
+from collections import namedtuple
+import numpy as np
+from . import epochs
+from . import models
+from . import proration
+
+Population = namedtuple("Population", ["plans", "times", "balances", "paid", "refunded", "sites", "events"])
+
+
+class Model():
+    """A model describes how synthetic customers pick and change plans.
+
+    Args:
+        initial (dict)      : Maps a plan name to the probability of starting on it
+        transitions (dict)  : Maps a plan name to a dict of next plan probabilities, staying included
+        mean_days (float)   : Mean days between two plan decisions
+        sites_mean (float)  : Mean number of websites, capped by the starting plan's limit
+        spread_days (int)   : Signups are spread uniformly over this many days
+        start (int)         : Epoch seconds of the first signup
+
+    Attributes:
+        catalog (obj:Catalog) : Catalog the plan ids refer to
+        initial (array)       : Starting probability of each plan id
+        cumulative (array)    : Cumulative transition probabilities, one row per plan id
+    """
+
+    def __init__(self, initial, transitions, mean_days=90.0, sites_mean=1.0, spread_days=365, start=1546300800):
+        self.catalog = models.Plan.catalog
+        size = len(self.catalog.names)
+        self.initial = np.zeros(size)
+        matrix = np.zeros((size, size))
+        for name, probability in initial.items():
+            self.initial[self.catalog.ids[name]] = probability
+        for name, row in transitions.items():
+            for target, probability in row.items():
+                matrix[self.catalog.ids[name], self.catalog.ids[target]] = probability
+        for name in self.catalog.names:
+            if name not in transitions:
+                matrix[self.catalog.ids[name], self.catalog.ids[name]] = 1.0
+
+        if not np.isclose(self.initial.sum(), 1.0) or not np.allclose(matrix.sum(axis=1), 1.0):
+            raise Exception("Probabilities must sum to 1")
+        self.cumulative = np.cumsum(matrix, axis=1)
+        self.cumulative[:, -1] = 1.0
+        self.mean_days = mean_days
+        self.sites_mean = sites_mean
+        self.spread_days = spread_days
+        self.start = start
+
+    @classmethod
+    def from_dict(cls, config):
+        """Returns a model from a dict such as one loaded from JSON"""
+        return cls(**config)
+
+
+def simulate(model, customers, steps, seed=0, record=None):
+    """Simulates a population and returns its final state
+
+    Args:
+        model (obj:Model)   : Plan choice model
+        customers (int)     : Population size
+        steps (int)         : Number of plan decisions per customer
+        seed (int or SeedSequence) : Seed of the random generator
+        record (list)       : If given, (plan ids, times, moved, sites) arrays of every step are appended
+
+    Returns:
+        A Population of arrays with one entry per customer.
+    """
+    rng = np.random.default_rng(seed)
+    prices, limits = model.catalog.cents_array(), model.catalog.limit_array()
+
+    plans = np.searchsorted(np.cumsum(model.initial), rng.random(customers), side="right")
+    plans = np.minimum(plans, len(prices) - 1)
+    times = model.start + rng.integers(0, model.spread_days * 86400, customers)
+    clock = times.copy()
+    balances = prices[plans].copy()
+    paid = balances.copy()
+    refunded = np.zeros(customers, dtype=np.int64)
+    sites = rng.poisson(model.sites_mean, customers)
+    sites = np.where(limits[plans] >= 0, np.minimum(sites, limits[plans]), sites)
+    events = np.ones(customers, dtype=np.int64)
+    if record is not None:
+        record.append((plans.copy(), times.copy(), np.ones(customers, dtype=bool), sites.copy()))
+
+    for _ in range(steps):
+        waits = np.maximum(1, np.rint(rng.exponential(model.mean_days * 86400, customers)).astype(np.int64))
+        clock = clock + waits
+        draws = rng.random(customers)
+        targets = (draws[:, None] >= model.cumulative[plans]).sum(axis=1)
+        moved = np.flatnonzero(targets != plans)
+
+        if moved.size:
+            now = clock[moved]
+            result = proration.prorate(prices[plans[moved]], balances[moved], now - times[moved],
+                                       epochs.seconds_in_year_array(now), prices[targets[moved]],
+                                       sites[moved], limits[targets[moved]])
+            balances[moved] = result.balances
+            paid[moved] += result.payments
+            refunded[moved] += result.refunds
+            sites[moved] -= result.trims
+            plans[moved] = targets[moved]
+            times[moved] = now
+            events[moved] += 1
+
+        if record is not None:
+            mask = np.zeros(customers, dtype=bool)
+            mask[moved] = True
+            record.append((plans.copy(), times.copy(), mask, sites.copy()))
+
+    return Population(plans, times, balances, paid, refunded, sites, events)
+
+
+def run_trials(model, customers, steps, trials, seed=0):
+    """Runs independent trials and returns arrays of population totals, one entry per trial
+
+    Returns:
+        A dict with 'paid', 'refunded', 'balance' totals in cents, 'events' totals and
+        'subscribers', an array of the final subscriber count per plan id and trial.
+    """
+    totals = {"paid": np.empty(trials, dtype=np.int64), "refunded": np.empty(trials, dtype=np.int64),
+              "balance": np.empty(trials, dtype=np.int64),
+              "events": np.empty(trials, dtype=np.int64),
+              "subscribers": np.empty((trials, len(model.catalog.names)), dtype=np.int64)}
+    for trial, child in enumerate(np.random.SeedSequence(seed).spawn(trials)):
+        population = simulate(model, customers, steps, child)
+        totals["paid"][trial] = population.paid.sum()
+        totals["refunded"][trial] = population.refunded.sum()
+        totals["balance"][trial] = population.balances.sum()
+        totals["events"][trial] = population.events.sum()
+        totals["subscribers"][trial] = np.bincount(population.plans, minlength=len(model.catalog.names))
+    return totals
+
+
+def summarize(values, quantiles=(0.05, 0.5, 0.95)):
+    """Returns the mean, standard deviation and quantiles of a distribution as a dict"""
+    values = np.asarray(values, dtype=np.float64)
+    summary = {"mean": float(values.mean()), "std": float(values.std())}
+    for q in quantiles:
+        summary[f"p{round(q * 100)}"] = float(np.quantile(values, q))
+    return summary
@@ -0,0 +1,171 @@
+"""Proration
+
+This module computes the proration of many plan changes at once. It follows
+the transfer, upgrade and downgrade branches of models.Customer.move_to_plan
+with NumPy arrays so that a whole population of customers is prorated in a
+single pass instead of one customer at a time. Both paths run the integer
+cent kernel money.prorate, so amounts are exact and agree to the cent.
+
+prorate_batch prices every move from the ledgers as they are before the
+batch, so a customer may appear only once. move_batch accepts several moves
+of a customer and applies them in rounds of distinct customers, each round
+prorated once the previous one is recorded.
+
+Example:
+
+        result = prorate_batch(customers, target_plans, timestamps)
+        upgrades = money.to_dollars(result.payments[result.kinds == UPGRADE])
+        apply_batch(customers, target_plans, timestamps, result)
+        result = move_batch(customers, target_plans, timestamps)
+
+Attributes:
+    TRANSFER (int)       : Kind code of a move where the balance equals the new price
+    UPGRADE (int)        : Kind code of a move that requires a payment
+    DOWNGRADE (int)      : Kind code of a move that results in a refund
+    KINDS (tuple)        : Event type names indexed by kind code
+    Proration (type)     : Arrays of cents returned by prorate and prorate_batch
+
+"""
+
+from collections import namedtuple
+import numpy as np
+from . import epochs
+from . import helpers
+from . import models
+from . import money
+from .money import TRANSFER, UPGRADE, DOWNGRADE, KINDS
+
+Proration = namedtuple("Proration", ["spend", "current_balances", "kinds", "payments", "refunds", "balances", "trims"])
+
+
+def prorate(old_prices, balances, elapsed, seconds_in_year, new_prices, site_counts, max_sites):
+    """Prorates plan changes given as parallel arrays
+
+    Args:
+        old_prices (array)      : Price in cents of the plan each customer is leaving
+        balances (array)        : Balance in cents after each customer's last event
+        elapsed (array)         : Seconds since each customer's last event
+        seconds_in_year (array) : Seconds in the year starting at each plan change
+        new_prices (array)      : Price in cents of the plan each customer is moving to
+        site_counts (array)     : Number of active websites of each customer
+        max_sites (array)       : Site limit of the new plan, negative when unlimited
+
+    Returns:
+        A Proration of arrays with one entry per plan change, amounts in cents.
+    """
+    new_prices = np.asarray(new_prices, dtype=np.int64)
+    site_counts = np.asarray(site_counts, dtype=np.int64)
+    max_sites = np.asarray(max_sites, dtype=np.int64)
+
+    spend, current, kinds, payments, refunds = money.prorate(
+        np.asarray(old_prices, dtype=np.int64), np.asarray(balances, dtype=np.int64),
+        np.asarray(elapsed, dtype=np.int64), np.asarray(seconds_in_year, dtype=np.int64), new_prices)
+    limited = (kinds == DOWNGRADE) & (max_sites >= 0)
+    trims = np.where(limited, np.maximum(site_counts - max_sites, 0), 0)
+
+    return Proration(spend, current, kinds.astype(np.int8), payments, refunds, new_prices.copy(), trims)
+
+
+def prorate_batch(customers, target_plans, timestamps):
+    """Prorates a plan change for every customer without modifying them
+
+    Args:
+        customers (list:Customer) : Subscribed customers
+        target_plans (list:str)   : Name of the desired plan of each customer
+        timestamps (list:datetime): Round datetime of each plan change
+
+    Returns:
+        A Proration of arrays with one entry per customer. Raises an exception
+        if a customer has no plan, is already on the desired plan or appears
+        more than once.
+    """
+    count = len(customers)
+    if len(target_plans) != count or len(timestamps) != count:
+        raise Exception("prorate batch")
+    if len({id(customer) for customer in customers}) != count:
+        raise Exception("Customer moved twice in one batch, use move_batch")
+
+    catalog = models.Plan.catalog
+    old_ids = np.empty(count, dtype=np.int64)
+    new_ids = np.empty(count, dtype=np.int64)
+    balances = np.empty(count, dtype=np.int64)
+    elapsed = np.empty(count, dtype=np.int64)
+    site_counts = np.empty(count, dtype=np.int64)
+
+    # Many plan changes share a timestamp during a replay
+    epoch = {}
+    now_times = np.empty(count, dtype=np.int64)
+    for i, (customer, name, now) in enumerate(zip(customers, target_plans, timestamps)):
+        current = customer.current_plan
+        if current == None or current.name == name:
+            raise Exception("move to plan")
+
+        prev = customer.events[-1][0]
+        for when in (now, prev):
+            if when not in epoch:
+                epoch[when] = helpers.datetime_to_time(when)
+
+        old_ids[i] = catalog.plan(current.name).id
+        new_ids[i] = catalog.plan(name).id
+        balances[i] = customer.store.last("balances", customer.id)
+        elapsed[i] = epoch[now] - epoch[prev]
+        now_times[i] = epoch[now]
+        site_counts[i] = customer.website_count
+
+    prices, limits = catalog.cents_array(), catalog.limit_array()
+    seconds_in_year = epochs.seconds_in_year_array(now_times)
+    return prorate(prices[old_ids], balances, elapsed, seconds_in_year, prices[new_ids], site_counts, limits[new_ids])
+
+
+def apply_batch(customers, target_plans, timestamps, result):
+    """Records the plan changes of a Proration on each customer
+
+    Args:
+        customers (list:Customer) : Customers passed to prorate_batch
+        target_plans (list:str)   : Plans passed to prorate_batch
+        timestamps (list:datetime): Timestamps passed to prorate_batch
+        result (Proration)        : Value returned by prorate_batch
+
+    Returns:
+        True if successful.
+    """
+    spend = result.spend.tolist()
+    kinds = result.kinds.tolist()
+    payments = result.payments.tolist()
+    refunds = result.refunds.tolist()
+
+    for i, customer in enumerate(customers):
+        customer._apply_move(target_plans[i], timestamps[i], KINDS[kinds[i]], spend[i], payments[i], refunds[i])
+    return True
+
+
+def move_batch(customers, target_plans, timestamps):
+    """Prorates and records plan changes in order, a customer may move several times
+
+    The n-th move of every customer is prorated in round n with
+    prorate_batch and applied before round n + 1 is prorated, so each move
+    starts from the ledgers its earlier moves left. If a move is invalid, the
+    rounds before it stay applied.
+
+    Returns:
+        A Proration of arrays with one entry per plan change, in the order given.
+    """
+    rounds, moved = [], {}
+    for i, customer in enumerate(customers):
+        n = moved.get(id(customer), 0)
+        moved[id(customer)] = n + 1
+        if n == len(rounds):
+            rounds.append([])
+        rounds[n].append(i)
+
+    merged = None
+    for indexes in rounds:
+        batch = [customers[i] for i in indexes]
+        plans, times = [target_plans[i] for i in indexes], [timestamps[i] for i in indexes]
+        result = prorate_batch(batch, plans, times)
+        apply_batch(batch, plans, times, result)
+        if merged is None:
+            merged = Proration(*(np.empty(len(customers), dtype=field.dtype) for field in result))
+        for field, values in zip(merged, result):
+            field[indexes] = values
+    return merged if merged is not None else prorate_batch([], [], [])
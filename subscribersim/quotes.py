@@ -0,0 +1,135 @@
+"""Quotes
+
+This module previews plan changes without making them. quote_move runs the
+proration of Customer.move_to_plan on the customer's last balance and event
+and returns what the move would charge, refund and leave as balance, and
+which websites a downgrade would remove. Nothing is logged, trimmed or
+appended.
+
+A quote prices the move at the start of the local day of the requested
+time, or at the last event if it happened later that day, so every preview
+of a day shows the same amount. It is therefore not what move_to_plan at the
+requested time charges: a later move has used more of the current plan, so
+it pays slightly more or is refunded slightly less than quoted. Only a move
+at the time of the quote, Quote.time, matches it to the cent. Quotes are memoized per customer in a
+small LRU keyed by plan and day. The cache of a customer is tagged with the
+size and last entry of its events ledger, its balance and the catalog: any
+select, move or renewal logs an event, which discards the customer's cached
+quotes on the next call.
+Websites are read on every call, so adding or removing sites needs no
+invalidation.
+
+Example:
+
+        quote = quote_move(jake, "Single", datetime(2019, 6, 1, 15, 30))
+        print(quote.refund, quote.sites_to_remove)
+
+Attributes:
+    Quote (type)            : A previewed plan change, amounts in dollars
+    cache (obj:QuoteCache)  : Cache used by quote_move
+
+"""
+
+import weakref
+from collections import namedtuple, OrderedDict
+from . import epochs
+from . import helpers
+from . import models
+from . import money
+
+Quote = namedtuple("Quote", ["plan", "time", "type", "spend", "charge", "refund", "balance", "sites_to_remove"])
+
+
+class QuoteCache():
+    """A quote cache holds an LRU of quotes for each live customer.
+
+    The LRU of a customer is keyed weakly, like sites.UrlIndex, and is
+    dropped together with the customer.
+
+    Args:
+        size (int)          : Most quotes kept per customer
+
+    Attributes:
+        customers (dict)    : Maps a customer to (ledger tag, OrderedDict of quotes)
+        hits (int)          : Quotes returned from the cache
+        misses (int)        : Quotes computed
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.customers = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def quote(self, customer, name, when=None):
+        """Returns the Quote of moving a customer to a plan at a datetime, now if omitted"""
+        if when is None:
+            when = helpers.datetime_now()
+        current = customer.current_plan
+        if current is None or current.name == name:
+            raise Exception("move to plan")
+
+        store, cid = customer.store, customer.id
+        events = store.events
+        last = events.offsets[cid] + events.sizes[cid] - 1
+        tag = (events.sizes[cid], events.columns[0][last], store.last("balances", cid), models.Plan.catalog)
+        if helpers.datetime_to_time(when) < tag[1]:
+            raise Exception("Quote before the last event")
+        entry = self.customers.get(customer)
+        if entry is None or entry[0] != tag:
+            entry = self.customers[customer] = (tag, OrderedDict())
+        quotes = entry[1]
+
+        t = when.timetuple()
+        key = (name, t.tm_year, t.tm_mon, t.tm_mday)
+        quote = quotes.get(key)
+        if quote is None:
+            self.misses += 1
+            quote = quotes[key] = self._price(customer, name, max(epochs.day_start(*key[1:]), tag[1]), tag)
+            if len(quotes) > self.size:
+                quotes.popitem(last=False)
+        else:
+            self.hits += 1
+            quotes.move_to_end(key)
+
+        trims = self._trims(customer, quote)
+        return quote._replace(sites_to_remove=trims) if trims else quote
+
+    def clear(self):
+        """Forgets every cached quote"""
+        self.customers.clear()
+
+    def _price(self, customer, name, tim, tag):
+        """Returns the Quote of a move at epoch seconds tim given the ledger tag, without websites"""
+        _, prev, balance, catalog = tag
+        price = catalog.cents[catalog.plan(name).id]
+        spent, _, kind, payment, refund = money.prorate(
+            catalog.price_cents(customer.current_plan.name), balance, tim - prev, epochs.seconds_in_year(tim), price)
+        return Quote(name, epochs.datetime_from_time(tim), money.KINDS[kind], money.to_dollars(spent),
+                     money.to_dollars(payment), money.to_dollars(refund), money.to_dollars(price), ())
+
+    def _trims(self, customer, quote):
+        """Returns the URLs a downgrade would remove, most recent last, like SiteRegistry.trim"""
+        limit = models.Plan(quote.plan).max_sites
+        if quote.type != "downgrade" or limit is None or customer.website_count <= limit:
+            return ()
+        return tuple(website.url for website in customer.websites)[limit:]
+
+
+cache = QuoteCache()
+
+
+def quote_move(customer, name, when=None):
+    """Returns the Quote of moving a customer to a plan at a datetime without changing the customer
+
+    Args:
+        customer (obj:Customer) : A subscribed customer
+        name (string)           : Name of the desired plan
+        when (datetime)         : Time of the move, helpers.datetime_now() at the call if omitted
+
+    Returns:
+        A Quote priced at Quote.time, the start of the day of when or the last
+        event if later, not at when itself. Raises an exception if the
+        customer has no plan or is already on the plan.
+    """
+    return cache.quote(customer, name, when)
@@ -0,0 +1,173 @@
+"""Registry
+
+This module holds customers for concurrent use from many threads. Customer
+methods read and append the ledgers of a CustomerStore, which moves and
+compacts the blocks of every customer it holds, so locking one customer is
+not enough: two customers of the same store must not be changed at once.
+A Registry therefore hash-shards customers by key, like runner and service,
+and gives every shard its own CustomerStore, UrlIndex and lock. Operations
+on customers of different shards share no mutable state and take no common
+lock, so on a free-threaded build they run in parallel. Registry.duplicates
+merges the URL indexes of the shards.
+
+Every operation looks the customer up and applies a Customer method while
+holding the lock of its shard, so a plan change or website operation is
+atomic with respect to every other operation of the registry. Customers
+must not be used or referenced outside the registry, a customer collected
+by another thread releases its ledgers without the lock.
+
+Example:
+
+        registry = Registry(shards=64)
+        registry.create("jake")
+        registry.select_plan("jake", "Single", now)
+        with ThreadPoolExecutor(32) as pool:
+            pool.map(lambda req: registry.move_to_plan(*req), requests)
+        with registry.locked("jake") as jake:
+            if jake.current_plan.name == "Single":
+                jake.move_to_plan("Plus", now)
+
+Attributes:
+    No module level variables.
+
+"""
+
+import threading
+from contextlib import contextmanager
+from . import models
+from . import replay
+from . import runner
+from . import sites
+from .store import CustomerStore
+
+
+class Shard():
+    """A shard holds customers sharing a CustomerStore and the lock guarding it.
+
+    Attributes:
+        lock (RLock)              : Held while a customer of the shard is used
+        store (obj:CustomerStore) : Ledger backend of the customers of the shard
+        url_index (obj:UrlIndex)  : URLs of the websites of the customers of the shard
+        customers (dict)          : Maps a customer key to its Customer
+    """
+
+    __slots__ = ("lock", "store", "url_index", "customers")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.store = CustomerStore()
+        self.url_index = sites.UrlIndex()
+        self.customers = {}
+
+
+class Registry():
+    """A registry applies customer operations under per-shard locks.
+
+    Args:
+        shards (int)    : Number of shards, more shards means less contention
+
+    Attributes:
+        shards (list:Shard) : Shards indexed by runner.shard_of
+    """
+
+    def __init__(self, shards=16):
+        self.shards = [Shard() for _ in range(shards)]
+
+    def __len__(self):
+        return sum(len(shard.customers) for shard in self.shards)
+
+    def __contains__(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            return key in shard.customers
+
+    def keys(self):
+        """Returns the customer keys of every shard"""
+        keys = []
+        for shard in self.shards:
+            with shard.lock:
+                keys.extend(shard.customers)
+        return keys
+
+    def create(self, key, name=None, password="", email=""):
+        """Adds a customer without a plan, raises an exception if the key exists"""
+        shard = self._shard(key)
+        with shard.lock:
+            if key in shard.customers:
+                raise Exception("Customer exists")
+            shard.customers[key] = models.Customer(key if name is None else name, password, email, shard.store,
+                                                   shard.url_index)
+        return True
+
+    def remove(self, key):
+        """Removes a customer and frees its ledgers, raises an exception if unknown"""
+        shard = self._shard(key)
+        with shard.lock:
+            self._get(shard, key)
+            del shard.customers[key]
+        return True
+
+    @contextmanager
+    def locked(self, key):
+        """Yields a customer with the lock of its shard held, to apply several operations atomically"""
+        shard = self._shard(key)
+        with shard.lock:
+            yield self._get(shard, key)
+
+    def select_plan(self, key, name, now=None):
+        """Atomically applies Customer.select_plan"""
+        with self.locked(key) as customer:
+            return customer.select_plan(name, now)
+
+    def move_to_plan(self, key, name, now=None):
+        """Atomically applies Customer.move_to_plan"""
+        with self.locked(key) as customer:
+            return customer.move_to_plan(name, now)
+
+    def renew(self, key):
+        """Atomically applies Customer.renew"""
+        with self.locked(key) as customer:
+            return customer.renew()
+
+    def add_website(self, key, url, has_database=False):
+        """Atomically applies Customer.add_website"""
+        with self.locked(key) as customer:
+            return customer.add_website(url, has_database)
+
+    def remove_website(self, key, url):
+        """Atomically applies Customer.remove_website"""
+        with self.locked(key) as customer:
+            return customer.remove_website(url)
+
+    def summary(self, key):
+        """Returns the replay.Summary of a customer, read under the lock of its shard"""
+        with self.locked(key) as customer:
+            return replay.summarize(customer)
+
+    def hosting(self, url):
+        """Returns the names of the customers of every shard hosting a full URL"""
+        names = []
+        for shard in self.shards:
+            with shard.lock:
+                names.extend(customer.name for customer in shard.url_index.customers(url))
+        return names
+
+    def duplicates(self):
+        """Returns a dict of every URL hosted by more than one customer and their names, across shards"""
+        hosts = {}
+        for shard in self.shards:
+            with shard.lock:
+                for url in list(shard.url_index.owners):
+                    hosts.setdefault(url, []).extend(c.name for c in shard.url_index.customers(url))
+        return {url: names for url, names in hosts.items() if len(names) > 1}
+
+    def _shard(self, key):
+        """Returns the shard of a customer key"""
+        return self.shards[runner.shard_of(key, len(self.shards))]
+
+    def _get(self, shard, key):
+        """Returns the customer of a key in a shard whose lock is held"""
+        customer = shard.customers.get(key)
+        if customer is None:
+            raise Exception("Unknown customer")
+        return customer
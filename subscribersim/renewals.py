@@ -0,0 +1,108 @@
+"""Renewals
+
+This module charges yearly renewals. A Scheduler keeps a heap of customers
+keyed by renewal date, and advancing it to a date renews every customer due
+by then, oldest renewal first, with Customer.renew. Renewed customers are
+pushed back at their next renewal date, so a customer several years behind
+is renewed once per year.
+
+Plan changes move a customer's renewal date a year past the change without
+telling the scheduler. When such an entry comes due, it is pushed back at
+the new date instead of being renewed. Advancing therefore costs
+O(log n) for each renewal and each moved entry that comes due. Customers
+that are not due are never visited.
+
+Example:
+
+        scheduler = Scheduler()
+        scheduler.add_all(customers)
+        for customer in scheduler.advance(datetime(2021, 1, 1)):
+            print(customer.name, customer.payments[-1])
+
+Attributes:
+    No module level variables.
+
+"""
+
+import heapq
+import weakref
+from itertools import count
+from . import helpers
+
+
+class Scheduler():
+    """A scheduler holds customers in a heap ordered by renewal date.
+
+    Entries refer to customers weakly, like sites.UrlIndex, and the entry of
+    a collected customer is dropped when it reaches the top of the heap.
+
+    Attributes:
+        heap (list)         : (renewal epoch, sequence, weak reference) entries
+        scheduled (dict)    : Maps a customer to the epoch of its live entry
+        renewed (int)       : Number of renewals charged
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.scheduled = weakref.WeakKeyDictionary()
+        self.sequence = count()
+        self.renewed = 0
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def add(self, customer):
+        """Schedules the next renewal of a subscribed customer"""
+        due = self._due(customer)
+        if due is not None and self.scheduled.get(customer) != due:
+            self.scheduled[customer] = due
+            heapq.heappush(self.heap, (due, next(self.sequence), weakref.ref(customer)))
+
+    def add_all(self, customers):
+        """Schedules many customers, heapifying once"""
+        for customer in customers:
+            due = self._due(customer)
+            if due is not None and self.scheduled.get(customer) != due:
+                self.scheduled[customer] = due
+                self.heap.append((due, next(self.sequence), weakref.ref(customer)))
+        heapq.heapify(self.heap)
+
+    def next_due(self):
+        """Returns the earliest scheduled renewal as a datetime, None if nothing is scheduled"""
+        while self.heap and self._stale(self.heap[0]):
+            heapq.heappop(self.heap)
+        return helpers.time_to_datetime(self.heap[0][0]) if self.heap else None
+
+    def advance(self, until):
+        """Renews every customer due at or before a datetime
+
+        Returns:
+            The renewed customers in renewal order, once per renewal.
+        """
+        limit = helpers.datetime_to_time(until)
+        heap, fired = self.heap, []
+        while heap and heap[0][0] <= limit:
+            entry = heapq.heappop(heap)
+            if self._stale(entry):
+                continue
+            customer = entry[2]()
+            due = self._due(customer)
+            if due == entry[0]:
+                customer.renew()
+                fired.append(customer)
+                due = self._due(customer)
+            self.scheduled[customer] = due
+            heapq.heappush(heap, (due, next(self.sequence), entry[2]))
+        self.renewed += len(fired)
+        return fired
+
+    def _due(self, customer):
+        """Returns the renewal date of a customer in epoch seconds, None without a plan"""
+        if customer.current_plan is None or customer.plan_renewal_date is None:
+            return None
+        return helpers.datetime_to_time(customer.plan_renewal_date)
+
+    def _stale(self, entry):
+        """Returns True if an entry belongs to a dead customer or was superseded"""
+        customer = entry[2]()
+        return customer is None or self.scheduled.get(customer) != entry[0]
@@ -0,0 +1,181 @@
+"""Replay
+
+This module replays event logs against customers. Logs are JSON lines or
+CSV files of select_plan, move_to_plan, add_website and remove_website
+events. Events are parsed lazily and applied as they are read, and every
+customer is emitted as soon as its history is consumed, so memory grows with
+the number of active customers rather than with the size of the log.
+
+A customer's history is consumed when a 'close' event is read for it, when
+no event was seen for it during retire_after seconds of log time, or when the
+log ends. retire_after must be longer than any gap between two events of a
+customer, yearly subscribers can be idle for more than a year. Nothing is
+kept of a retired customer: a later select_plan for its key starts a new
+customer, and any other event for a key without a customer holding a plan
+is an error, whether the customer was retired or never selected a plan.
+
+Example:
+
+        events = read_events("events.jsonl")
+        for customer in replay(events, retire_after=400 * 86400):
+            print(summarize(customer))
+
+        $ python -m subscribersim.replay events.jsonl > summary.csv
+
+Attributes:
+    ACTIONS (tuple)  : Event actions understood by apply_event
+    FIELDS (tuple)   : Columns of an event in a CSV log
+    Event (type)     : A parsed log event
+    Summary (type)   : Final state of a replayed customer
+
+"""
+
+import csv
+import json
+import sys
+from collections import namedtuple, OrderedDict
+from itertools import chain
+from datetime import datetime
+from . import helpers
+from . import models
+from . import money
+
+ACTIONS = ("select_plan", "move_to_plan", "add_website", "remove_website", "close")
+FIELDS = ("customer", "action", "time", "plan", "url", "database")
+
+Event = namedtuple("Event", ["customer", "action", "time", "plan", "url", "database"])
+Summary = namedtuple("Summary", ["customer", "plan", "renews_on", "events", "payments", "paid",
+                                 "refunded", "balance", "websites"])
+
+
+def parse_time(value):
+    """Returns a round datetime from epoch seconds or an ISO 8601 string"""
+    if isinstance(value, (int, float)):
+        return helpers.time_to_datetime(value)
+    value = value.strip()
+    if value.lstrip("-").isdigit():
+        return helpers.time_to_datetime(int(value))
+    return datetime.fromisoformat(value).replace(microsecond=0)
+
+
+def parse_bool(value):
+    """Returns a bool from a JSON value or a CSV cell"""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+
+def make_event(record):
+    """Returns an Event from a dict read from a log"""
+    action = record["action"]
+    if action not in ACTIONS:
+        raise Exception(f"Unknown action {action}")
+    return Event(str(record["customer"]), action, parse_time(record["time"]), record.get("plan") or None,
+                 record.get("url") or None, parse_bool(record.get("database", False)))
+
+
+def read_jsonl(lines):
+    """Yields an Event for every non blank JSON line"""
+    for line in lines:
+        if line.strip():
+            yield make_event(json.loads(line))
+
+
+def read_csv(lines):
+    """Yields an Event for every row of a CSV log with a FIELDS header"""
+    for record in csv.DictReader(lines):
+        yield make_event(record)
+
+
+def read_events(path):
+    """Yields the events of a .jsonl or .csv log, reading one line at a time"""
+    reader = read_csv if path.endswith(".csv") else read_jsonl
+    with open(path, newline="") as lines:
+        yield from reader(lines)
+
+
+def apply_event(customer, event):
+    """Applies one event to a customer using the Customer methods"""
+    if event.action == "select_plan":
+        customer.select_plan(event.plan, event.time)
+    elif event.action == "move_to_plan":
+        customer.move_to_plan(event.plan, event.time)
+    elif event.action == "add_website":
+        customer.add_website(event.url, event.database)
+    elif event.action == "remove_website":
+        customer.remove_website(event.url)
+    return True
+
+
+def replay(events, retire_after=None, store=None, on_error=None, factory=None):
+    """Applies events to customers and yields each customer once its history is consumed
+
+    Args:
+        events (iter:Event)        : Events in log order
+        retire_after (int)         : Seconds of log time without events before a customer is retired,
+                                     longer than any gap between two events of a customer
+        store (obj:CustomerStore)  : Ledger backend of the replayed customers
+        on_error (callable)        : Called with (event, exception) when an event fails, re-raises if None
+        factory (callable)         : Returns the customer for a key seen for the first time, a new one if None
+
+    Yields:
+        Customer objects named after their log key, least recently active first.
+    """
+    active = OrderedDict()
+
+    for event in events:
+        key = event.customer
+        customer, _ = active.pop(key, (None, None))
+
+        if event.action == "close":
+            if customer is not None:
+                yield customer
+            continue
+
+        if customer is None:
+            customer = factory(key) if factory else models.Customer(key, "", "", store)
+            if customer.current_plan is None and event.action != "select_plan":
+                exc = Exception(f"{event.action} for customer {key} without a plan, retired or never subscribed")
+                if on_error is None:
+                    raise exc
+                on_error(event, exc)
+                continue
+        now = helpers.datetime_to_time(event.time)
+        active[key] = (customer, now)
+
+        try:
+            apply_event(customer, event)
+        except Exception as exc:
+            if on_error is None:
+                raise
+            on_error(event, exc)
+
+        if retire_after is not None:
+            while next(iter(active.values()))[1] < now - retire_after:
+                yield active.popitem(last=False)[1][0]
+
+    while active:
+        yield active.popitem(last=False)[1][0]
+
+
+def summarize(customer):
+    """Returns the Summary of a customer"""
+    renews_on = customer.plan_renewal_date
+    store, cid = customer.store, customer.id
+    return Summary(customer.name, customer.current_plan.name if customer.current_plan else "",
+                   renews_on.isoformat() if renews_on else "", len(customer.events) - 1,
+                   len(customer.payments) - 1, money.to_dollars(sum(store.payments.values(cid))),
+                   money.to_dollars(sum(store.refunds.values(cid))), customer.balances[-1], customer.website_count)
+
+
+def write_summaries(summaries, fp):
+    """Writes Summary rows to a file object as CSV with a header"""
+    writer = csv.writer(fp, lineterminator="\n")
+    writer.writerow(Summary._fields)
+    for summary in summaries:
+        writer.writerow(summary)
+
+
+if __name__ == '__main__':
+    events = chain.from_iterable(read_events(path) for path in sys.argv[1:])
+    write_summaries((summarize(c) for c in replay(events)), sys.stdout)
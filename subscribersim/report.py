@@ -0,0 +1,87 @@
+"""Report
+
+This module derives report rows from customer ledgers. Rows are built
+lazily, one event at a time, from the events ledger of a CustomerStore and
+the ledger sizes recorded with each event, so customers no longer carry a
+rendered copy of their history. Rows of many customers can be streamed to
+paged text tables, CSV or JSON lines.
+
+Example:
+
+        write_table(customers, sys.stdout, page_size=50)
+        write_csv(customers, open("report.csv", "w", newline=""))
+        print_table(jake)
+
+Attributes:
+    HEADER (list:str) : Column names of a report row
+
+"""
+
+import csv
+import json
+from itertools import chain, islice
+from . import epochs
+from . import money
+
+HEADER = ["customer", "event", "plan", "renews on", "websites", "payments", "last payment", "last spend",
+          "last refund", "balance"]
+
+
+def rows(customer):
+    """Yields a report row for every event of a customer, in the order of HEADER"""
+    store, cid = customer.store, customer.id
+    events, labels = store.events, store.labels
+    balances, payments = store.balances, store.payments
+    refunds, spend = store.refunds, store.spend
+
+    for i in range(1, events.sizes[cid]):
+        tim, plan, type, sites, paid, refunded, spent = events.get(cid, i)
+        renews_on = epochs.datetime_from_time(epochs.months_hence(tim, 12))
+        yield [customer.name, labels[type], labels[plan], renews_on, sites, paid - 1,
+               money.to_dollars(payments.get(cid, paid - 1)[0]), money.to_dollars(spend.get(cid, spent - 1)[0]),
+               money.to_dollars(refunds.get(cid, refunded - 1)[0]), money.to_dollars(balances.get(cid, i)[0])]
+
+
+def iter_rows(customers):
+    """Yields the report rows of many customers, one customer after another"""
+    return chain.from_iterable(rows(customer) for customer in customers)
+
+
+def pages(customers, page_size):
+    """Yields lists of at most page_size report rows"""
+    stream = iter_rows(customers)
+    page = list(islice(stream, page_size))
+    while page:
+        yield page
+        page = list(islice(stream, page_size))
+
+
+def write_table(customers, fp, page_size=100):
+    """Writes report rows as text tables of page_size rows, each with a header"""
+    from tabulate import tabulate  # Only needed when a table is rendered
+    for page in pages(customers, page_size):
+        fp.write(tabulate(page, headers=HEADER))
+        fp.write("\n\n")
+
+
+def write_csv(customers, fp):
+    """Writes report rows as CSV with a header"""
+    writer = csv.writer(fp, lineterminator="\n")
+    writer.writerow(HEADER)
+    for row in iter_rows(customers):
+        row[3] = row[3].isoformat()
+        writer.writerow(row)
+
+
+def write_jsonl(customers, fp):
+    """Writes report rows as JSON objects, one per line"""
+    for row in iter_rows(customers):
+        row[3] = row[3].isoformat()
+        fp.write(json.dumps(dict(zip(HEADER, row))))
+        fp.write("\n")
+
+
+def print_table(customer):
+    """Prints every report row of a customer as a single table"""
+    from tabulate import tabulate
+    print ("\n\n", tabulate(list(rows(customer)), headers=HEADER), "\n\n")
@@ -0,0 +1,145 @@
+"""Rollups
+
+This module maintains revenue aggregates as events are logged. A Rollup
+attached to a CustomerStore is called after every select_plan, move_to_plan
+and renewal, and updates in O(1) the money paid and refunded per month and
+plan, the events per month and type, and the active subscribers per plan.
+A customer stops being an active subscriber when the store releases its id,
+once it is closed and collected. Queries read the counters and never scan
+the ledgers.
+
+Rollups hold plain counters in cents, so the rollups of shards replayed in
+separate processes can be pickled and merged. recompute builds the same
+counters from scratch by walking the ledgers, to check an incremental rollup.
+
+Customers restored by the snapshot or database modules do not log events,
+so they are only counted by recompute.
+
+Example:
+
+        rollup = Rollup().attach(store)
+        ... replay into store ...
+        rollup.revenue((2019, 6))
+        rollup.changes((2019, 6))
+        rollup == recompute(customers)
+
+Attributes:
+    No module level variables.
+
+"""
+
+from collections import Counter
+from . import epochs
+from . import money
+
+
+class Rollup():
+    """A rollup holds revenue counters updated by logged events.
+
+    Attributes:
+        paid (Counter)        : Maps (year, month, plan) to cents paid
+        refunded (Counter)    : Maps (year, month, plan) to cents refunded
+        events (Counter)      : Maps (year, month, event type) to a count
+        subscribers (Counter) : Maps a plan to the unreleased customers whose last event is on it
+    """
+
+    def __init__(self):
+        self.paid = Counter()
+        self.refunded = Counter()
+        self.events = Counter()
+        self.subscribers = Counter()
+
+    def __eq__(self, other):
+        if not isinstance(other, Rollup):
+            return NotImplemented
+        return all(_nonzero(getattr(self, name)) == _nonzero(getattr(other, name))
+                   for name in ("paid", "refunded", "events", "subscribers"))
+
+    def attach(self, store):
+        """Updates this rollup on every event logged in a CustomerStore and returns it"""
+        store.observers.append(self.observe)
+        return self
+
+    def detach(self, store):
+        """Stops updating this rollup from a CustomerStore"""
+        store.observers.remove(self.observe)
+
+    def observe(self, store, cid, entry):
+        """Counts an events ledger entry just appended for customer id cid, or the release of cid if None"""
+        events = store.events
+        if entry is None:
+            plan = events.columns[1][events.offsets[cid] + events.sizes[cid] - 1]
+            if plan >= 0:
+                self.subscribers[store.labels[plan]] -= 1
+            return
+        tim, plan, type, _, paid, refunded, _ = entry
+        previous = events.offsets[cid] + events.sizes[cid] - 2
+        labels = store.labels
+        old = events.columns[1][previous]
+        payment = refund = 0
+        if paid > events.columns[4][previous]:
+            payment = store.payments.columns[0][store.payments.offsets[cid] + paid - 1]
+        if refunded > events.columns[5][previous]:
+            refund = store.refunds.columns[0][store.refunds.offsets[cid] + refunded - 1]
+        self.count(tim, labels[old] if old >= 0 else None, labels[plan], labels[type], payment, refund)
+
+    def count(self, tim, old, plan, type, payment, refund):
+        """Counts one event moving a customer from plan old, None for a new customer, to plan"""
+        year, month = epochs.year_month(tim)
+        self.events[year, month, type] += 1
+        if payment:
+            self.paid[year, month, plan] += payment
+        if refund:
+            self.refunded[year, month, plan] += refund
+        if old is not None:
+            self.subscribers[old] -= 1
+        self.subscribers[plan] += 1
+
+    def merge(self, other):
+        """Adds the counters of another rollup to this one and returns it"""
+        for name in ("paid", "refunded", "events", "subscribers"):
+            getattr(self, name).update(getattr(other, name))
+        return self
+
+    def revenue(self, month=None, plan=None):
+        """Returns the dollars paid in a (year, month) and plan, every month or plan if None"""
+        return money.to_dollars(_total(self.paid, month, plan))
+
+    def refunds(self, month=None, plan=None):
+        """Returns the dollars refunded in a (year, month) and plan, every month or plan if None"""
+        return money.to_dollars(_total(self.refunded, month, plan))
+
+    def changes(self, month):
+        """Returns a dict of the number of events of each type in a (year, month)"""
+        return {type: n for (year, mon, type), n in sorted(self.events.items()) if (year, mon) == tuple(month) and n}
+
+    def active(self):
+        """Returns a dict of the active subscribers of each plan"""
+        return {plan: n for plan, n in sorted(self.subscribers.items()) if n}
+
+
+def _nonzero(counter):
+    """Returns the entries of a counter that are not zero"""
+    return {key: n for key, n in counter.items() if n}
+
+
+def _total(counter, month, plan):
+    """Returns the sum of a (year, month, plan) counter over the keys matching month and plan"""
+    return sum(cents for (year, mon, name), cents in counter.items()
+               if (month is None or (year, mon) == tuple(month)) and (plan is None or name == plan))
+
+
+def recompute(customers):
+    """Returns a Rollup built from the ledgers of customers"""
+    rollup = Rollup()
+    for customer in customers:
+        store, cid = customer.store, customer.id
+        labels = store.labels
+        times, plans, types, _, paid, refunded, _ = store.events.entries(cid)
+        payments = store.payments.values(cid)
+        refunds = store.refunds.values(cid)
+        for i in range(1, len(times)):
+            rollup.count(times[i], labels[plans[i - 1]] if plans[i - 1] >= 0 else None, labels[plans[i]],
+                         labels[types[i]], payments[paid[i] - 1] if paid[i] > paid[i - 1] else 0,
+                         refunds[refunded[i] - 1] if refunded[i] > refunded[i - 1] else 0)
+    return rollup
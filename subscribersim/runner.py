@@ -0,0 +1,173 @@
+"""Runner
+
+This module replays event logs on many cores. Customers are independent, so
+they are hash-sharded by customer key and every shard is replayed in its own
+process with the replay module and the models logic.
+
+A run has two parallel phases. Each log is cut into line-aligned byte ranges
+and every range is split into per-shard spill files. Each shard then replays
+its spill files in log order. The summaries and ledger rows of every shard
+are sorted by customer key and merged, so the output of a sharded run is
+byte-identical to a serial run with workers=1.
+
+Logs must hold one record per line.
+
+Example:
+
+        summaries, ledgers = run(["events.jsonl"], workers=32)
+        write_results(summaries, ledgers, "out")
+
+        $ python -m subscribersim.runner 32 out events.jsonl
+
+Attributes:
+    LedgerRow (type) : One event of a replayed customer with its balance
+
+"""
+
+import csv
+import heapq
+import json
+import os
+import sys
+import tempfile
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from . import replay
+
+LedgerRow = namedtuple("LedgerRow", ["customer", "event", "time", "plan", "type", "balance"])
+
+
+def shard_of(key, shards):
+    """Returns the shard of a customer key, stable across processes and runs"""
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+def ledger_rows(customer):
+    """Returns a LedgerRow for every event of a customer"""
+    balances = customer.balances
+    return [LedgerRow(customer.name, i, when.isoformat(), plan, type, balances[i])
+            for i, (when, plan, type) in enumerate(customer.events[1:], 1)]
+
+
+def replay_shard(paths, retire_after=None):
+    """Replays logs in order and returns the sorted summaries and ledger rows of their customers"""
+    events = (event for path in paths for event in replay.read_events(path))
+    summaries, rows = [], []
+    for customer in replay.replay(events, retire_after):
+        summaries.append(replay.summarize(customer))
+        rows.extend(ledger_rows(customer))
+    summaries.sort(key=lambda summary: summary.customer)
+    rows.sort(key=lambda row: (row.customer, row.event))
+    return summaries, rows
+
+
+def split_log(path, chunk_size):
+    """Returns (start, end) byte ranges of a log cut at line boundaries, after a CSV header"""
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as log:
+        start = len(log.readline()) if path.endswith(".csv") else 0
+        while start < size:
+            log.seek(min(start + chunk_size, size))
+            log.readline()
+            end = min(log.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def spill_range(path, start, end, shards, directory, prefix):
+    """Writes the lines of a byte range to one spill file per shard
+
+    Returns:
+        A list with the spill file path of each shard, None for empty shards.
+    """
+    is_csv = path.endswith(".csv")
+    with open(path, "rb") as log:
+        header = log.readline() if is_csv else b""
+        log.seek(start)
+        data = log.read(end - start)
+
+    # Like replay.read_csv, find the customer column by the header of the log
+    column = next(csv.reader([header.decode("utf-8")])).index("customer") if is_csv else None
+    buckets = [[] for _ in range(shards)]
+    for line in data.splitlines(keepends=True):
+        if not line.strip():
+            continue
+        text = line.decode("utf-8")
+        if is_csv:
+            key = next(csv.reader([text]))[column]
+        else:
+            key = str(json.loads(text)["customer"])
+        buckets[shard_of(key, shards)].append(line)
+
+    spills = []
+    extension = ".csv" if is_csv else ".jsonl"
+    for shard, lines in enumerate(buckets):
+        if not lines:
+            spills.append(None)
+            continue
+        spill = os.path.join(directory, f"{prefix}-{shard}{extension}")
+        with open(spill, "wb") as out:
+            out.write(header)
+            out.writelines(lines)
+        spills.append(spill)
+    return spills
+
+
+def merge(results):
+    """Merges the sorted (summaries, rows) results of every shard"""
+    summaries = list(heapq.merge(*(s for s, _ in results), key=lambda summary: summary.customer))
+    rows = list(heapq.merge(*(r for _, r in results), key=lambda row: (row.customer, row.event)))
+    return summaries, rows
+
+
+def run(paths, workers=1, shards=None, retire_after=None, chunk_size=1 << 24):
+    """Replays logs and returns the merged summaries and ledger rows
+
+    Args:
+        paths (list:str)    : Logs to replay in order
+        workers (int)       : Number of processes, 1 replays in this process
+        shards (int)        : Number of customer shards, 4 per worker if omitted
+        retire_after (int)  : Passed to replay.replay, longer than any gap between two events of a customer
+        chunk_size (int)    : Approximate bytes per range of the spill phase
+
+    Returns:
+        A tuple (summaries, rows) sorted by customer key.
+    """
+    if workers == 1:
+        return replay_shard(paths, retire_after)
+
+    shards = shards or 4 * workers
+    with tempfile.TemporaryDirectory() as directory, ProcessPoolExecutor(workers) as pool:
+        ranges = [(path, start, end) for path in paths for start, end in split_log(path, chunk_size)]
+        spills = pool.map(spill_range, *zip(*ranges), [shards] * len(ranges), [directory] * len(ranges),
+                          [str(i) for i in range(len(ranges))]) if ranges else []
+
+        # Spill files of a shard stay in log order
+        shard_paths = [[] for _ in range(shards)]
+        for files in spills:
+            for shard, spill in enumerate(files):
+                if spill is not None:
+                    shard_paths[shard].append(spill)
+
+        work = [files for files in shard_paths if files]
+        results = list(pool.map(replay_shard, work, [retire_after] * len(work)))
+    return merge(results)
+
+
+def write_results(summaries, rows, directory):
+    """Writes summary.csv and ledger.csv to a directory"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "summary.csv"), "w", newline="") as fp:
+        replay.write_summaries(summaries, fp)
+    with open(os.path.join(directory, "ledger.csv"), "w", newline="") as fp:
+        writer = csv.writer(fp, lineterminator="\n")
+        writer.writerow(LedgerRow._fields)
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    summaries, rows = run(sys.argv[3:], workers=int(sys.argv[1]))
+    write_results(summaries, rows, sys.argv[2])
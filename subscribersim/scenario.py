@@ -0,0 +1,172 @@
+"""Scenario
+
+This module runs declarative scenarios over many customers. A scenario is a
+JSON or YAML file listing steps: selecting a plan, moving to a plan after an
+offset of months, days or seconds from the previous step, and adding or
+removing websites. Offsets are relative like the chained
+helpers.datetime_months_hence calls of subscribersim.py, but they are
+resolved once, when the scenario is compiled, into absolute times. Months
+are calendar months and days count 86400 seconds.
+
+A compiled Program is a set of flat arrays: one opcode, operand, flag and
+epoch time per step, with plan names and URLs interned in a table. The
+interpreter executes one step at a time across a whole population of new
+customers, so dates are never parsed or resolved per customer and every plan
+change of a step is prorated in one call to proration.prorate_batch.
+
+Scenario:
+
+        name: jake
+        start: 2019-01-01T09:00:00
+        steps:
+          - select_plan: Infinite
+          - add_website: superdupercop.com
+            database: true
+          - add_website: iamjohnmclane.com
+          - move_to_plan: Single
+            after: {months: 4}
+          - move_to_plan: Plus
+            after: {months: 2}
+
+Example:
+
+        program = compile_scenario(load("jake.yaml"))
+        customers = population(1000000)
+        run(program, customers)
+
+        $ subscribersim scenario jake.yaml --customers 100000 > summary.csv
+
+Attributes:
+    SELECT (int)        : Opcode of select_plan, the operand is a plan id
+    MOVE (int)          : Opcode of move_to_plan, the operand is a plan id
+    ADD_SITE (int)      : Opcode of add_website, the operand is a URL and the flag the database option
+    REMOVE_SITE (int)   : Opcode of remove_website, the operand is a full URL
+    OPCODES (dict)      : Maps a step key to its opcode
+    OFFSETS (tuple)     : Keys understood in the 'after' mapping of a step
+    Program (type)      : A compiled scenario
+
+"""
+
+import json
+from array import array
+from collections import namedtuple
+from . import epochs
+from . import helpers
+from . import models
+from . import replay
+
+SELECT, MOVE, ADD_SITE, REMOVE_SITE = 0, 1, 2, 3
+OPCODES = {"select_plan": SELECT, "move_to_plan": MOVE, "add_website": ADD_SITE, "remove_website": REMOVE_SITE}
+OFFSETS = ("months", "days", "seconds")
+
+Program = namedtuple("Program", ["name", "ops", "operands", "flags", "times", "constants"])
+
+
+def load(path):
+    """Returns the scenario dict of a .json, .yaml or .yml file"""
+    with open(path) as fp:
+        if path.endswith((".yaml", ".yml")):
+            import yaml  # PyYAML is only needed for YAML scenarios
+            return yaml.safe_load(fp)
+        return json.load(fp)
+
+
+def compile_scenario(scenario, start=None):
+    """Compiles a scenario dict into a Program
+
+    Args:
+        scenario (dict)     : Holds 'steps' and optionally 'name' and 'start'
+        start (datetime)    : Time of the first step, overrides the start of the scenario
+
+    Returns:
+        A Program whose times are absolute epoch seconds. Raises an exception
+        on an unknown step or plan.
+    """
+    if start is None:
+        start = scenario.get("start")
+        if start is None:
+            start = helpers.datetime_now()
+        elif hasattr(start, "isoformat"):
+            # YAML loads timestamps as dates and datetimes
+            start = replay.parse_time(start.isoformat())
+        else:
+            start = replay.parse_time(start)
+    clock = helpers.datetime_to_time(start)
+
+    catalog = models.Plan.catalog
+    ops, operands, flags, times = array("b"), array("q"), array("b"), array("q")
+    constants, interned = [], {}
+    for number, step in enumerate(scenario.get("steps", ())):
+        actions = [key for key in step if key in OPCODES]
+        if len(actions) != 1:
+            raise Exception(f"Step {number} needs exactly one of {', '.join(OPCODES)}")
+        action = actions[0]
+        unknown = set(step) - set(OPCODES) - {"after", "database"}
+        if unknown:
+            raise Exception(f"Step {number} has unknown keys {', '.join(sorted(unknown))}")
+
+        clock = _advance(clock, step.get("after") or {})
+        op, value = OPCODES[action], step[action]
+        if op in (SELECT, MOVE):
+            operand = catalog.plan(value).id
+        else:
+            if value not in interned:
+                interned[value] = len(constants)
+                constants.append(value)
+            operand = interned[value]
+
+        ops.append(op)
+        operands.append(operand)
+        flags.append(1 if replay.parse_bool(step.get("database", False)) else 0)
+        times.append(clock)
+    return Program(scenario.get("name", ""), ops, operands, flags, times, constants)
+
+
+def _advance(clock, after):
+    """Returns epoch seconds clock moved by an 'after' mapping of months, days and seconds"""
+    unknown = set(after) - set(OFFSETS)
+    if unknown:
+        raise Exception(f"Unknown offsets {', '.join(sorted(unknown))}")
+    if after.get("months"):
+        clock = epochs.months_hence(clock, int(after["months"]))
+    return clock + int(after.get("days", 0)) * 86400 + int(after.get("seconds", 0))
+
+
+def population(count, prefix="customer", store=None):
+    """Returns count new customers named prefix-0 to prefix-(count - 1)"""
+    return [models.Customer(f"{prefix}-{i}", "", "", store) for i in range(count)]
+
+
+def run(program, customers):
+    """Executes a Program on every customer, one step at a time across all of them
+
+    Customers must not have a plan yet. The plan changes of a step are
+    prorated together with proration.prorate_batch.
+
+    Returns:
+        The customers.
+    """
+    from . import proration  # Imports NumPy, only needed once a scenario runs
+    names = models.Plan.catalog.names
+    count = len(customers)
+    for op, operand, flag, tim in zip(program.ops, program.operands, program.flags, program.times):
+        when = epochs.datetime_from_time(tim)
+        if op == SELECT:
+            name = names[operand]
+            for customer in customers:
+                customer.select_plan(name, when)
+        elif op == MOVE:
+            plans, timestamps = [names[operand]] * count, [when] * count
+            result = proration.prorate_batch(customers, plans, timestamps)
+            proration.apply_batch(customers, plans, timestamps, result)
+        elif op == ADD_SITE:
+            url, database = program.constants[operand], bool(flag)
+            for customer in customers:
+                customer.add_website(url, database)
+        elif op == REMOVE_SITE:
+            url = program.constants[operand]
+            for customer in customers:
+                customer.remove_website(url)
+        else:
+            raise Exception(f"Unknown opcode {op}")
+    return customers
@@ -0,0 +1,297 @@
+"""Service
+
+This module serves customers over a local socket with asyncio. Clients send
+one JSON request per line and receive one JSON response per line, tagged
+with the id of the request, so a connection can pipeline many requests.
+
+Requests are routed to a shard by customer key. Each shard drains whatever
+requests are waiting into a micro-batch and applies it in arrival order:
+plan changes of distinct customers are prorated together with
+proration.prorate_batch, and the other requests are applied one at a time.
+Requests of a customer always go to the same shard, so they are applied in
+the order they were received.
+
+Request:
+
+        {"id": 1, "action": "move_to_plan", "customer": "jake", "plan": "Plus", "time": "2019-03-01T09:00:00"}
+
+Actions are those of replay.ACTIONS and 'quote', which previews a plan change
+with quotes.quote_move without applying it. Responses are
+{"id": 1, "ok": true, "result": {...}} or {"id": 1, "ok": false, "error": "..."}.
+A line that is not a JSON object is answered with an error and an id of
+null. If applying a micro-batch fails, every request of it that has no
+response yet is answered with the error and the shard keeps serving.
+
+Example:
+
+        $ subscribersim serve --port 8765
+        $ subscribersim load --port 8765 --customers 1000 --requests 100000
+
+Attributes:
+    ACTIONS (tuple) : Actions understood by the service
+
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from . import helpers
+from . import models
+from . import money
+from . import proration
+from . import quotes
+from . import replay
+from . import runner
+
+ACTIONS = replay.ACTIONS + ("quote",)
+
+
+class Service():
+    """A service applies requests to its customers in per-shard micro-batches.
+
+    Args:
+        shards (int)                : Number of shards
+        max_batch (int)             : Most requests applied in one micro-batch
+        store (obj:CustomerStore)   : Ledger backend of the customers
+
+    Attributes:
+        customers (dict)  : Maps a customer key to its Customer
+        requests (int)    : Number of requests applied
+        batches (int)     : Number of micro-batches applied
+    """
+
+    def __init__(self, shards=8, max_batch=1024, store=None):
+        self.shards = shards
+        self.max_batch = max_batch
+        self.store = store
+        self.customers = {}
+        self.queues = []
+        self.workers = []
+        self.requests = 0
+        self.batches = 0
+
+    def start(self):
+        """Starts the shard workers on the running event loop"""
+        self.queues = [asyncio.Queue() for _ in range(self.shards)]
+        self.workers = [asyncio.ensure_future(self._work(queue)) for queue in self.queues]
+
+    async def stop(self):
+        """Cancels the shard workers"""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, request):
+        """Queues a request given as a dict and returns a future of its response"""
+        future = asyncio.get_running_loop().create_future()
+        key = str(request.get("customer", ""))
+        self.queues[runner.shard_of(key, self.shards)].put_nowait((request, future))
+        return future
+
+    async def handle(self, reader, writer):
+        """Serves one connection until the client closes it"""
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("Request is not a JSON object")
+                except ValueError as e:
+                    writer.write(json.dumps({"id": None, "ok": False, "error": str(e)}).encode() + b"\n")
+                    continue
+                future = self.submit(request)
+                future.add_done_callback(lambda f: writer.write(json.dumps(f.result()).encode() + b"\n"))
+                pending.add(future)
+                future.add_done_callback(pending.discard)
+                if writer.transport.get_write_buffer_size() > 1 << 20:
+                    await writer.drain()
+            if pending:
+                await asyncio.wait(pending)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _work(self, queue):
+        """Applies the requests of a shard in micro-batches"""
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                self.apply(batch)
+            except Exception as e:
+                for request, future in batch:
+                    if not future.done():
+                        self._resolve(future, request, error=e)
+
+    def apply(self, batch):
+        """Applies a micro-batch of (request, future) pairs in order"""
+        moves = {}
+        for request, future in batch:
+            key = str(request.get("customer", ""))
+            if key in moves:
+                self._move(moves)
+            try:
+                action = request.get("action")
+                if action not in ACTIONS:
+                    raise Exception(f"Unknown action {action}")
+                customer = self.customers.get(key)
+                if customer is None and action != "select_plan":
+                    raise Exception("Unknown customer")
+
+                if action == "quote":
+                    when = replay.parse_time(request["time"]) if "time" in request else helpers.datetime_now()
+                    quote = quotes.quote_move(customer, request["plan"], when)
+                    self._resolve(future, request, dict(quote._asdict(), time=quote.time.isoformat(),
+                                                        sites_to_remove=list(quote.sites_to_remove)))
+                elif action == "move_to_plan":
+                    when = replay.parse_time(request["time"]) if "time" in request else helpers.datetime_now()
+                    if customer.current_plan is None or customer.current_plan.name == request["plan"]:
+                        raise Exception("move to plan")
+                    models.Plan(request["plan"])
+                    moves[key] = (customer, request["plan"], when, request, future)
+                else:
+                    event = replay.make_event(dict(request, time=request.get("time", helpers.datetime_now().isoformat())))
+                    if customer is None:
+                        customer = models.Customer(key, "", "", self.store)
+                        replay.apply_event(customer, event)
+                        self.customers[key] = customer
+                    else:
+                        replay.apply_event(customer, event)
+                    if action == "close":
+                        del self.customers[key]
+                    self._resolve(future, request, replay.summarize(customer)._asdict())
+            except Exception as e:
+                self._resolve(future, request, error=e)
+        self._move(moves)
+        self.batches += 1
+
+    def _move(self, moves):
+        """Prorates and applies the queued plan changes of distinct customers, then clears them"""
+        if not moves:
+            return
+        customers, plans, times, requests, futures = zip(*moves.values())
+        result = proration.prorate_batch(customers, plans, times)
+        proration.apply_batch(customers, plans, times, result)
+        for i, (request, future) in enumerate(zip(requests, futures)):
+            self._resolve(future, request, self._outcome(result, i))
+        moves.clear()
+
+    def _outcome(self, result, i):
+        """Returns the dollar amounts of entry i of a Proration as a dict"""
+        return {"type": proration.KINDS[result.kinds[i]], "spend": money.to_dollars(int(result.spend[i])),
+                "payment": money.to_dollars(int(result.payments[i])), "refund": money.to_dollars(int(result.refunds[i])),
+                "balance": money.to_dollars(int(result.balances[i]))}
+
+    def _resolve(self, future, request, result=None, error=None):
+        """Sets the response of a request"""
+        self.requests += 1
+        if error is None:
+            future.set_result({"id": request.get("id"), "ok": True, "result": result})
+        else:
+            future.set_result({"id": request.get("id"), "ok": False, "error": str(error)})
+
+
+async def serve(service, host="127.0.0.1", port=8765, path=None):
+    """Starts a service and returns its server, on a unix socket if path is given"""
+    service.start()
+    if path:
+        return await asyncio.start_unix_server(service.handle, path)
+    return await asyncio.start_server(service.handle, host, port)
+
+
+def workload(customers, requests, seed=0):
+    """Yields requests: a select_plan per customer, then plan changes a day apart"""
+    plans = ["Single", "Plus", "Infinite"]
+    start = 1546336800
+    for c in range(customers):
+        yield {"action": "select_plan", "customer": f"load{seed}-{c}", "plan": plans[c % 3], "time": start}
+    for i in range(requests - customers):
+        c, step = i % customers, i // customers + 1
+        yield {"action": "move_to_plan", "customer": f"load{seed}-{c}", "plan": plans[(c + step) % 3],
+               "time": start + step * 86400}
+
+
+async def load(host="127.0.0.1", port=8765, path=None, customers=1000, requests=100000, connections=8, window=512):
+    """Sends a workload over many connections and returns its throughput and latencies
+
+    Requests of a customer are always sent on the same connection, and each
+    connection keeps at most window requests in flight.
+    """
+    streams = [[] for _ in range(connections)]
+    for request in workload(customers, requests):
+        streams[runner.shard_of(request["customer"], connections)].append(request)
+    latencies, errors = [], []
+
+    async def client(stream):
+        if path:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        sent, slots = {}, asyncio.Semaphore(window)
+
+        async def receive():
+            for _ in stream:
+                response = json.loads(await reader.readline())
+                latencies.append(time.perf_counter() - sent.pop(response["id"]))
+                if not response["ok"]:
+                    errors.append(response["error"])
+                slots.release()
+
+        receiving = asyncio.ensure_future(receive())
+        for i, request in enumerate(stream):
+            await slots.acquire()
+            sent[i] = time.perf_counter()
+            writer.write(json.dumps(dict(request, id=i)).encode() + b"\n")
+            if i % 64 == 0:
+                await writer.drain()
+        await writer.drain()
+        await receiving
+        writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(stream) for stream in streams if stream))
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    return {"requests": len(latencies), "errors": len(errors), "seconds": round(seconds, 3),
+            "throughput": round(len(latencies) / seconds, 1),
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+            "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve customers or load a running service")
+    parser.add_argument("command", choices=["serve", "load"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--path", help="Unix socket path, used instead of host and port")
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--connections", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    if args.command == "load":
+        print(json.dumps(asyncio.run(load(args.host, args.port, args.path, args.customers,
+                                          args.requests, args.connections))))
+        return 0
+
+    async def forever():
+        server = await serve(Service(args.shards), args.host, args.port, args.path)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(forever())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
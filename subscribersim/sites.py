@@ -0,0 +1,146 @@
+"""Sites
+
+This module contains the website registry of a customer and the global
+URL index. A SiteRegistry keeps a customer's websites in an insertion
+ordered dict keyed by URL, so lookup and removal by URL are O(1) and the
+most recent sites can be trimmed from the end on downgrade. Every registry
+also records its URLs in a UrlIndex, which finds domains hosted by more than
+one customer. Customers share the global index unless they are given their
+own, and as it may be used from many threads it is updated under a lock.
+
+Example:
+
+        jake.websites.get("http://superdupercop.com")
+        jake.websites.trim(1)
+        sites.index.duplicates()
+
+Attributes:
+    index (obj:UrlIndex) : Index used by registries created without one
+
+"""
+
+import threading
+import weakref
+
+
+class UrlIndex():
+    """An index from full URL to the customers hosting it.
+
+    Customers are held through weak references: a customer releases its
+    store id and clears its websites when it is collected, which a strong
+    reference from a long lived index would postpone forever.
+
+    The owners of a URL are an insertion ordered dict rather than a list, so
+    adding or discarding one is O(1) however many customers host the URL.
+
+    Attributes:
+        owners (dict) : Maps a URL to a dict of weak references to customers, in insertion order
+        lock (RLock)  : Held while owners is updated, reentrant for customers collected meanwhile
+    """
+
+    def __init__(self):
+        self.owners = {}
+        self.lock = threading.RLock()
+
+    def add(self, url, owner):
+        """Records that the customer behind weak reference owner hosts url"""
+        with self.lock:
+            refs = self.owners.get(url)
+            if refs is None:
+                self.owners[url] = {owner: None}
+            else:
+                refs[owner] = None
+
+    def discard(self, url, owner):
+        """Forgets that the customer behind weak reference owner hosts url"""
+        with self.lock:
+            refs = self.owners.get(url)
+            if refs is not None:
+                refs.pop(owner, None)
+                if not refs:
+                    del self.owners[url]
+
+    def customers(self, url):
+        """Returns the live customers hosting url"""
+        with self.lock:
+            refs = list(self.owners.get(url, ()))
+        return [c for c in (ref() for ref in refs) if c is not None]
+
+    def duplicates(self):
+        """Returns a dict of every URL hosted by more than one customer and its customers"""
+        with self.lock:
+            shared = [url for url, refs in self.owners.items() if len(refs) > 1]
+        return {url: self.customers(url) for url in shared}
+
+
+index = UrlIndex()
+
+
+class SiteRegistry():
+    """A site registry holds the websites of one customer in insertion order.
+
+    It supports len, iteration, membership by URL and indexing like the list
+    it replaces.
+
+    Args:
+        owner (Customer)        : Customer owning the websites
+        url_index (UrlIndex)    : Index to keep up to date, sites.index if omitted
+
+    Attributes:
+        owner (weakref)         : Weak reference to the customer, shared with its websites
+        sites (dict)            : Maps a full URL to its Website
+    """
+
+    __slots__ = ("owner", "sites", "url_index")
+
+    def __init__(self, owner, url_index=None):
+        self.owner = weakref.ref(owner)
+        self.sites = {}
+        self.url_index = index if url_index is None else url_index
+
+    def __len__(self):
+        return len(self.sites)
+
+    def __iter__(self):
+        return iter(self.sites.values())
+
+    def __contains__(self, url):
+        return url in self.sites
+
+    def __getitem__(self, i):
+        if i == -1 and self.sites:
+            return next(reversed(self.sites.values()))
+        return list(self.sites.values())[i]
+
+    def get(self, url):
+        """Returns the Website with a full URL or None"""
+        return self.sites.get(url)
+
+    def add(self, website):
+        """Adds a Website, raises an exception if its URL is already registered"""
+        if website.url in self.sites:
+            raise Exception("Website exists")
+        self.sites[website.url] = website
+        self.url_index.add(website.url, self.owner)
+
+    def remove(self, url):
+        """Removes the Website with a full URL, returns False if there is none"""
+        website = self.sites.pop(url, None)
+        if website is None:
+            return False
+        self.url_index.discard(url, self.owner)
+        return True
+
+    def pop(self):
+        """Removes and returns the most recently added Website"""
+        url, website = self.sites.popitem()
+        self.url_index.discard(url, self.owner)
+        return website
+
+    def trim(self, limit):
+        """Removes the most recent websites until at most limit remain and returns them"""
+        return [self.pop() for _ in range(len(self.sites) - limit)]
+
+    def clear(self):
+        """Removes every website"""
+        self.trim(0)
@@ -0,0 +1,337 @@
+"""Store
+
+This module contains the columnar backend for customer ledgers. Instead of
+every customer owning five growing Python lists, a CustomerStore keeps the
+ledgers of all its customers in shared typed arrays. Each customer is an
+integer id into per-ledger offset, size and capacity columns, and its entries
+sit in a contiguous block of the value columns.
+
+Example:
+
+        store = CustomerStore()
+        jake = models.Customer(fullname, password, email, store)
+        store.last_values("balances")
+
+Attributes:
+    LEDGERS (tuple) : Names of the ledgers kept for each customer
+    EVENT_SENTINEL (tuple) : Entry stored for the 0 sentinel of the events ledger
+    default (obj:CustomerStore) : Store used when a customer is created without one
+
+Todo:
+    * Share the plan and event type labels between stores
+
+"""
+
+from array import array
+from . import helpers
+from . import money
+
+LEDGERS = ("events", "balances", "payments", "refunds", "spend")
+EVENT_SENTINEL = (0, -1, -1, 0, 1, 1, 1)
+
+
+class Ledger():
+    """A ledger holds one append-only sequence per customer in shared columns.
+
+    A customer's entries occupy a block of capacity slots starting at its
+    offset. A full block is moved to the end of the columns with twice the
+    capacity, and the holes left behind are reclaimed by compact().
+
+    Args:
+        fields (list:tup(str,str)) : Field names and array typecodes of an entry
+
+    Attributes:
+        fields (tuple)           : Field names of an entry
+        columns (list:array)     : One typed array per field
+        offsets (array)          : Index of the first entry of each customer
+        sizes (array)            : Number of entries of each customer
+        capacities (array)       : Number of slots reserved for each customer
+    """
+
+    initial_capacity = 4
+
+    def __init__(self, fields):
+        self.fields = tuple(name for name, _ in fields)
+        self.columns = [array(typecode) for _, typecode in fields]
+        self.offsets = array("q")
+        self.sizes = array("q")
+        self.capacities = array("q")
+        self.reserved = 0
+
+    def add(self, cid):
+        """Reserves a block for customer id cid"""
+        offset = self._grow(self.initial_capacity)
+        if cid == len(self.offsets):
+            self.offsets.append(offset)
+            self.sizes.append(0)
+            self.capacities.append(self.initial_capacity)
+        else:
+            self.offsets[cid] = offset
+            self.sizes[cid] = 0
+            self.capacities[cid] = self.initial_capacity
+        self.reserved += self.initial_capacity
+
+    def release(self, cid):
+        """Frees the block of customer id cid"""
+        self.reserved -= self.capacities[cid]
+        self.sizes[cid] = 0
+        self.capacities[cid] = 0
+
+    def append(self, cid, values):
+        """Appends an entry given as a tuple of field values"""
+        size = self.sizes[cid]
+        if size == self.capacities[cid]:
+            self._relocate(cid, max(2 * size, self.initial_capacity))
+        index = self.offsets[cid] + size
+        for column, value in zip(self.columns, values):
+            column[index] = value
+        self.sizes[cid] = size + 1
+
+    def get(self, cid, index):
+        """Returns the entry at a non negative index as a tuple"""
+        index += self.offsets[cid]
+        return tuple(column[index] for column in self.columns)
+
+    def set(self, cid, index, values):
+        """Overwrites the entry at a non negative index"""
+        index += self.offsets[cid]
+        for column, value in zip(self.columns, values):
+            column[index] = value
+
+    def entries(self, cid):
+        """Returns every entry of a customer as one typed array per field"""
+        offset = self.offsets[cid]
+        return [column[offset:offset + self.sizes[cid]] for column in self.columns]
+
+    def assign(self, cid, columns):
+        """Replaces every entry of a customer with typed arrays, one per field"""
+        size = len(columns[0])
+        if size > self.capacities[cid]:
+            self.sizes[cid] = 0
+            self._relocate(cid, size)
+        offset = self.offsets[cid]
+        for column, values in zip(self.columns, columns):
+            column[offset:offset + size] = values
+        self.sizes[cid] = size
+
+    def values(self, cid, field=0):
+        """Returns one field of every entry of a customer as a typed array"""
+        offset = self.offsets[cid]
+        return self.columns[field][offset:offset + self.sizes[cid]]
+
+    def compact(self):
+        """Rewrites the columns without the holes left by relocated blocks"""
+        columns = [array(column.typecode) for column in self.columns]
+        reserved = 0
+        for cid, capacity in enumerate(self.capacities):
+            offset = self.offsets[cid]
+            self.offsets[cid] = len(columns[0])
+            for new, old in zip(columns, self.columns):
+                new.extend(old[offset:offset + capacity])
+            reserved += capacity
+        self.columns = columns
+        self.reserved = reserved
+
+    def _grow(self, slots):
+        """Extends every column by zeroed slots and returns the first new index"""
+        offset = len(self.columns[0])
+        for column in self.columns:
+            column.frombytes(bytes(column.itemsize * slots))
+        return offset
+
+    def _relocate(self, cid, capacity):
+        """Moves a full block to the end of the columns with a larger capacity"""
+        if len(self.columns[0]) > 2 * self.reserved + 4096:
+            self.compact()
+        offset, size = self.offsets[cid], self.sizes[cid]
+        new_offset = self._grow(capacity)
+        for column in self.columns:
+            column[new_offset:new_offset + size] = column[offset:offset + size]
+        self.reserved += capacity - self.capacities[cid]
+        self.offsets[cid] = new_offset
+        self.capacities[cid] = capacity
+
+
+class CustomerStore():
+    """A customer store keeps the ledgers of many customers in typed columns.
+
+    Events are stored as (epoch seconds, plan label, event type label) along
+    with the number of active websites and the sizes of the payments, refunds
+    and spend ledgers right after the event, so report rows can be derived
+    later. The money ledgers hold integer cents. Every ledger starts with the
+    0 sentinel that models.Customer has always used.
+
+    Attributes:
+        events (obj:Ledger)      : Event timestamps, labels, site count and ledger sizes
+        balances (obj:Ledger)    : Account value after each event
+        payments (obj:Ledger)    : Payments of each customer
+        refunds (obj:Ledger)     : Refunds of each customer
+        spend (obj:Ledger)       : Spend at the time of each plan change
+        labels (list:str)        : Plan names and event types indexed by label
+        names (list:str)         : Name of the customer holding each id, None once released
+        observers (list)         : Called with (store, cid, entry) after every logged event, and with
+                                   entry None before an id is released
+    """
+
+    def __init__(self):
+        self.events = Ledger([("time", "q"), ("plan", "h"), ("type", "h"), ("sites", "q"),
+                              ("payments", "q"), ("refunds", "q"), ("spend", "q")])
+        self.balances = Ledger([("value", "q")])
+        self.payments = Ledger([("value", "q")])
+        self.refunds = Ledger([("value", "q")])
+        self.spend = Ledger([("value", "q")])
+        self.labels = []
+        self.label_codes = {}
+        self.free = []
+        self.count = 0
+        self.names = []
+        self.observers = []
+
+    def add(self, name=None):
+        """Returns the id of a new customer named name with sentinel ledgers"""
+        if self.free:
+            cid = self.free.pop()
+            self.names[cid] = name
+        else:
+            cid = self.count
+            self.count += 1
+            self.names.append(name)
+        for name in LEDGERS:
+            ledger = getattr(self, name)
+            ledger.add(cid)
+            ledger.append(cid, EVENT_SENTINEL if name == "events" else (0,))
+        return cid
+
+    def release(self, cid):
+        """Frees the ledgers of a customer id so that it can be reused"""
+        for observer in self.observers:
+            observer(self, cid, None)
+        for name in LEDGERS:
+            getattr(self, name).release(cid)
+        self.names[cid] = None
+        self.free.append(cid)
+
+    def label(self, text):
+        """Returns the integer code of a plan name or event type"""
+        code = self.label_codes.get(text)
+        if code is None:
+            code = self.label_codes[text] = len(self.labels)
+            self.labels.append(text)
+        return code
+
+    def event_entry(self, cid, tim, plan, type, sites):
+        """Returns an events ledger entry recording the current ledger sizes of a customer"""
+        return (tim, self.label(plan), self.label(type), sites, self.payments.sizes[cid],
+                self.refunds.sizes[cid], self.spend.sizes[cid])
+
+    def log_event(self, cid, tim, plan, type, sites):
+        """Appends an event given as epoch seconds, plan name, event type and active site count"""
+        entry = self.event_entry(cid, tim, plan, type, sites)
+        self.events.append(cid, entry)
+        for observer in self.observers:
+            observer(self, cid, entry)
+
+    def last(self, name, cid):
+        """Returns the last value of a money ledger of a customer in cents"""
+        ledger = getattr(self, name)
+        return ledger.columns[0][ledger.offsets[cid] + ledger.sizes[cid] - 1]
+
+    def append(self, name, cid, cents):
+        """Appends cents to a money ledger of a customer"""
+        getattr(self, name).append(cid, (cents,))
+
+    def last_cents(self, name):
+        """Returns the last value of a money ledger for every customer id as a NumPy array of cents"""
+        import numpy as np  # Only the array queries need NumPy, the store itself is built on array
+        ledger = getattr(self, name)
+        values = np.frombuffer(ledger.columns[0], dtype=np.int64)
+        offsets = np.frombuffer(ledger.offsets, dtype=np.int64)
+        sizes = np.frombuffer(ledger.sizes, dtype=np.int64)
+        return np.where(sizes > 0, values[offsets + np.maximum(sizes - 1, 0)], 0)
+
+    def last_values(self, name):
+        """Returns the last value of a money ledger for every customer id as a NumPy array of dollars"""
+        return money.to_dollars(self.last_cents(name))
+
+    def compact(self):
+        """Reclaims the space left by relocated and released ledgers"""
+        for name in LEDGERS:
+            getattr(self, name).compact()
+
+
+class LedgerView():
+    """A list-like view over one customer's ledger in a CustomerStore.
+
+    Supports len, indexing, slicing, iteration, item assignment and append so
+    that code written against the original lists keeps working. Slices are
+    returned as lists. Money ledgers are read and written in dollars and
+    stored in cents.
+
+    Args:
+        store (obj:CustomerStore) : Store holding the ledger
+        name (str)                : One of LEDGERS
+        cid (int)                 : Customer id
+    """
+
+    __slots__ = ("store", "ledger", "cid", "is_events")
+
+    def __init__(self, store, name, cid):
+        self.store = store
+        self.ledger = getattr(store, name)
+        self.cid = cid
+        self.is_events = name == "events"
+
+    def __len__(self):
+        return self.ledger.sizes[self.cid]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._decode(self.ledger.get(self.cid, self._index(index)))
+
+    def __setitem__(self, index, value):
+        self.ledger.set(self.cid, self._index(index), self._encode(value))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (LedgerView, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, value):
+        """Appends an entry to the end of the ledger"""
+        self.ledger.append(self.cid, self._encode(value))
+
+    def _index(self, index):
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("ledger index out of range")
+        return index
+
+    def _encode(self, value):
+        if not self.is_events:
+            return (money.to_cents(value),)
+        if value == 0:
+            return EVENT_SENTINEL
+        when, plan, type = value
+        return self.store.event_entry(self.cid, helpers.datetime_to_time(when), plan, type, 0)
+
+    def _decode(self, entry):
+        if not self.is_events:
+            return money.to_dollars(entry[0])
+        when, plan, type = entry[:3]
+        if plan < 0:
+            return 0
+        labels = self.store.labels
+        return (helpers.time_to_datetime(when), labels[plan], labels[type])
+
+
+default = CustomerStore()
@@ -5,7 +5,7 @@ objects and their methods. In this example, a user selects a plan and
 
 Example:
 
-        $ python subscribersim.py
+        $ subscribersim demo
 
 Attributes:
     No module level variables.
@@ -15,13 +15,14 @@ To do:
 
 """
 
-import models
-import helpers
+from . import models
+from . import helpers
 
 start_amy = "Plus"
 start_jak = "Infinite"
 
-if (__name__ == '__main__'):
+
+def main():
     """Jake is a character from the show Brooklyn 99. His website, password choices
     and subscription change frequency reveal who he is.
     """
@@ -50,3 +51,7 @@ if (__name__ == '__main__'):
     print (jake)
 
     jake.print_table()
+
+
+if (__name__ == '__main__'):
+    main()
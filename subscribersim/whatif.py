@@ -0,0 +1,168 @@
+"""What-if
+
+This module reprices recorded histories under an alternative catalog. The
+events ledger of a customer holds everything proration depends on: the time,
+plan and type of every event. Site counts never change an amount, so a
+history can be repriced without rerunning the Customer methods.
+
+Only customers whose events reference a plan whose price or site limit
+changed are repriced, the others would pay exactly the same. Their histories
+are laid out as one row per customer and one column per event, and the
+columns are prorated left to right with the array kernel money.prorate that
+proration.prorate runs, so every customer's k-th event is repriced in one
+pass.
+
+Example:
+
+        catalog = models.Catalog.load("plans-2020.json")
+        for row in diff(customers, catalog):
+            print(row.plan, row.change)
+
+        $ subscribersim whatif plans-2020.json events.jsonl
+
+Attributes:
+    START (int)         : Event code of a plan selection
+    MOVE (int)          : Event code of a plan change
+    RENEWAL (int)       : Event code of a renewal
+    CODES (dict)        : Maps an event type to its code, every other type is a MOVE
+    History (type)      : Recorded events of customers as (customers, events) arrays
+    Repricing (type)    : Per event amounts in cents under an alternative catalog
+    Diff (type)         : Revenue of one plan before and after repricing, in dollars
+
+"""
+
+from collections import namedtuple
+import numpy as np
+from . import epochs
+from . import models
+from . import money
+
+START, MOVE, RENEWAL = 0, 1, 2
+CODES = {"start": START, "renewal": RENEWAL}
+
+Repricing = namedtuple("Repricing", ["customers", "plans", "payments", "refunds", "kinds", "balances"])
+Diff = namedtuple("Diff", ["plan", "paid", "refunded", "repriced_paid", "repriced_refunded", "change"])
+History = namedtuple("History", ["times", "plans", "types", "lengths", "payments", "refunds"])
+
+
+def changed_plans(catalog, base=None):
+    """Returns the names of the plans whose price or site limit differ between two catalogs
+
+    Args:
+        catalog (obj:Catalog) : Alternative catalog
+        base (obj:Catalog)    : Catalog the histories were recorded with, the installed one if None
+    """
+    base = models.Plan.catalog if base is None else base
+    return {name for name in set(base.plans) | set(catalog.plans) if base.plans.get(name) != catalog.plans.get(name)}
+
+
+def affected(customers, plans):
+    """Returns the customers with an event on one of plans, in order"""
+    touched, codes = [], {}
+    for customer in customers:
+        store = customer.store
+        wanted = codes.get(id(store))
+        if wanted is None:
+            wanted = codes[id(store)] = {store.label_codes[name] for name in plans if name in store.label_codes}
+        events = store.events
+        offset = events.offsets[customer.id]
+        if wanted and not wanted.isdisjoint(events.columns[1][offset + 1:offset + events.sizes[customer.id]]):
+            touched.append(customer)
+    return touched
+
+
+def histories(customers, catalog):
+    """Returns the recorded events of customers as a History of (customers, events) arrays
+
+    Plans are ids of catalog, padding entries are -1. payments and refunds
+    hold the cents logged by each event. Raises an exception if an event is on
+    a plan missing from catalog.
+    """
+    lengths = np.array([c.store.events.sizes[c.id] - 1 for c in customers], dtype=np.int64)
+    shape = (len(customers), int(lengths.max()) if len(customers) else 0)
+    times = np.zeros(shape, dtype=np.int64)
+    plans = np.full(shape, -1, dtype=np.int64)
+    types = np.zeros(shape, dtype=np.int8)
+    payments = np.zeros(shape, dtype=np.int64)
+    refunds = np.zeros(shape, dtype=np.int64)
+
+    for row, customer in enumerate(customers):
+        store, cid = customer.store, customer.id
+        labels, n = store.labels, lengths[row]
+        tims, names, kinds, _, paid, refunded, _ = store.events.entries(cid)
+        logged_payments, logged_refunds = store.payments.values(cid), store.refunds.values(cid)
+        times[row, :n] = tims[1:]
+        plans[row, :n] = [catalog.plan(labels[code]).id for code in names[1:]]
+        types[row, :n] = [CODES.get(labels[code], MOVE) for code in kinds[1:]]
+        payments[row, :n] = [logged_payments[paid[i] - 1] if paid[i] > paid[i - 1] else 0 for i in range(1, n + 1)]
+        refunds[row, :n] = [logged_refunds[refunded[i] - 1] if refunded[i] > refunded[i - 1] else 0
+                            for i in range(1, n + 1)]
+    return History(times, plans, types, lengths, payments, refunds)
+
+
+def reprice(customers, catalog):
+    """Returns the Repricing of the recorded histories of customers under catalog"""
+    return _reprice(customers, histories(customers, catalog), catalog)
+
+
+def _reprice(customers, history, catalog):
+    """Prorates the events of a History column by column with catalog prices"""
+    times, plans, types, lengths = history.times, history.plans, history.types, history.lengths
+    prices = catalog.cents_array()
+    payments = np.zeros(plans.shape, dtype=np.int64)
+    refunds = np.zeros(plans.shape, dtype=np.int64)
+    kinds = np.full(plans.shape, -1, dtype=np.int8)
+    balances = np.zeros(len(customers), dtype=np.int64)
+
+    for k in range(plans.shape[1]):
+        live = lengths > k
+        price = prices[np.maximum(plans[:, k], 0)]
+        # A selection or a renewal charges the plan price
+        charged = live & (types[:, k] != MOVE)
+        payments[charged, k] = price[charged]
+
+        moved = np.flatnonzero(live & (types[:, k] == MOVE))
+        if moved.size:
+            now = times[moved, k]
+            _, _, kind, payment, refund = money.prorate(
+                prices[plans[moved, k - 1]], balances[moved], now - times[moved, k - 1],
+                epochs.seconds_in_year_array(now), price[moved])
+            payments[moved, k] = payment
+            refunds[moved, k] = refund
+            kinds[moved, k] = kind
+        balances[live] = price[live]
+    return Repricing(list(customers), plans, payments, refunds, kinds, balances)
+
+
+def diff(customers, catalog, base=None):
+    """Returns the revenue of every plan before and after repricing under catalog
+
+    Amounts are attributed to the plan of the event that logged them and only
+    cover the affected customers, every other customer pays the same under
+    both catalogs.
+
+    Returns:
+        A list of Diff rows in catalog order, one per plan with any amount.
+    """
+    touched = affected(customers, changed_plans(catalog, base))
+    history = histories(touched, catalog)
+    result = _reprice(touched, history, catalog)
+
+    size = len(catalog.names)
+    live = history.plans >= 0
+    ids = history.plans[live]
+
+    def per_plan(values):
+        totals = np.zeros(size, dtype=np.int64)
+        np.add.at(totals, ids, values[live])
+        return totals
+
+    paid, refunded = per_plan(history.payments), per_plan(history.refunds)
+    repriced_paid, repriced_refunded = per_plan(result.payments), per_plan(result.refunds)
+    change = (repriced_paid - repriced_refunded) - (paid - refunded)
+    rows = []
+    for i, name in enumerate(catalog.names):
+        amounts = (paid[i], refunded[i], repriced_paid[i], repriced_refunded[i], change[i])
+        if any(amounts):
+            rows.append(Diff(name, *(money.to_dollars(int(cents)) for cents in amounts)))
+    return rows
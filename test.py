@@ -11,10 +11,45 @@ Attributes:
 
 """
 import os, sys
-sys.path.append(os.path.join(os.path.dirname(__file__), "subscribersim"))
 import unittest
-from subscribersim.models import Customer, Plan
-import helpers
+from subscribersim.models import Customer, Plan, Catalog
+from subscribersim import helpers
+from subscribersim import proration
+from subscribersim import epochs
+import time
+import io
+from subscribersim import replay
+from subscribersim import runner
+from subscribersim import report
+from subscribersim import sites
+import bench
+from subscribersim import metrics
+from subscribersim import montecarlo
+from subscribersim import money
+from subscribersim import snapshot
+from subscribersim import database
+from subscribersim import ledgerfile
+from subscribersim import service
+from subscribersim import renewals
+from subscribersim import history
+from subscribersim import rollups
+from subscribersim import scenario
+from subscribersim import registry
+from subscribersim import whatif
+from subscribersim import quotes
+from subscribersim import flips
+import asyncio
+import json
+import csv
+import tempfile
+import subprocess
+import threading
+import random
+from unittest import mock
+from subscribersim import cli
+from subscribersim.store import CustomerStore
+from datetime import datetime, timedelta
+from collections import Counter
 
 
 class TestCustomer(unittest.TestCase):
@@ -137,7 +172,9 @@ class TestCustomer(unittest.TestCase):
 
         self.assertEqual(person.spend[-1],spend,"Incorrect spend")
         self.assertEqual(person.balances[-1],person.current_plan.price,"Incorrent balance")
-        self.assertEqual(person.balances[-1], (person.balances[-2] - person.spend[-1] - person.refunds[-1]), "Refund incorrect")
+        self.assertEqual(money.to_cents(person.balances[-1]),
+                         money.to_cents(person.balances[-2]) - money.to_cents(person.spend[-1]) - money.to_cents(person.refunds[-1]),
+                         "Refund incorrect")
 
         #person.print_table()
 
@@ -195,5 +232,1344 @@ class TestCustomer(unittest.TestCase):
         #person.print_table()
 
 
+class TestProration(unittest.TestCase):
+    """Batch proration must agree with Customer.move_to_plan"""
+
+    def _population(self):
+        """Creates customers on every plan with a few websites each"""
+        start = datetime(2019, 1, 15, 10, 30, 0)
+        people = []
+        for i, plan in enumerate(["Single", "Plus", "Infinite"] * 4):
+            person = Customer(f"Customer {i}", "secret", f"customer{i}@99.com")
+            person.select_plan(plan, helpers.datetime_months_hence(start, i))
+            for n in range(min(i % 4, Plan.plans[plan][0] or 3)):
+                person.add_website(f"site{i}-{n}.com", False)
+            people.append(person)
+        return people
+
+    def test_prorate_batch_matches_move_to_plan(self):
+        """Prorates a population in one batch and one customer at a time.
+
+        Verifies that every ledger matches after upgrades and downgrades.
+        """
+        serial, batched = self._population(), self._population()
+        targets = ["Infinite", "Single", "Plus"] * 4
+        times = [helpers.datetime_months_hence(p.events[-1][0], 1 + i % 11) for i, p in enumerate(serial)]
+
+        for person, plan, now in zip(serial, targets, times):
+            person.move_to_plan(plan, now)
+        result = proration.prorate_batch(batched, targets, times)
+        proration.apply_batch(batched, targets, times, result)
+
+        for a, b in zip(serial, batched):
+            self.assertEqual(a.events, b.events, "Events differ")
+            self.assertEqual(a.spend, b.spend, "Spend differs")
+            self.assertEqual(a.payments, b.payments, "Payments differ")
+            self.assertEqual(a.refunds, b.refunds, "Refunds differ")
+            self.assertEqual(a.balances, b.balances, "Balances differ")
+            self.assertEqual(a.website_count, b.website_count, "Sites differ")
+
+    def test_repeated_customer(self):
+        """Moves a customer twice in one batch and one move at a time.
+
+        Verifies that prorate_batch rejects the batch and that move_batch
+        prices the second move from the ledgers the first one left.
+        """
+        serial, batched = self._population()[:2], self._population()[:2]
+        targets = ["Plus", "Single", "Infinite"]
+        times = [datetime(2019, 3, 1), datetime(2019, 4, 1), datetime(2019, 6, 1)]
+        for person, plan, now in zip([serial[0], serial[1], serial[0]], targets, times):
+            person.move_to_plan(plan, now)
+        customers = [batched[0], batched[1], batched[0]]
+        with self.assertRaises(Exception):
+            proration.prorate_batch(customers, targets, times)
+        result = proration.move_batch(customers, targets, times)
+
+        expected = [serial[0].payments[-2], 0, serial[0].payments[-1]]
+        self.assertEqual(money.to_dollars(result.payments).tolist(), expected, "Payments incorrect")
+        for a, b in zip(serial, batched):
+            self.assertEqual(a.events, b.events, "Events differ")
+            self.assertEqual(a.spend, b.spend, "Spend differs")
+            self.assertEqual(a.payments, b.payments, "Payments differ")
+            self.assertEqual(a.refunds, b.refunds, "Refunds differ")
+            self.assertEqual(a.balances, b.balances, "Balances differ")
+
+    def test_transfer(self):
+        """Moves a customer whose balance equals the new plan price."""
+        person = Customer("Gina Linetti", "thegina", "gina@99.com")
+        person.select_plan("Single", datetime(2019, 3, 1))
+        person.balances[-1] = Plan.plans["Plus"][1]
+
+        result = proration.prorate_batch([person], ["Plus"], [datetime(2019, 3, 1)])
+        self.assertEqual(result.kinds[0], proration.TRANSFER, "Not a transfer")
+
+        person.move_to_plan("Plus", datetime(2019, 3, 1))
+        self.assertEqual(person.events[-1][2], "transfer", "Transfer not logged")
+        self.assertEqual(person.balances[-1], Plan.plans["Plus"][1], "Incorrect balance")
+
+    def test_cent_kernel(self):
+        """Prorates random plan changes one at a time and as arrays.
+
+        Verifies that both agree, that spend is rounded half up and that
+        balance, spend, payment and refund add up to the cent.
+        """
+        rng = proration.np.random.default_rng(5)
+        args = [rng.integers(0, 30000, 500), rng.integers(0, 30000, 500), rng.integers(0, 31622400, 500),
+                rng.choice([31536000, 31622400], 500), rng.integers(0, 30000, 500)]
+        batch = money.prorate(*args)
+        for i in range(500):
+            scalar = money.prorate(*(int(a[i]) for a in args))
+            self.assertEqual(scalar, tuple(int(b[i]) for b in batch), "Batch differs")
+            spent, current, kind, payment, refund = scalar
+            self.assertEqual(current + payment - refund, args[4][i], "Amounts do not add up")
+            self.assertEqual(money.KINDS[kind], "upgrade" if payment else "downgrade" if refund else "transfer")
+        self.assertEqual(money.spend(100, 1, 200), 1, "Half cent not rounded up")
+        self.assertEqual(money.spend(100, 1, 201), 0, "Below half cent rounded up")
+        self.assertEqual(money.to_dollars(money.to_cents(41.83)), 41.83, "Dollar view differs")
+
+    def test_reordered_catalog(self):
+        """Moves customers selected under the default catalog after installing a reordered one"""
+        default = Plan.catalog
+        people = [Customer(f"Gina {i}", "", "") for i in range(2)]
+        for person in people:
+            person.select_plan("Single", datetime(2019, 1, 1))
+        try:
+            Catalog({name: default.plans[name] for name in ("Infinite", "Plus", "Single")}).install()
+            when = datetime(2019, 3, 1)
+            result = proration.prorate_batch(people[:1], ["Plus"], [when])
+            proration.apply_batch(people[:1], ["Plus"], [when], result)
+            people[1].move_to_plan("Plus", when)
+        finally:
+            default.install()
+        self.assertEqual(people[0].payments[-1], people[1].payments[-1], "Batch differs after reordering")
+        self.assertEqual(people[1].payments[-1], 57.9, "Payment incorrect")
+
+
+class TestCustomerStore(unittest.TestCase):
+    """Ledgers kept in a CustomerStore must behave like the original lists"""
+
+    def test_ledgers_grow_past_capacity(self):
+        """Interleaves plan changes of two customers sharing a store.
+
+        Verifies that relocated ledgers keep their entries and the 0 sentinel.
+        """
+        store = CustomerStore()
+        rosa = Customer("Rosa Diaz", "summerskiss", "rosadiaz@99.com", store)
+        gina = Customer("Gina Linetti", "thegina", "gina@99.com", store)
+        now = datetime(2019, 1, 1, 9, 0, 0)
+        rosa.select_plan("Single", now)
+        gina.select_plan("Infinite", now)
+
+        plans = ["Plus", "Infinite", "Single"]
+        for i in range(12):
+            now = helpers.datetime_months_hence(now, 1)
+            rosa.move_to_plan(plans[i % 3], now)
+            gina.move_to_plan(plans[(i + 2) % 3], now)
+
+        self.assertEqual(rosa.events[0], 0, "Sentinel lost")
+        self.assertEqual(len(rosa.events[1:]), 13, "Event count incorrect")
+        self.assertEqual(rosa.events[-1][:2], (now, "Single"), "Last event incorrect")
+        self.assertEqual(gina.events[1][1], "Infinite", "First event incorrect")
+        self.assertEqual(list(store.last_values("balances")), [rosa.balances[-1], gina.balances[-1]])
+
+    def test_release_and_compact(self):
+        """Releases a customer and compacts the store.
+
+        Verifies that the id is reused and the remaining ledger is intact.
+        """
+        store = CustomerStore()
+        holt = Customer("Raymond Holt", "gerdieforlife", "cptrayholt@99.com", store)
+        kevin = Customer("Kevin Cozner", "cheddar", "kcozner@99.com", store)
+        kevin.select_plan("Plus", datetime(2019, 6, 1))
+        released = holt.id
+        del holt
+        store.compact()
+
+        amy = Customer("Amy Santiago", "deweydecimal", "amysantiago@99.com", store)
+        self.assertEqual(amy.id, released, "Id not reused")
+        self.assertEqual(len(amy.payments), 1, "Ledger not reset")
+        self.assertEqual(kevin.payments, [0, 99], "Ledger corrupted")
+        self.assertFalse(hasattr(kevin, "__dict__"), "Customer is not slotted")
+
+
+class TestEpochs(unittest.TestCase):
+    """The epoch second kernel must agree with the helpers functions"""
+
+    def setUp(self):
+        self.zone = os.environ.get("TZ")
+        os.environ["TZ"] = "America/New_York"
+        time.tzset()
+        epochs.reset()
+
+    def tearDown(self):
+        if self.zone is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = self.zone
+        time.tzset()
+        epochs.reset()
+
+    def _timestamps(self):
+        """Returns hourly timestamps around month ends and daylight saving transitions
+
+        Repeated wall clock times are skipped, helpers cannot round trip them.
+        """
+        stamps = []
+        for day in [(2019, 1, 31), (2019, 3, 10), (2019, 8, 31), (2019, 11, 3), (2020, 2, 29), (2020, 3, 8)]:
+            start = helpers.datetime_to_time(datetime(*day))
+            stamps.extend(range(start - 7200, start + 30 * 3600, 3593))
+        wall = helpers.time_to_datetime
+        return [t for t in stamps if wall(t) not in (wall(t - 3600), wall(t + 3600))]
+
+    def test_months_hence(self):
+        """Verifies month-end clamping and transition days against datetime_months_hence"""
+        for months in (1, 4, 12):
+            vector = epochs.months_hence_array(self._timestamps(), months)
+            for tim, fast in zip(self._timestamps(), vector.tolist()):
+                prev = helpers.time_to_datetime(tim)
+                expected = helpers.datetime_months_hence(prev, months)
+                self.assertEqual(epochs.datetime_months_hence(prev, months), expected, "Scalar differs")
+                self.assertEqual(helpers.time_to_datetime(fast), expected, "Vector differs")
+
+    def test_seconds_in_year(self):
+        """Verifies year lengths against get_seconds_in_current_year"""
+        vector = epochs.seconds_in_year_array(self._timestamps())
+        for tim, fast in zip(self._timestamps(), vector.tolist()):
+            expected = helpers.get_seconds_in_current_year(helpers.time_to_datetime(tim))
+            self.assertEqual(epochs.get_seconds_in_current_year(helpers.time_to_datetime(tim)), expected)
+            self.assertEqual(epochs.seconds_in_year(tim), expected, "Scalar differs")
+            self.assertEqual(fast, expected, "Vector differs")
+
+
+class TestReplay(unittest.TestCase):
+    """Replaying a log must match calling the Customer methods directly"""
+
+    LOG = "\n".join([
+        '{"customer": "jake", "action": "select_plan", "time": "2019-01-10T09:00:00", "plan": "Infinite"}',
+        '{"customer": "jake", "action": "add_website", "time": "2019-01-10T09:05:00", "url": "superdupercop.com", "database": true}',
+        '{"customer": "jake", "action": "add_website", "time": "2019-01-10T09:06:00", "url": "iamjohnmclane.com"}',
+        '{"customer": "amy", "action": "select_plan", "time": "2019-02-01T12:00:00", "plan": "Plus"}',
+        '{"customer": "jake", "action": "move_to_plan", "time": "2019-05-10T09:00:00", "plan": "Single"}',
+        '{"customer": "jake", "action": "close", "time": "2019-05-10T09:00:00"}',
+        '{"customer": "amy", "action": "move_to_plan", "time": "2020-06-01T12:00:00", "plan": "Infinite"}',
+    ])
+
+    def test_replay_matches_methods(self):
+        """Replays a JSON lines log and the same events by hand.
+
+        Verifies the summaries and that closed customers are emitted first.
+        """
+        jake = Customer("jake", "", "")
+        jake.select_plan("Infinite", datetime(2019, 1, 10, 9))
+        jake.add_website("superdupercop.com", True)
+        jake.add_website("iamjohnmclane.com", False)
+        jake.move_to_plan("Single", datetime(2019, 5, 10, 9))
+
+        customers = list(replay.replay(replay.read_jsonl(io.StringIO(self.LOG))))
+        self.assertEqual([c.name for c in customers], ["jake", "amy"], "Emitted out of order")
+        self.assertEqual(replay.summarize(customers[0]), replay.summarize(jake), "Summary differs")
+        self.assertEqual(customers[1].events[-1][2], "upgrade", "Event not applied")
+
+    def test_retire_idle_customers(self):
+        """Retires a customer after a year of log time without events.
+
+        Verifies that jake is emitted before the log is fully consumed.
+        """
+        log = [line.replace('"jake", "action": "close"', '"jake", "action": "remove_website"') for line in self.LOG.splitlines()]
+        log.append('{"customer": "amy", "action": "add_website", "time": "2020-06-02T12:00:00", "url": "laminateheaven.com"}')
+        read = []
+
+        def events():
+            for event in replay.read_jsonl(log):
+                read.append(event)
+                yield event
+
+        for customer in replay.replay(events(), retire_after=365 * 86400):
+            if customer.name == "jake":
+                self.assertEqual(len(read), len(log) - 1, "Not retired after a year")
+                break
+
+    def test_event_after_retirement(self):
+        """Verifies that an event for a retired customer is reported instead of starting a plan-less customer"""
+        log = ['{"customer": "jake", "action": "select_plan", "time": "2019-01-01T09:00:00", "plan": "Single"}',
+               '{"customer": "amy", "action": "select_plan", "time": "2020-02-01T09:00:00", "plan": "Plus"}',
+               '{"customer": "jake", "action": "move_to_plan", "time": "2020-03-01T09:00:00", "plan": "Plus"}']
+        with self.assertRaisesRegex(Exception, "without a plan"):
+            list(replay.replay(replay.read_jsonl(log), retire_after=365 * 86400))
+
+        errors = []
+        customers = list(replay.replay(replay.read_jsonl(log), retire_after=365 * 86400,
+                                       on_error=lambda event, exc: errors.append(event.customer)))
+        self.assertEqual(errors, ["jake"], "Retired event not reported")
+        self.assertEqual([c.name for c in customers], ["jake", "amy"], "History split")
+
+    def test_csv_log(self):
+        """Verifies that a CSV log produces the same summaries as JSON lines"""
+        rows = [",".join(replay.FIELDS)]
+        for event in replay.read_jsonl(self.LOG.splitlines()):
+            rows.append(",".join([event.customer, event.action, event.time.isoformat(), event.plan or "",
+                                  event.url or "", str(event.database)]))
+        from_csv = [replay.summarize(c) for c in replay.replay(replay.read_csv(rows))]
+        from_jsonl = [replay.summarize(c) for c in replay.replay(replay.read_jsonl(self.LOG.splitlines()))]
+        self.assertEqual(from_csv, from_jsonl, "CSV log differs")
+
+
+def write_log(path, customers=40, moves=6):
+    """Writes a JSON lines log of customers interleaved by time and returns its path"""
+    plans = ["Single", "Plus", "Infinite"]
+    start = datetime(2019, 1, 1, 8, 0, 0)
+    lines = []
+    for step in range(moves + 1):
+        for c in range(customers):
+            when = helpers.datetime_months_hence(start, step).replace(minute=c % 60)
+            plan = plans[(c + step * (c % 3 + 1)) % 3]
+            record = {"customer": f"c{c:03}", "time": when.isoformat(), "plan": plan}
+            if step == 0:
+                record["action"] = "select_plan"
+            elif plan == plans[(c + (step - 1) * (c % 3 + 1)) % 3]:
+                record.update(action="add_website", url=f"c{c}-{step}.com")
+            else:
+                record["action"] = "move_to_plan"
+            lines.append(json.dumps(record))
+    with open(path, "w") as log:
+        log.write("\n".join(lines) + "\n")
+    return path
+
+
+class TestRunner(unittest.TestCase):
+    """A sharded run must produce the same files as a serial run"""
+
+    def test_sharded_run_is_byte_identical(self):
+        """Replays a log with one and with two processes.
+
+        Verifies that summary.csv and ledger.csv are byte-identical.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"))
+            outputs = []
+            for workers in (1, 2):
+                out = os.path.join(directory, f"out{workers}")
+                runner.write_results(*runner.run([log], workers=workers, shards=5, chunk_size=2048), out)
+                files = []
+                for name in ("summary.csv", "ledger.csv"):
+                    with open(os.path.join(out, name), "rb") as fp:
+                        files.append(fp.read())
+                outputs.append(files)
+
+            self.assertEqual(outputs[0], outputs[1], "Sharded run differs")
+            self.assertEqual(outputs[0][0].count(b"\n"), 41, "Customers missing")
+
+    def test_csv_header_order(self):
+        """Shards a CSV log whose columns are not in FIELDS order like a serial run"""
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"))
+            path = os.path.join(directory, "events.csv")
+            columns = ["action", "time", "plan", "url", "database", "customer"]
+            with open(log) as lines, open(path, "w", newline="") as out:
+                writer = csv.DictWriter(out, columns)
+                writer.writeheader()
+                writer.writerows(dict(json.loads(line)) for line in lines)
+            serial = runner.run([path])
+            for shards in (3, 5, 8):
+                self.assertEqual(runner.run([path], workers=2, shards=shards, chunk_size=2048), serial,
+                                 "Sharded run differs")
+
+
+class TestReport(unittest.TestCase):
+    """Lazy report rows must match the rows the table used to record"""
+
+    def _jake(self, snapshots):
+        """Replays the example customer, recording a row after each plan event like _add_table_row did"""
+        def snapshot():
+            snapshots.append([jake.name, jake.events[-1][2], jake.current_plan.name, jake.plan_renewal_date,
+                              jake.website_count, len(jake.payments[1:]), jake.payments[-1], jake.spend[-1],
+                              jake.refunds[-1], jake.balances[-1]])
+
+        jake = Customer("Jake Peralta", "diehardfan", "@jakeperalta99.com")
+        jake.select_plan("Infinite", datetime(2019, 4, 2, 11, 30))
+        snapshot()
+        for url in ["superdupercop.com", "iamjohnmclane.com", "iheartpuzzles.com"]:
+            jake.add_website(url, False)
+        for plan, months in [("Single", 4), ("Plus", 2), ("Single", 4)]:
+            jake.move_to_plan(plan, helpers.datetime_months_hence(helpers.datetime_get_last_event(jake), months))
+            snapshot()
+            if plan == "Plus":
+                jake.add_website("iheartpuzzles.com", False)
+        return jake
+
+    def test_rows_match_snapshots(self):
+        """Verifies ROWS against rows recorded eagerly after each event"""
+        snapshots = []
+        jake = self._jake(snapshots)
+        self.assertEqual(jake.ROWS, [report.HEADER] + snapshots, "Rows differ")
+
+    def test_writers(self):
+        """Streams two customers to paged text, CSV and JSON lines"""
+        people = [self._jake([]), self._jake([])]
+
+        text = io.StringIO()
+        report.write_table(people, text, page_size=3)
+        self.assertEqual(text.getvalue().count("last refund"), 3, "Pages incorrect")
+
+        table = io.StringIO()
+        report.write_csv(people, table)
+        self.assertEqual(len(table.getvalue().splitlines()), 9, "CSV rows incorrect")
+
+        lines = io.StringIO()
+        report.write_jsonl(people, lines)
+        last = json.loads(lines.getvalue().splitlines()[-1])
+        self.assertEqual((last["event"], last["balance"]), ("downgrade", 49), "JSON row incorrect")
+
+
+class TestSiteRegistry(unittest.TestCase):
+    """Websites are indexed by URL per customer and across customers"""
+
+    def test_remove_and_trim(self):
+        """Removes a site by URL and downgrades an agency customer.
+
+        Verifies that the most recent sites are trimmed on downgrade.
+        """
+        person = Customer("Doug Judy", "pontiacbandit", "dougjudy@99.com")
+        person.select_plan("Infinite", datetime(2019, 1, 1))
+        for n in range(500):
+            person.add_website(f"pontiac{n}.com", False)
+
+        person.remove_website("http://pontiac7.com")
+        self.assertNotIn("http://pontiac7.com", person.websites, "Website not removed")
+        self.assertEqual(person.website_count, 499, "Website count incorrect")
+        self.assertEqual(person.websites.get("http://pontiac8.com").customer, "Doug Judy", "Owner incorrect")
+        with self.assertRaises(Exception):
+            person.add_website("pontiac8.com", False)
+
+        person.move_to_plan("Plus", datetime(2019, 2, 1))
+        self.assertEqual([w.url for w in person.websites], ["http://pontiac0.com", "http://pontiac1.com", "http://pontiac2.com"])
+
+    def test_duplicate_url_rejected(self):
+        """Adds a URL twice to one customer.
+
+        Unlike the list it replaced, the registry holds one website per URL,
+        so the second add raises and leaves the sites unchanged.
+        """
+        person = Customer("Doug Judy", "pontiacbandit", "dougjudy@99.com")
+        person.select_plan("Plus", datetime(2019, 1, 1))
+        person.add_website("pontiac.com", False)
+        with self.assertRaisesRegex(Exception, "Website exists"):
+            person.add_website("pontiac.com", False)
+        self.assertEqual([w.url for w in person.websites], ["http://pontiac.com"], "Duplicate added")
+        person.remove_website("http://pontiac.com")
+        self.assertEqual(person.website_count, 0, "Website not removed")
+
+    def test_duplicate_domains(self):
+        """Verifies that the global index finds a domain hosted by two customers"""
+        url_index = sites.UrlIndex()
+        people = [Customer(name, "", "") for name in ("Hitchcock", "Scully")]
+        for person in people:
+            person.websites = sites.SiteRegistry(person, url_index)
+            person.select_plan("Plus", datetime(2019, 1, 1))
+            person.add_website("nachos.com", False)
+        people[0].add_website("hitchcock.com", False)
+
+        self.assertEqual(list(url_index.duplicates()), ["http://nachos.com"], "Duplicate not found")
+        self.assertEqual(url_index.customers("http://nachos.com"), people, "Owners incorrect")
+        del people[1], person
+        self.assertEqual(url_index.duplicates(), {}, "Released customer still indexed")
+
+    def test_shared_domain_owners(self):
+        """Indexes one domain hosted by 2000 customers and removes them out of order.
+
+        Verifies that the remaining owners keep their order and that the URL
+        leaves the index with its last owner.
+        """
+        url_index = sites.UrlIndex()
+        people = [Customer(f"Agent {n}", "", "") for n in range(2000)]
+        for person in people:
+            person.websites = sites.SiteRegistry(person, url_index)
+            person.select_plan("Single", datetime(2019, 1, 1))
+            person.add_website("ninenine.com", False)
+
+        for person in people[1::2]:
+            person.remove_website("http://ninenine.com")
+        self.assertEqual(url_index.customers("http://ninenine.com"), people[::2], "Owners incorrect")
+        del people[:1000], person
+        self.assertEqual(url_index.customers("http://ninenine.com"), people[::2], "Released customers still indexed")
+        for person in people:
+            person.websites.clear()
+        self.assertNotIn("http://ninenine.com", url_index.owners, "URL still indexed")
+
+
+class TestCatalog(unittest.TestCase):
+    """Plans are interned by a catalog that can be loaded from a file"""
+
+    def setUp(self):
+        self.default = Plan.catalog
+
+    def tearDown(self):
+        self.default.install()
+
+    def test_plans_are_interned(self):
+        """Verifies that plan changes reuse one Plan instance per name"""
+        person = Customer("Rosa Diaz", "summerskiss", "rosadiaz@99.com")
+        person.select_plan("Single", datetime(2019, 1, 1))
+        person.move_to_plan("Plus", datetime(2019, 2, 1))
+
+        self.assertIs(person.current_plan, Plan("Plus"), "Plan not interned")
+        self.assertEqual(Plan.catalog.prices[Plan("Plus").id], 99, "Price array incorrect")
+        self.assertEqual(list(Plan.catalog.limit_array()), [1, 3, -1], "Limit array incorrect")
+        with self.assertRaises(Exception):
+            Plan("Gold")
+
+    def test_load_catalog(self):
+        """Loads a catalog with an extra plan and downgrades a customer to it."""
+        config = {"plans": [{"name": "Single", "price": 49, "max_sites": 1},
+                            {"name": "Agency", "price": 149, "max_sites": 10},
+                            {"name": "Infinite", "price": 249, "max_sites": None}]}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "plans.json")
+            with open(path, "w") as fp:
+                json.dump(config, fp)
+            Catalog.load(path).install()
+
+        person = Customer("Adrian Pimento", "scullysfriend", "pimento@99.com")
+        person.select_plan("Infinite", datetime(2019, 1, 1))
+        for n in range(12):
+            person.add_website(f"pimento{n}.com", False)
+        person.move_to_plan("Agency", datetime(2019, 1, 1))
+
+        self.assertEqual(Plan.plans["Agency"], (10, 149), "Plan.plans not updated")
+        self.assertEqual(person.refunds[-1], 100, "Refund incorrect")
+        self.assertEqual(person.website_count, 10, "Sites not trimmed")
+
+
+class TestBench(unittest.TestCase):
+    """The benchmark cases must run and regressions must be flagged"""
+
+    def test_run_and_compare(self):
+        """Runs a small case and compares it against a faster baseline"""
+        result = bench.run_case("move_to_plan", 50)
+        self.assertEqual(result["ops"], 50, "Operations incorrect")
+        self.assertLessEqual(result["p50_us"], result["p99_us"], "Percentiles incorrect")
+
+        faster = dict(result, throughput=result["throughput"] * 2)
+        self.assertEqual(len(bench.compare([result], {"results": [faster]}, 0.1)), 1, "Regression not flagged")
+        self.assertEqual(bench.compare([result], {"results": [result]}, 0.1), [], "False regression")
+
+
+class TestMetrics(unittest.TestCase):
+    """Instrumentation must count plan changes and restore the originals"""
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.registry.reset()
+
+    def test_counters_and_export(self):
+        """Downgrades and upgrades an instrumented customer.
+
+        Verifies the counters, the Prometheus snapshot and that disable restores the methods.
+        """
+        original = Customer.move_to_plan
+        metrics.enable(Customer)
+        person = Customer("Charles Boyle", "dianeweist", "charlesboyle@99.com")
+        person.select_plan("Infinite", datetime(2019, 1, 1))
+        for url in ["foodie.com", "foodcentral.com", "foodfanatic.com"]:
+            person.add_website(url, False)
+        person.move_to_plan("Single", datetime(2019, 3, 1))
+        person.move_to_plan("Plus", datetime(2019, 4, 1))
+        with self.assertRaises(Exception):
+            person.move_to_plan("Plus", datetime(2019, 5, 1))
+
+        counters = metrics.registry.summary()["counters"]
+        self.assertEqual(counters["plan_changes/downgrade"], 1, "Downgrade not counted")
+        self.assertEqual(counters["plan_changes/upgrade"], 1, "Upgrade not counted")
+        self.assertEqual(counters["websites_trimmed"], 2, "Trimmed sites not counted")
+        self.assertEqual(counters["errors/move_to_plan"], 1, "Error not counted")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.prom")
+            metrics.registry.write_prometheus(path)
+            with open(path) as fp:
+                text = fp.read()
+        self.assertIn('subscribersim_plan_changes_total{type="upgrade"} 1', text)
+        self.assertIn('subscribersim_call_seconds_count{function="move_to_plan"} 3', text)
+
+        metrics.disable()
+        self.assertIs(Customer.move_to_plan, original, "Method not restored")
+
+
+class TestMonteCarlo(unittest.TestCase):
+    """Simulated populations must follow the move_to_plan proration rules"""
+
+    MODEL = {"initial": {"Single": 0.5, "Plus": 0.3, "Infinite": 0.2},
+             "transitions": {"Single": {"Single": 0.6, "Plus": 0.3, "Infinite": 0.1},
+                             "Plus": {"Single": 0.3, "Plus": 0.4, "Infinite": 0.3},
+                             "Infinite": {"Single": 0.4, "Plus": 0.3, "Infinite": 0.3}},
+             "mean_days": 60, "sites_mean": 2.0}
+
+    def test_simulation_matches_customers(self):
+        """Replays every simulated plan change through Customer methods.
+
+        Verifies payments, refunds, balances and site counts of each customer.
+        """
+        model = montecarlo.Model.from_dict(self.MODEL)
+        steps = []
+        population = montecarlo.simulate(model, 60, 8, seed=3, record=steps)
+        names = model.catalog.names
+
+        for i in range(60):
+            plans, times, _, sites = steps[0]
+            person = Customer(f"sim{i}", "", "")
+            person.select_plan(names[plans[i]], helpers.time_to_datetime(int(times[i])))
+            for n in range(sites[i]):
+                person.add_website(f"sim{i}-{n}.com", False)
+            for plans, times, moved, _ in steps[1:]:
+                if moved[i]:
+                    person.move_to_plan(names[plans[i]], helpers.time_to_datetime(int(times[i])))
+
+            self.assertEqual(sum(person.store.payments.values(person.id)), population.paid[i], "Payments differ")
+            self.assertEqual(sum(person.store.refunds.values(person.id)), population.refunded[i], "Refunds differ")
+            self.assertEqual(money.to_cents(person.balances[-1]), population.balances[i], "Balance differs")
+            self.assertEqual(person.website_count, population.sites[i], "Sites differ")
+            self.assertEqual(len(person.events) - 1, population.events[i], "Events differ")
+
+    def test_trials_are_reproducible(self):
+        """Verifies that trials depend only on the seed"""
+        model = montecarlo.Model.from_dict(self.MODEL)
+        first = montecarlo.run_trials(model, 500, 6, trials=5, seed=11)
+        second = montecarlo.run_trials(model, 500, 6, trials=5, seed=11)
+        self.assertEqual(first["paid"].tolist(), second["paid"].tolist(), "Trials not reproducible")
+        self.assertEqual(first["subscribers"].sum(axis=1).tolist(), [500] * 5, "Subscribers lost")
+        self.assertLessEqual(montecarlo.summarize(first["paid"])["p5"], montecarlo.summarize(first["paid"])["p95"])
+
+
+class TestSnapshot(unittest.TestCase):
+    """Resuming from a snapshot must match replaying the whole log"""
+
+    def test_resume_matches_full_replay(self):
+        """Replays half a log, writes a snapshot and resumes it with the whole log.
+
+        Verifies summaries and ledger rows against a full replay.
+        """
+        def results(customers):
+            return sorted((replay.summarize(c), runner.ledger_rows(c)) for c in customers)
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"), customers=30)
+            path = os.path.join(directory, "events.snap")
+            events = list(replay.read_events(log))
+            half = len(events) // 2
+            watermark = helpers.datetime_to_time(events[half - 1].time)
+            first = [e for e in events if helpers.datetime_to_time(e.time) <= watermark]
+
+            snapshot.checkpoint(replay.replay(first), watermark).write(path)
+            restored = snapshot.Snapshot.read(path)
+            self.assertEqual(len(restored), 30, "Customers missing from snapshot")
+            self.assertEqual(results(snapshot.resume(restored, events)), results(replay.replay(events)),
+                             "Resumed replay differs")
+
+    def test_checkpoint_within_a_second(self):
+        """Takes a checkpoint halfway through the events of one second and resumes it.
+
+        Verifies that the unapplied events of that second are not dropped.
+        """
+        def results(customers):
+            return sorted((replay.summarize(c), runner.ledger_rows(c)) for c in customers)
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"), customers=30)
+            path = os.path.join(directory, "events.snap")
+            events = [e._replace(time=e.time.replace(minute=0)) for e in replay.read_events(log)]
+            first = events[:len(events) // 2]
+            watermark = helpers.datetime_to_time(first[-1].time)
+            applied = sum(helpers.datetime_to_time(e.time) == watermark for e in first)
+            self.assertLess(applied, 30, "Checkpoint not within a second")
+
+            snapshot.checkpoint(replay.replay(first), watermark, applied).write(path)
+            restored = snapshot.Snapshot.read(path)
+            self.assertEqual(results(snapshot.resume(restored, events)), results(replay.replay(events)),
+                             "Events of the watermark second dropped")
+
+
+class TestDatabase(unittest.TestCase):
+    """Customers reloaded from SQLite must match the replayed customers"""
+
+    def test_save_and_reload(self):
+        """Saves a replayed log in small batches, saves it again and reloads every customer.
+
+        Verifies summaries, ledger rows, websites and the event time index.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"), customers=25)
+            path = os.path.join(directory, "customers.db")
+            customers = list(replay.replay(replay.read_events(log)))
+            expected = {c.name: (replay.summarize(c), runner.ledger_rows(c), [w.url for w in c.websites])
+                        for c in customers}
+
+            with database.Database(path, batch_size=7) as db:
+                self.assertEqual(db.save(customers), 25, "Customers not written")
+                self.assertEqual(db.save(customers[:3]), 3, "Customers not rewritten")
+                self.assertEqual(db.connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+            with database.Database(path) as db:
+                self.assertEqual(len(db), 25, "Customers missing")
+                for name, (summary, rows, urls) in expected.items():
+                    person = db.load(name)
+                    self.assertEqual(replay.summarize(person), summary, "Summary differs")
+                    self.assertEqual(runner.ledger_rows(person), rows, "Ledger differs")
+                    self.assertEqual([w.url for w in person.websites], urls, "Websites differ")
+                start = helpers.datetime_to_time(datetime(2019, 2, 1))
+                end = helpers.datetime_to_time(datetime(2019, 3, 1))
+                february = [row for _, rows, _ in expected.values() for row in rows if row.time.startswith("2019-02")]
+                self.assertEqual(len(db.events_between(start, end)), len(february), "Time range differs")
+                self.assertRaises(Exception, db.load, "nobody")
+
+
+class TestLedgerFile(unittest.TestCase):
+    """Ledger files must round trip the event histories of customers"""
+
+    def test_append_and_map(self):
+        """Writes replayed customers in two sessions and maps the file.
+
+        Verifies events, money values and per plan totals against the customers.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"), customers=20)
+            path = os.path.join(directory, "events.ledger")
+            customers = list(replay.replay(replay.read_events(log)))
+            for part in (customers[:8], customers[8:]):
+                with ledgerfile.Writer(path) as writer:
+                    for person in part:
+                        writer.append(person)
+
+            ledger = ledgerfile.LedgerFile(path)
+            self.assertIsInstance(ledger.records, ledgerfile.np.memmap, "File not mapped")
+            self.assertEqual(len(ledger), sum(len(c.events) - 1 for c in customers), "Records missing")
+            paid = {}
+            for person in customers:
+                records = ledger.of(person.name)
+                self.assertEqual(ledger.events(person.name), person.events[1:], "Events differ")
+                self.assertEqual(money.to_dollars(records["balance"]).tolist(), person.balances[1:], "Balances differ")
+                logged = records["flags"] & ledgerfile.PAYMENT > 0
+                self.assertEqual(money.to_dollars(records["payment"][logged]).tolist(), person.payments[1:], "Payments differ")
+                logged = records["flags"] & ledgerfile.REFUND > 0
+                self.assertEqual(money.to_dollars(records["refund"][logged]).tolist(), person.refunds[1:], "Refunds differ")
+                for (_, plan, _), payment in zip(person.events[1:], records["payment"]):
+                    paid[plan] = paid.get(plan, 0) + int(payment)
+            self.assertEqual(ledger.totals_by_plan("payment"), paid, "Totals differ")
+
+    def test_readable_while_appending(self):
+        """Reopens a ledger file and reads it before the writer is closed.
+
+        Verifies that the old records stay readable during the session and
+        that closing keeps them ahead of the appended ones.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"), customers=12)
+            path = os.path.join(directory, "events.ledger")
+            customers = list(replay.replay(replay.read_events(log)))
+            with ledgerfile.Writer(path) as writer:
+                for person in customers[:5]:
+                    writer.append(person)
+            before = ledgerfile.LedgerFile(path).records.copy()
+
+            with ledgerfile.Writer(path) as writer:
+                for person in customers[5:]:
+                    writer.append(person)
+                    writer.fp.flush()
+                    ledger = ledgerfile.LedgerFile(path)
+                    self.assertEqual(ledger.records.tolist(), before.tolist(), "Old records changed before close")
+                    self.assertNotIn(person.name, ledger.customers, "Record visible before close")
+
+            ledger = ledgerfile.LedgerFile(path)
+            self.assertEqual(ledger.records[:len(before)].tolist(), before.tolist(), "Old records moved")
+            for person in customers:
+                self.assertEqual(ledger.events(person.name), person.events[1:], "Events differ")
+
+    def test_append_without_events(self):
+        """Reopens a ledger file to add customers without events, then appends records again.
+
+        Verifies that the old index is left in place until the header moves
+        and that every session reads back complete.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"), customers=6)
+            path = os.path.join(directory, "events.ledger")
+            customers = list(replay.replay(replay.read_events(log)))
+            with ledgerfile.Writer(path) as writer:
+                for person in customers[:3]:
+                    writer.append(person)
+            with open(path, "rb") as fp:
+                data = fp.read()
+
+            with ledgerfile.Writer(path) as writer:
+                pass
+            with open(path, "rb") as fp:
+                self.assertEqual(fp.read(), data, "Empty session rewrote the file")
+
+            idle = Customer("Idle", "", "")
+            with ledgerfile.Writer(path) as writer:
+                writer.append(idle)
+            with open(path, "rb") as fp:
+                fp.seek(ledgerfile.HEADER_SIZE)
+                self.assertEqual(fp.read(len(data) - ledgerfile.HEADER_SIZE), data[ledgerfile.HEADER_SIZE:],
+                                 "Old index rewritten in place")
+            self.assertEqual(ledgerfile.LedgerFile(path).of("Idle").size, 0, "Customer without events missing")
+
+            with ledgerfile.Writer(path) as writer:
+                for person in customers[3:]:
+                    writer.append(person)
+            ledger = ledgerfile.LedgerFile(path)
+            for person in customers:
+                self.assertEqual(ledger.events(person.name), person.events[1:], "Events differ")
+
+
+class TestService(unittest.TestCase):
+    """Micro-batched requests must leave customers as serial calls would"""
+
+    def test_load_matches_serial(self):
+        """Runs the load generator against a service on a unix socket.
+
+        Verifies that there are no errors, that requests were coalesced and
+        that every customer matches a serial replay of the same workload.
+        """
+        async def run(path):
+            served = service.Service(shards=3)
+            server = await service.serve(served, path=path)
+            stats = await service.load(path=path, customers=60, requests=600, connections=4, window=32)
+            server.close()
+            await served.stop()
+            return served, stats
+
+        with tempfile.TemporaryDirectory() as directory:
+            served, stats = asyncio.run(run(os.path.join(directory, "service.sock")))
+
+        self.assertEqual((stats["requests"], stats["errors"]), (600, 0), "Requests failed")
+        self.assertLess(served.batches, served.requests, "Requests not coalesced")
+        events = [replay.make_event(request) for request in service.workload(60, 600)]
+        serial = {c.name: (replay.summarize(c), runner.ledger_rows(c)) for c in replay.replay(events)}
+        for key, person in served.customers.items():
+            self.assertEqual((replay.summarize(person), runner.ledger_rows(person)), serial[key], "Customer differs")
+        self.assertEqual(len(served.customers), 60, "Customers missing")
+
+    def test_errors_keep_serving(self):
+        """Sends a line that is not a JSON object and a batch whose proration fails.
+
+        Verifies that both are answered with errors and that the connection
+        and the shard keep serving.
+        """
+        async def run(path):
+            served = service.Service(shards=1)
+            server = await service.serve(served, path=path)
+            reader, writer = await asyncio.open_unix_connection(path)
+            select = {"action": "select_plan", "customer": "jake", "plan": "Single", "time": "2019-01-01T09:00:00"}
+            move = {"action": "move_to_plan", "customer": "jake", "plan": "Plus", "time": "2019-03-01T09:00:00"}
+            responses = []
+            for request in (5, dict(select, id=1), dict(move, id=2), dict(move, id=3, plan="Infinite")):
+                writer.write(json.dumps(request).encode() + b"\n")
+                responses.append(json.loads(await asyncio.wait_for(reader.readline(), 5)))
+            writer.close()
+            server.close()
+            await served.stop()
+            return responses
+
+        apply_batch, calls = proration.apply_batch, []
+
+        def flaky(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise Exception("apply failed")
+            return apply_batch(*args)
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(proration, "apply_batch", flaky):
+            responses = asyncio.run(run(os.path.join(directory, "service.sock")))
+        self.assertEqual([(r["id"], r["ok"]) for r in responses], [(None, False), (1, True), (2, False), (3, True)],
+                         "Responses incorrect")
+        self.assertEqual(responses[2]["error"], "apply failed", "Error not reported")
+
+
+class TestRenewals(unittest.TestCase):
+    """Advancing the scheduler must charge every due renewal once"""
+
+    def test_advance_renews_due_customers(self):
+        """Schedules customers signed up over a year, moves some and advances in steps.
+
+        Verifies renewal events, payments and balances, and that plan changes
+        postpone the renewal instead of charging twice.
+        """
+        start = datetime(2019, 1, 10, 9, 0, 0)
+        people = []
+        for i in range(24):
+            person = Customer(f"renew{i}", "", "")
+            person.select_plan(["Single", "Plus", "Infinite"][i % 3], helpers.datetime_months_hence(start, i // 2))
+            people.append(person)
+        scheduler = renewals.Scheduler()
+        scheduler.add_all(people)
+        self.assertEqual(scheduler.next_due(), helpers.datetime_months_hence(start, 12), "Wrong first renewal")
+
+        moved = people[::4]
+        for person in moved:
+            person.move_to_plan("Infinite" if person.current_plan.name != "Infinite" else "Single",
+                                helpers.datetime_months_hence(person.events[-1][0], 6))
+        scheduler.add(moved[0])
+
+        fired = []
+        for month in range(1, 37):
+            fired += scheduler.advance(helpers.datetime_months_hence(start, month))
+        self.assertEqual(scheduler.advance(helpers.datetime_months_hence(start, 36)), [], "Renewed twice")
+
+        end = helpers.datetime_months_hence(start, 36)
+        for person in people:
+            changes = [e for e in person.events[1:] if e[2] != "renewal"]
+            last = changes[-1][0]
+            expected = []
+            due = helpers.datetime_months_hence(last, 12)
+            while due <= end:
+                expected.append(due)
+                due = helpers.datetime_months_hence(due, 12)
+            renewed = [e for e in person.events[1:] if e[2] == "renewal"]
+            self.assertEqual([e[0] for e in renewed], expected, "Renewals differ")
+            self.assertEqual(fired.count(person), len(expected), "Renewals not returned")
+            if renewed:
+                self.assertEqual(person.payments[-1], person.current_plan.price, "Renewal not charged")
+                self.assertEqual(person.balances[-1], person.current_plan.price, "Balance not reset")
+                self.assertEqual(person.plan_renewal_date, helpers.datetime_months_hence(renewed[-1][0], 12))
+        self.assertEqual(scheduler.renewed, len(fired), "Renewals not counted")
+
+
+class TestHistory(unittest.TestCase):
+    """Point-in-time queries must agree with walking the ledgers"""
+
+    def test_state_and_ranges(self):
+        """Queries a customer with transfers, downgrades and a renewal at many times.
+
+        Verifies state_at, payments_between and refunds_between against a walk
+        of the events, balances, payments and refunds ledgers.
+        """
+        start = datetime(2019, 1, 10, 9, 0, 0)
+        person = Customer("Gina Linetti", "thegina", "gina@99.com")
+        person.select_plan("Plus", start)
+        person.add_website("gina.com", False)
+        for months, plan in ((2, "Infinite"), (3, "Single"), (4, "Plus")):
+            person.move_to_plan(plan, helpers.datetime_months_hence(person.events[-1][0], months))
+        person.balances[-1] = Plan.plans["Single"][1]
+        person.move_to_plan("Single", person.events[-1][0])
+        person.renew()
+
+        def walk(tim):
+            paid = refunded = 0
+            state = None
+            for i, (when, plan, type) in enumerate(person.events[1:], 1):
+                paid += type in ("start", "upgrade", "renewal")
+                refunded += type == "downgrade"
+                if helpers.datetime_to_time(when) <= tim:
+                    state = (when, plan, type, paid, person.balances[i])
+            return state
+
+        self.assertIsNone(history.state_at(person, datetime(2019, 1, 1)), "State before first event")
+        tims = [helpers.datetime_to_time(e[0]) for e in person.events[1:]]
+        for tim in range(tims[0], tims[-1] + 86400 * 30, 86400 * 7):
+            state = history.state_at(person, helpers.time_to_datetime(tim))
+            when, plan, type, paid, balance = walk(tim)
+            self.assertEqual((state.time, state.plan, state.type, state.payments, state.balance),
+                             (when, plan, type, paid, balance), "State differs")
+            self.assertLessEqual(state.remaining, state.balance, "Remaining above balance")
+
+        end = datetime(2021, 1, 1)
+        self.assertEqual([p for _, p in history.payments_between(person, start, end)], person.payments[1:])
+        self.assertEqual([r for _, r in history.refunds_between(person, start, end)], person.refunds[1:])
+        middle = helpers.datetime_months_hence(start, 3)
+        self.assertEqual(history.payments_between(person, start, middle),
+                         [(e[0], p) for e, p in zip(person.events[1:3], person.payments[1:3])], "Range differs")
+        self.assertEqual(history.events_between(person, middle, end), person.events[3:], "Events differ")
+
+        ends = dict(history.month_ends([person], start, 3))
+        self.assertEqual(list(ends), [datetime(2019, 1, 31, 23, 59, 59), datetime(2019, 2, 28, 23, 59, 59),
+                                      datetime(2019, 3, 31, 23, 59, 59)], "Month ends differ")
+        self.assertEqual(ends[datetime(2019, 3, 31, 23, 59, 59)][0][1].plan, "Infinite", "Snapshot differs")
+
+
+class TestRollups(unittest.TestCase):
+    """Incremental rollups must equal a full recompute"""
+
+    def test_sharded_rollups_merge(self):
+        """Replays a log in two shards, each into a store with an attached rollup.
+
+        Verifies the merged rollup against a recompute and the ledgers.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"), customers=30)
+            events = list(replay.read_events(log))
+
+        shards, customers = [], []
+        for shard in range(2):
+            store = CustomerStore()
+            rollup = rollups.Rollup().attach(store)
+            mine = [e for e in events if runner.shard_of(e.customer, 2) == shard]
+            customers += list(replay.replay(mine, store=store))
+            shards.append(rollup)
+        merged = rollups.Rollup().merge(shards[0]).merge(shards[1])
+
+        self.assertEqual(merged, rollups.recompute(customers), "Rollup differs from recompute")
+        self.assertNotEqual(shards[0], merged, "Shards not merged")
+        self.assertAlmostEqual(merged.revenue(), sum(sum(c.payments) for c in customers), places=6)
+        self.assertAlmostEqual(merged.refunds(), sum(sum(c.refunds) for c in customers), places=6)
+        self.assertEqual(merged.active(), dict(sorted(Counter(c.current_plan.name for c in customers).items())))
+        february = merged.changes((2019, 2))
+        logged = Counter(e[2] for c in customers for e in c.events[1:] if e[0].month == 2)
+        self.assertEqual(february, dict(sorted(logged.items())), "February events differ")
+        self.assertAlmostEqual(sum(merged.revenue((2019, 1), plan) for plan in Plan.plans), merged.revenue((2019, 1)))
+
+    def test_closed_customer(self):
+        """Closes a customer in a replay and lets it be collected.
+
+        Verifies that it is no longer an active subscriber while its payments
+        stay in the revenue.
+        """
+        log = ['{"customer": "jake", "action": "select_plan", "time": "2019-01-01T09:00:00", "plan": "Single"}',
+               '{"customer": "amy", "action": "select_plan", "time": "2019-01-02T09:00:00", "plan": "Plus"}',
+               '{"customer": "jake", "action": "close", "time": "2019-02-01T09:00:00"}']
+        store = CustomerStore()
+        rollup = rollups.Rollup().attach(store)
+        kept = [c for c in replay.replay(replay.read_jsonl(log), store=store) if c.name == "amy"]
+        self.assertEqual(rollup.active(), {"Plus": 1}, "Closed customer still counted")
+        self.assertAlmostEqual(rollup.revenue(), Plan.plans["Single"][1] + Plan.plans["Plus"][1], places=6)
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestCli(unittest.TestCase):
+    """The command must start without its heavy dependencies"""
+
+    def test_cold_start(self):
+        """Runs 'subscribersim --version' in a fresh interpreter.
+
+        Verifies that NumPy, tabulate and dateutil are not imported. The time
+        of a cold start is checked against cli.STARTUP_BUDGET by bench.py.
+        """
+        check = "import sys; from subscribersim import cli; print(' '.join(sorted(sys.modules)))"
+        loaded = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True, cwd=ROOT).stdout.split()
+        for module in ("numpy", "tabulate", "dateutil", "subscribersim.models"):
+            self.assertNotIn(module, loaded, f"{module} imported at startup")
+
+        output = subprocess.run([sys.executable, "-m", "subscribersim", "--version"],
+                                capture_output=True, text=True, check=True, cwd=ROOT).stdout
+        self.assertIn(cli.__version__, output, "Version incorrect")
+
+    def test_now_per_call(self):
+        """Verifies that an omitted now is read when each method is called"""
+        first, second = datetime(2019, 1, 1, 9), datetime(2019, 4, 1, 9)
+        jake = Customer("Jake Peralta", "diehardfan", "@jakeperalta99.com")
+        with mock.patch.object(helpers, "datetime_now", side_effect=[first, second]):
+            jake.select_plan("Single")
+            jake.move_to_plan("Plus")
+        self.assertEqual([e[0] for e in jake.events[1:]], [first, second], "Event times incorrect")
+
+    def test_replay(self):
+        """Replays a log through the command"""
+        with tempfile.TemporaryDirectory() as directory:
+            log = write_log(os.path.join(directory, "events.jsonl"), customers=5)
+            with mock.patch("sys.stdout", new=io.StringIO()) as out:
+                self.assertEqual(cli.main(["replay", log]), 0)
+        self.assertEqual(len(out.getvalue().splitlines()), 6, "Summary rows incorrect")
+
+
+class TestScenario(unittest.TestCase):
+    """A compiled scenario must match the same steps taken one customer at a time"""
+
+    JAKE = {"name": "jake", "start": "2019-01-01T09:00:00", "steps": [
+        {"select_plan": "Infinite"},
+        {"add_website": "superdupercop.com", "database": True},
+        {"add_website": "iamjohnmclane.com"},
+        {"add_website": "iheartpuzzles.com"},
+        {"move_to_plan": "Single", "after": {"months": 4}},
+        {"move_to_plan": "Plus", "after": {"months": 2, "days": 3}},
+        {"add_website": "iamjohnmclane.com"},
+        {"remove_website": "http://superdupercop.com"},
+        {"move_to_plan": "Single", "after": {"months": 4}}]}
+
+    def test_run_matches_customer_methods(self):
+        """Runs the Jake scenario from a JSON file over 20 customers"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "jake.json")
+            with open(path, "w") as fp:
+                json.dump(self.JAKE, fp)
+            program = scenario.compile_scenario(scenario.load(path))
+        self.assertEqual(list(program.ops), [0, 2, 2, 2, 1, 1, 2, 3, 1], "Opcodes incorrect")
+        self.assertEqual(len(program.constants), 4, "Constants not interned")
+        customers = scenario.run(program, scenario.population(20, store=CustomerStore()))
+
+        jake = Customer("jake", "", "")
+        jake.select_plan("Infinite", datetime(2019, 1, 1, 9))
+        jake.add_website("superdupercop.com", True)
+        jake.add_website("iamjohnmclane.com", False)
+        jake.add_website("iheartpuzzles.com", False)
+        jake.move_to_plan("Single", helpers.datetime_months_hence(helpers.datetime_get_last_event(jake), 4))
+        jake.move_to_plan("Plus", helpers.datetime_months_hence(helpers.datetime_get_last_event(jake), 2)
+                          + timedelta(days=3))
+        jake.add_website("iamjohnmclane.com", False)
+        jake.remove_website("http://superdupercop.com")
+        jake.move_to_plan("Single", helpers.datetime_months_hence(helpers.datetime_get_last_event(jake), 4))
+
+        expected = replay.summarize(jake)
+        for customer in customers:
+            self.assertEqual(customer.events, jake.events, "Events differ")
+            self.assertEqual(replay.summarize(customer)[1:], expected[1:], "Summary differs")
+
+    def test_compile_errors(self):
+        """Verifies that unknown plans, steps and offsets are rejected at compile time"""
+        for steps in ([{"select_plan": "Gold"}], [{"renew": "Single"}],
+                      [{"select_plan": "Single", "move_to_plan": "Plus"}],
+                      [{"move_to_plan": "Plus", "after": {"weeks": 1}}]):
+            with self.assertRaises(Exception):
+                scenario.compile_scenario({"steps": steps})
+
+
+class TestRegistry(unittest.TestCase):
+    """Concurrent operations on a registry must not lose updates"""
+
+    def test_stress(self):
+        """Runs plan changes and website operations from 8 threads on 40 customers.
+
+        Switching threads every microsecond interleaves the Customer methods.
+        Verifies that every operation is recorded once in the ledgers and the
+        URL index.
+        """
+        people = registry.Registry(shards=4)
+        start = datetime(2019, 1, 1, 9)
+        keys = [f"stress-{i}" for i in range(40)]
+        for key in keys:
+            people.create(key)
+            people.select_plan(key, "Infinite", start)
+        plans = ["Plus", "Single", "Infinite"]
+        moves, urls = Counter(), []
+
+        def work(thread):
+            rand = random.Random(thread)
+            for i in range(150):
+                key = rand.choice(keys)
+                if i % 3:
+                    with people.locked(key) as customer:
+                        if customer.current_plan.name == "Infinite":
+                            url = f"t{thread}-{i}.com"
+                            customer.add_website(url, False)
+                            urls.append(("http://" + url, key))
+                            continue
+                        when = helpers.datetime_months_hence(helpers.datetime_get_last_event(customer), 1)
+                        customer.move_to_plan("Infinite", when)
+                        moves[key] += 1
+                else:
+                    with people.locked(key) as customer:
+                        plan = plans[(plans.index(customer.current_plan.name) + 1) % 3]
+                        when = helpers.datetime_months_hence(helpers.datetime_get_last_event(customer), 1)
+                        customer.move_to_plan(plan, when)
+                        moves[key] += 1
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=work, args=(t,)) for t in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(sum(moves.values()) + len(urls), 8 * 150, "Operations lost")
+        for key in keys:
+            with people.locked(key) as customer:
+                self.assertEqual(len(customer.events), moves[key] + 2, "Events lost")
+                self.assertEqual(len(customer.spend), moves[key] + 1, "Spend lost")
+                self.assertEqual(len(customer.balances), len(customer.events), "Balances lost")
+                times = [e[0] for e in customer.events[1:]]
+                self.assertEqual(times, sorted(times), "Events out of order")
+        for url, key in urls:
+            owners = people.hosting(url)
+            with people.locked(key) as customer:
+                self.assertEqual(owners, [key] if url in customer.websites else [], "URL index differs")
+        self.assertFalse(any(url in sites.index.owners for url, _ in urls), "Global URL index used")
+        hosts = ["host-a", "host-b"]
+        while people._shard(hosts[0]) is people._shard(hosts[1]):
+            hosts[1] += "b"
+        for key in hosts:
+            people.create(key)
+            people.select_plan(key, "Infinite", start)
+            people.add_website(key, "shared.com")
+        self.assertEqual(sorted(people.duplicates()["http://shared.com"]), hosts, "Duplicate across shards not found")
+        self.assertEqual(people.summary(keys[0]).events, moves[keys[0]] + 1, "Summary incorrect")
+        people.remove(keys[0])
+        self.assertNotIn(keys[0], people, "Customer not removed")
+
+
+class TestWhatIf(unittest.TestCase):
+    """Repriced histories must match a rerun under the alternative catalog"""
+
+    def setUp(self):
+        self.default = Plan.catalog
+
+    def tearDown(self):
+        self.default.install()
+
+    def run_history(self, events):
+        """Replays events into a new store and renews every customer up to 2021"""
+        customers = list(replay.replay(events, store=CustomerStore()))
+        scheduler = renewals.Scheduler()
+        scheduler.add_all(customers)
+        scheduler.advance(datetime(2021, 1, 1))
+        return customers
+
+    def test_reprice_matches_rerun(self):
+        """Raises the price of Plus and compares the diff with a full rerun"""
+        with tempfile.TemporaryDirectory() as directory:
+            events = list(replay.read_events(write_log(os.path.join(directory, "events.jsonl"))))
+        customers = self.run_history(events)
+
+        same = whatif.reprice(customers, self.default)
+        logged = whatif.histories(customers, self.default)
+        self.assertTrue((same.payments == logged.payments).all(), "Payments not reproduced")
+        self.assertTrue((same.refunds == logged.refunds).all(), "Refunds not reproduced")
+        self.assertEqual(whatif.diff(customers, self.default), [], "Unchanged catalog has a diff")
+
+        catalog = Catalog(dict(self.default.plans, Plus=(3, 120)))
+        self.assertEqual(whatif.changed_plans(catalog), {"Plus"}, "Changed plans incorrect")
+        touched = whatif.affected(customers, {"Plus"})
+        self.assertTrue(0 < len(touched) < len(customers), "Affected customers incorrect")
+        rows = {row.plan: row for row in whatif.diff(customers, catalog)}
+
+        catalog.install()
+        rerun = rollups.recompute(self.run_history(events))
+        for plan, row in rows.items():
+            self.assertAlmostEqual(row.repriced_paid - row.paid, rerun.revenue(plan=plan) -
+                                   rollups.recompute(customers).revenue(plan=plan), places=6)
+            self.assertAlmostEqual(row.repriced_refunded - row.refunded, rerun.refunds(plan=plan) -
+                                   rollups.recompute(customers).refunds(plan=plan), places=6)
+        self.assertGreater(rows["Plus"].change, 0, "Plus revenue not raised")
+
+
+class TestQuotes(unittest.TestCase):
+    """A quote must match the move it previews and change nothing"""
+
+    def test_quote_matches_move(self):
+        """Quotes a downgrade twice in a day, then makes the move at the quoted time"""
+        cache = quotes.QuoteCache(size=2)
+        amy = Customer("Amy Santiago", "binders", "amy@99.com")
+        amy.select_plan("Infinite", datetime(2019, 1, 1, 9))
+        for n in range(4):
+            amy.add_website(f"amy{n}.com", False)
+        rows = amy.ROWS
+
+        quote = cache.quote(amy, "Plus", datetime(2019, 5, 3, 17, 45))
+        self.assertEqual(cache.quote(amy, "Plus", datetime(2019, 5, 3, 8)), quote, "Quote differs within a day")
+        self.assertEqual((cache.hits, cache.misses), (1, 1), "Quote not cached")
+        self.assertEqual(quote.time, datetime(2019, 5, 3), "Quote not priced at the start of the day")
+        self.assertEqual(quote.sites_to_remove, ("http://amy3.com",), "Sites to remove incorrect")
+        self.assertEqual((amy.ROWS, amy.website_count), (rows, 4), "Quote changed the customer")
+
+        amy.remove_website("http://amy0.com")
+        self.assertEqual(cache.quote(amy, "Plus", datetime(2019, 5, 3)).sites_to_remove, (),
+                         "Sites read from the cache")
+        rosa = Customer("Rosa Diaz", "", "")
+        rosa.select_plan("Infinite", datetime(2019, 1, 1, 9))
+        rosa.move_to_plan("Plus", datetime(2019, 5, 3, 17, 45))
+        self.assertGreater(quote.refund, rosa.refunds[-1], "Move later in the day refunded as quoted")
+        amy.move_to_plan("Plus", quote.time)
+        self.assertEqual((quote.type, quote.refund, quote.balance, quote.spend),
+                         (amy.events[-1][2], amy.refunds[-1], amy.balances[-1], amy.spend[-1]), "Quote differs from move")
+
+        after = cache.quote(amy, "Infinite", datetime(2019, 5, 3, 12))
+        self.assertEqual((after.time, after.spend), (datetime(2019, 5, 3), 0), "Ledger change not seen")
+        for day in range(4, 8):
+            cache.quote(amy, "Single", datetime(2019, 5, day))
+        self.assertEqual(len(cache.customers[amy][1]), 2, "LRU not bounded")
+        with self.assertRaises(Exception):
+            cache.quote(amy, "Single", datetime(2019, 5, 2))
+        with self.assertRaises(Exception):
+            quotes.quote_move(amy, "Plus")
+
+
+class TestFlips(unittest.TestCase):
+    """Sliding window counters must match a scan of the ledgers"""
+
+    def test_jake_is_flagged(self):
+        """Replays the plan changes of the example program into a store with a detector"""
+        store = CustomerStore()
+        detector = flips.Detector(window=365 * 86400, buckets=12, flips=3, lateness=366 * 86400).attach(store)
+        jake = Customer("Jake Peralta", "diehardfan", "@jakeperalta99.com", store)
+        amy = Customer("Amy Santiago", "binders", "amy@99.com", store)
+        jake.select_plan("Infinite", datetime(2019, 1, 1, 9))
+        amy.select_plan("Single", datetime(2019, 1, 1, 9))
+        for plan, months in (("Single", 4), ("Plus", 2), ("Single", 4), ("Plus", 1)):
+            jake.move_to_plan(plan, helpers.datetime_months_hence(helpers.datetime_get_last_event(jake), months))
+        amy.move_to_plan("Infinite", datetime(2019, 6, 1))
+
+        self.assertEqual(len(detector.alerts), 1, "Alerts incorrect")
+        alert = detector.alerts[0]
+        self.assertEqual((alert.customer, alert.reason, alert.upgrades, alert.downgrades),
+                         ("Jake Peralta", "flips", 1, 2), "Alert incorrect")
+        self.assertEqual(alert.time, jake.events[4][0], "Alert not raised on the third change")
+        self.assertAlmostEqual(alert.refunded, sum(jake.refunds), places=6)
+        self.assertEqual(detector.window(jake.name).upgrades, 2, "Window not updated after the alert")
+
+        jake.move_to_plan("Infinite", datetime(2023, 1, 1))
+        self.assertEqual(len(detector), 1, "Idle customer not evicted")
+
+    def test_window_matches_scan(self):
+        """Compares the windows with the moves of each customer in its last buckets"""
+        store = CustomerStore()
+        detector = flips.Detector(window=120 * 86400, buckets=4, flips=100, refunds=500).attach(store)
+        with tempfile.TemporaryDirectory() as directory:
+            customers = list(replay.replay(replay.read_events(write_log(os.path.join(directory, "events.jsonl"))),
+                                           store=store))
+
+        width = detector.width
+        for customer in customers:
+            window = detector.window(customer.name) or flips.Alert(customer.name, None, None, 0, 0, 0, 0)
+            head = helpers.datetime_to_time(customer.events[-1][0]) // width
+            recent = [e for e in customer.events[1:] if helpers.datetime_to_time(e[0]) // width > head - 4]
+            self.assertEqual((window.upgrades, window.downgrades),
+                             (sum(e[2] == "upgrade" for e in recent), sum(e[2] == "downgrade" for e in recent)),
+                             "Window differs from scan")
+        self.assertTrue(all(alert.reason == "refunds" and alert.refunded - alert.paid >= 500
+                            for alert in detector.alerts), "Refund alerts incorrect")
+        detector.detach(store)
+
+    def test_reused_id(self):
+        """Releases a flipping customer and creates another on its id.
+
+        Verifies that the new customer starts with an empty window and that
+        alerts name the customer.
+        """
+        store = CustomerStore()
+        detector = flips.Detector(window=365 * 86400, buckets=12, flips=3).attach(store)
+        rosa = Customer("Rosa Diaz", "", "", store)
+        rosa.select_plan("Single", datetime(2019, 1, 1))
+        rosa.move_to_plan("Plus", datetime(2019, 2, 1))
+        rosa.move_to_plan("Single", datetime(2019, 3, 1))
+        cid = rosa.id
+        del rosa
+
+        terry = Customer("Terry Jeffords", "", "", store)
+        self.assertEqual(terry.id, cid, "Id not reused")
+        terry.select_plan("Single", datetime(2019, 4, 1))
+        terry.move_to_plan("Plus", datetime(2019, 5, 1))
+        self.assertEqual(detector.alerts, flips.deque(), "Window inherited from the released customer")
+        self.assertEqual(detector.window("Terry Jeffords").upgrades, 1, "Window incorrect")
+        self.assertEqual(detector.window("Rosa Diaz").downgrades, 1, "Window of the released customer lost")
+        terry.move_to_plan("Single", datetime(2019, 6, 1))
+        terry.move_to_plan("Plus", datetime(2019, 7, 1))
+        self.assertEqual([alert.customer for alert in detector.alerts], ["Terry Jeffords"], "Alert names wrong customer")
+
+    def test_out_of_order(self):
+        """Verifies that an event older than lateness raises instead of reaching an evicted window"""
+        store = CustomerStore()
+        detector = flips.Detector(window=365 * 86400, buckets=12, lateness=31 * 86400).attach(store)
+        people = [Customer(name, "", "", store) for name in ("Hitchcock", "Scully")]
+        people[0].select_plan("Single", datetime(2019, 1, 1))
+        people[1].select_plan("Single", datetime(2021, 1, 1))
+        people[1].move_to_plan("Plus", datetime(2020, 12, 15))
+        with self.assertRaises(Exception):
+            people[0].move_to_plan("Plus", datetime(2019, 6, 1))
+        self.assertIsNone(detector.window("Hitchcock"), "Unreachable window kept")
+
+
 if (__name__ == '__main__'):
     unittest.main()